@@ -2,8 +2,20 @@
 
 from __future__ import print_function
 import unicodedata
+import bisect
+import functools
+import gc
 import json
+import math
 import os
+import re
+import sys
+import types
+from storage import open_storage
+import stats
+
+# file used to store the collection if REF_DB is not defined
+DEFAULT_PATH = "references.json"
 
 def debug(*l):
     if False:
@@ -17,55 +29,109 @@ FIELDS = {
     "volume":None,
     "issue":None,
     "pages":None,
-    "links":[],
+    "links":{},
     "tags":[],
 }
 
 
+# shared values for refs without links, tags, alternatives or unknown fields
+NO_LINKS = types.MappingProxyType({})
+NO_TAGS = frozenset()
+NO_ITEMS = ()
+
+# table of authors, shared by all refs
+AUTHORS = {}
+
+def intern_author(author):
+    "Get the shared (lastname, givenname) tuple for an author"
+    author = tuple(author)
+    shared = AUTHORS.get(author)
+    if shared is None:
+        shared = tuple( sys.intern(str(name)) if isinstance(name, str) else name for name in author )
+        shared = AUTHORS.setdefault(shared, shared)
+    return shared
+
+
 class Ref:
     """Store all metadata about a reference.
     It is the central representation of a reference, which can be
     created from multiple sources and saved in multiple formats.
     """
     
+    # no per-instance dict: large collections hold many refs
+    __slots__ = tuple(FIELDS) + ("_missed", "_alternatives", "collection", "key")
+    
     def __init__(self, meta):
     
-        # add selected fields as attributes
-        self.extra = []
-        self.missed = []
-        for key in meta.keys():
-            value = meta[key]
-            if key in FIELDS:
-                setattr(self, key, value)
-            else:
-                self.missed.append((key,value))
+        # add selected fields as attributes, with defaults for missing fields
+        for key,default in FIELDS.items():
+            setattr(self, key, meta.get(key, default))
         
-        # default for missing fields
-        for key in FIELDS:
-            if not hasattr(self, key):
-                setattr(self, key, FIELDS[key])
+        missed = None
+        if not FIELDS.keys() >= meta.keys():
+            missed = [ (key,value) for key,value in meta.items() if key not in FIELDS and key != "alternatives" ] or None
+        self._missed = missed
         
         # Remove the ending point which is often included
         if self.title.endswith("."):
             self.title = self.title[:-1]
         
-        self.tags = set(self.tags)
+        # share repeated values between refs
+        if self.authors:
+            self.authors = tuple( intern_author(a) for a in self.authors )
+        if isinstance(self.journal, str):
+            self.journal = sys.intern(str(self.journal))
+        if isinstance(self.year, str):
+            self.year = sys.intern(str(self.year))
+        
+        self.tags = set(self.tags) if self.tags else NO_TAGS
+        self.links = dict(self.links) if self.links else NO_LINKS
         
-        self.alternatives = []
+        alternatives = meta.get("alternatives")
+        self._alternatives = [ Ref(alt) for alt in alternatives ] if alternatives else None
+        
+        # set when the ref is added to a collection
+        self.collection = None
+        self.key = None
+    
+    @property
+    def missed(self):
+        "Unknown fields found in the metadata, as (key,value) pairs"
+        return self._missed or NO_ITEMS
+    
+    @property
+    def extra(self):
+        return NO_ITEMS
+    
+    @property
+    def alternatives(self):
+        return self._alternatives or NO_ITEMS
     
     def add_alternative(self, ref):
-        self.alternatives.append(ref)
+        if self._alternatives is None:
+            self._alternatives = []
+        self._alternatives.append(ref)
     
     def add_link(self, key, value):
         "Add an identifier to this reference (pubmed, doi)"
+        old = self.links.get(key)
+        if not self.links:
+            self.links = {}
         self.links[key] = value
+        if self.collection:
+            self.collection.index_link(self.key, key, value, old)
+            self.collection.dirty.add(self.key)
     
     def add_tag(self, tag):
+        if not self.tags:
+            self.tags = set()
         self.tags.add(tag)
+        if self.collection:
+            self.collection.index_tag(self.key, tag)
+            self.collection.dirty.add(self.key)
     
     def short(self):
-        descr = u"%s\n%s (%s)" % (self.title, self.fmt_authors(), self.year)
-        return descr.encode("utf-8")
+        return u"%s\n%s (%s)" % (self.title, self.fmt_authors(), self.year)
     
     def __str__(self):
         issue = ""
@@ -83,7 +149,7 @@ class Ref:
         "Get a formatted list of authors"
         authors = self.authors
         if len(self.authors) > 7:
-            authors = authors[:5]
+            authors = list(authors[:5])
             authors.append(("et al.", ""))
         return ", ".join( [ self.fmt_author(a) for a in authors ] )
     
@@ -96,6 +162,8 @@ class Ref:
         for key in FIELDS:
             value = getattr(self, key)
             if value:
+                if isinstance(value, set):
+                    value = sorted(value)
                 meta[key] = value
         return meta
     
@@ -105,6 +173,8 @@ class Ref:
         for key in FIELDS:
             value = getattr(self,key)
             if value:
+                if isinstance(value, set):
+                    value = sorted(value)
                 if isfirst:
                     isfirst = False
                 else:
@@ -115,83 +185,263 @@ class Ref:
         return ret
 
 class RefCollection:
-    def __init__(self):
+    """Set of references, saved in a storage backend (see storage.py).
+    The backend is selected from the extension of the file: a JSON file (the default),
+    a SQLite database (.sqlite or .db) or a binary file (.refs).
+    With the last two, refs are only loaded when needed.
+    """
+    
+    @stats.timed("collection.open")
+    def __init__(self, path=None):
+        # loaded refs, all of them unless the storage is lazy
         self.refs = {}
-        self.path = "references.json"
-        if os.path.isfile(self.path):
-            f = open(self.path)
-            rawrefs = json.load(f)
-            f.close()
-            
-            for k in rawrefs.keys():
-                r = rawrefs[k]
-                self.add_reference(Ref(r))
+        # indexes: (link type, value) -> list of keys (in the order the refs were loaded) and tag -> set of keys
+        self.link_index = {}
+        self.tag_index = {}
+        # built on the first search, then updated with new refs
+        self.search_index = None
+        # built on the first duplicate check, then updated with new refs
+        self.duplicate_index = None
+        # keys of the refs which changed since the last save
+        self.dirty = set()
+        # keys of the refs added since the last save -> prefix of the key (see rekey)
+        self.added = {}
+        # next suffix to try for each key prefix (see pick_key)
+        self.key_counters = {}
+        
+        if not path:
+            path = os.environ.get("REF_DB", DEFAULT_PATH)
+        self.path = path
+        self.storage = open_storage(path)
+        # true when all refs are in memory
+        self.loaded = False
+        
+        if not self.storage.lazy:
+            self.load_all()
     
     def add_reference(self, ref, key=None):
         if not key:
             key = "%s%s" % (remove_accents(ref.authors[0][0]),ref.year)
         
+        prefix = key
         key = self.pick_key(key)
-        self.refs[key] = ref
+        self.attach(key, ref)
+        self.dirty.add(key)
+        self.added[key] = prefix
         return key
     
+    def attach(self, key, ref):
+        "Add a ref to the loaded refs and to the indexes"
+        self.refs[key] = ref
+        ref.collection = self
+        ref.key = key
+        for link,value in ref.links.items():
+            self.index_link(key, link, value)
+        for tag in ref.tags:
+            self.index_tag(key, tag)
+        if self.search_index is not None:
+            self.search_index.add(key, ref)
+        if self.duplicate_index is not None:
+            self.duplicate_index.add(key, ref)
+    
+    @stats.timed("collection.load_all")
+    def load_all(self):
+        "Make sure that all refs are loaded (they may not be with a lazy storage)"
+        if self.loaded:
+            return
+        
+        # the garbage collector slows down the creation of many objects for nothing
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            rawrefs = self.storage.load_all()
+            for k in rawrefs.keys():
+                if k not in self.refs:
+                    self.attach(k, Ref(rawrefs[k]))
+        finally:
+            if gc_enabled:
+                gc.enable()
+        self.loaded = True
+    
+    def index_link(self, key, link, value, old=None):
+        if old is not None and old != value:
+            self.unindex_link(key, link, old)
+        # all refs with this link are kept: the first one is found, as with the linear search
+        keys = self.link_index.setdefault( (link,value), [] )
+        if key not in keys:
+            keys.append(key)
+        if self.duplicate_index is not None:
+            self.duplicate_index.add_link(key, link, value)
+    
+    def unindex_link(self, key, link, value):
+        keys = self.link_index.get( (link,value) )
+        if keys and key in keys:
+            keys.remove(key)
+            if not keys:
+                del self.link_index[ (link,value) ]
+    
+    def index_tag(self, key, tag):
+        if tag not in self.tag_index:
+            self.tag_index[tag] = set()
+        self.tag_index[tag].add(key)
+    
     def pick_key(self, k):
-        key = k
-        sup = ord("a")
-        while key in self.refs:
-            key = k + chr(sup)
-            sup += 1
+        """Find a free key starting with k: k, then ka..kz, kaa..kaz, kba...
+        The next suffix to try is kept for each prefix, so that each suffix is only tried once."""
+        n = self.key_counters.get(k, 0)
+        key = k + key_suffix(n)
+        while self.contains(key):
+            n += 1
+            key = k + key_suffix(n)
+        self.key_counters[k] = n + 1
         return key
     
+    def rekey(self, key):
+        """Move a ref added since the last save to a new key, when another process saved a ref with its key.
+        Returns the new key."""
+        prefix = self.added.pop(key)
+        ref = self.refs.pop(key)
+        for link,value in ref.links.items():
+            self.unindex_link(key, link, value)
+        for keys in self.tag_index.values():
+            keys.discard(key)
+        # the indexes can not remove a ref, they are rebuilt when needed
+        self.search_index = None
+        self.duplicate_index = None
+        self.dirty.discard(key)
+        
+        new_key = self.pick_key(prefix)
+        self.attach(new_key, ref)
+        self.dirty.add(new_key)
+        self.added[new_key] = prefix
+        print("The key %s was taken by another process, the reference is saved as %s" % (key, new_key))
+        return new_key
+    
+    def contains(self, key):
+        return key in self.refs or (not self.loaded and self.storage.contains(key))
+    
+    def keys(self):
+        "Get the keys of all refs (without loading them)"
+        if self.loaded:
+            return set(self.refs.keys())
+        return set(self.refs.keys()).union( self.storage.keys() )
+    
     def get(self, key):
+        if key not in self.refs and not self.loaded:
+            meta = self.storage.load(key)
+            if meta is None:
+                raise KeyError(key)
+            self.attach(key, Ref(meta))
         return self.refs[key]
     
     def find(self, key, value):
-        for ref in self.refs.values():
-            if key in ref.links and ref.links[key] == value:
-                return ref
+        "Find the ref with a given link (for example a doi or pmid)"
+        keys = self.link_index.get( (key,value) )
+        refkey = keys[0] if keys else None
+        if not refkey and not self.loaded:
+            if not hasattr(self.storage, "find"):
+                # this storage can not search links
+                self.load_all()
+                return self.find(key, value)
+            refkey = self.storage.find(key, value)
+        if refkey:
+            return self.get(refkey)
     
     def get_references(self, tag=None):
         if tag:
-            tagged = {}
-            for key,ref in self.refs.items():
-                if tag in ref.tags: tagged[key] = ref
-            return tagged
+            if not self.loaded and not hasattr(self.storage, "tagged"):
+                self.load_all()
+            keys = set( self.tag_index.get(tag, ()) )
+            if not self.loaded:
+                keys.update( self.storage.tagged(tag) )
+            return dict( (key,self.get(key)) for key in keys )
         
+        self.load_all()
         return self.refs
     
+    def iter_references(self, tag=None):
+        """Iterate over the (key,ref) pairs sorted by key, optionally restricted to a tag.
+        Refs which are not loaded yet are decoded one at a time and not kept in memory.
+        """
+        if tag:
+            if not self.loaded and not hasattr(self.storage, "tagged"):
+                self.load_all()
+            keys = set( self.tag_index.get(tag, ()) )
+            if not self.loaded:
+                keys.update( self.storage.tagged(tag) )
+        else:
+            keys = self.keys()
+        
+        for key in sorted(keys):
+            ref = self.refs.get(key)
+            if ref is None:
+                ref = Ref(self.storage.load(key))
+            yield key, ref
+    
     def search(self, args):
-        pass
+        """Search refs matching all words of a query, returns a list of (key,ref) sorted by relevance.
+        Words can be restricted to a field (e.g. author:Naldi year:2015) and match as prefixes.
+        """
+        self.load_all()
+        if self.search_index is None:
+            self.search_index = SearchIndex()
+            for key,ref in self.refs.items():
+                self.search_index.add(key, ref)
+        return [ (key, self.refs[key]) for key in self.search_index.search(" ".join(args)) ]
     
+    def find_duplicate(self, ref):
+        """Find a stored ref describing the same work as a new ref, returns a (key, exact) pair or None.
+        Refs sharing a DOI or pubmed ID are exact duplicates, refs with the same (or a very similar) title,
+        first author and year are near-duplicates (exact is False).
+        """
+        # the duplicate index also has the links, use it when the storage can not search them
+        if self.loaded or hasattr(self.storage, "find"):
+            for link in DUPLICATE_LINKS:
+                value = ref.links.get(link)
+                if value:
+                    found = self.find(link, value)
+                    if found is not None:
+                        return found.key, True
+        
+        return self.get_duplicate_index().find(ref)
+    
+    @stats.timed("collection.duplicate_index")
+    def get_duplicate_index(self):
+        """Build the duplicate index on the first call.
+        With a lazy storage, only the fields compared by the index are read from the storage
+        (see duplicate_items): refs are not loaded."""
+        if self.duplicate_index is not None:
+            return self.duplicate_index
+        
+        index = DuplicateIndex()
+        if not self.loaded and hasattr(self.storage, "duplicate_items"):
+            for key,meta in self.storage.duplicate_items():
+                # loaded refs may have changed since they were saved
+                if key not in self.refs:
+                    index.add(key, Ref(meta))
+        else:
+            self.load_all()
+        for key,stored in self.refs.items():
+            index.add(key, stored)
+        self.duplicate_index = index
+        return index
+    
+    @stats.timed("collection.save")
     def save(self):
-        if not self.refs:
+        "Save the refs which changed since the last save"
+        if not self.dirty:
             return
         
-        encoder = json.JSONEncoder()
-        f = open(self.path, "w")
-        f.write("{\n")
-        isfirst = True
-        for key in sorted(self.refs.keys()):
-            ref = self.refs[key]
-            if isfirst:
-                isfirst = False
-            else:
-                f.write(",\n")
-            
-            f.write('"%s": %s' % (key,ref.encode(encoder)) )
-            
-        f.write("\n}\n")
-        f.close()
+        self.storage.save(self.refs, self.dirty, self.added, self.rekey)
+        self.dirty.clear()
+        self.added.clear()
     
     def save_ref(self, key, folder):
-        if not self.refs:
-            return
-        
-        if key not in self.refs:
+        if not self.contains(key):
             print("No such ref: "+key)
             return
         
-        ref = self.refs[key]
+        ref = self.get(key)
         
         encoder = json.JSONEncoder()
         f = open("%s/%s.json" % (folder, key), "w")
@@ -199,6 +449,231 @@ class RefCollection:
         f.close()
 
 
+# searchable fields and their weight in the ranking
+SEARCH_FIELDS = {
+    "title": 1.0,
+    "authors": 2.0,
+    "journal": 0.5,
+    "year": 1.0,
+}
+SEARCH_ALIASES = {"author": "authors"}
+TOKEN_PATTERN = re.compile(r"[^\W\d_]+|\d+")
+
+def tokenize(text):
+    "Split a text into lowercase words without accents, and numbers"
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text):
+        if not token.isdigit():
+            token = fold_word(token)
+        if token:
+            tokens.append(token)
+    return tokens
+
+@functools.lru_cache(maxsize=100000)
+def fold_word(word):
+    return remove_accents(word).lower()
+
+def search_text(ref, field):
+    value = getattr(ref, field)
+    if not value:
+        return ""
+    if field == "authors":
+        return " ".join( [ " ".join(a) for a in value ] )
+    return "%s" % value
+
+class SearchIndex:
+    """Inverted index on the title, authors, journal and year of refs.
+    For each field, it associates words to the keys of the refs containing them,
+    and keeps a sorted vocabulary for prefix matching.
+    """
+    
+    def __init__(self):
+        self.size = 0
+        self.postings = dict( (field,{}) for field in SEARCH_FIELDS )
+        self.vocabulary = dict( (field,[]) for field in SEARCH_FIELDS )
+    
+    def add(self, key, ref):
+        self.size += 1
+        for field in SEARCH_FIELDS:
+            postings = self.postings[field]
+            for token in tokenize(search_text(ref, field)):
+                if token not in postings:
+                    postings[token] = {}
+                    bisect.insort(self.vocabulary[field], token)
+                matches = postings[token]
+                matches[key] = matches.get(key, 0) + 1
+    
+    def match(self, field, term):
+        "Score the refs with a word starting with the term in this field"
+        scores = {}
+        postings = self.postings[field]
+        vocabulary = self.vocabulary[field]
+        idx = bisect.bisect_left(vocabulary, term)
+        while idx < len(vocabulary) and vocabulary[idx].startswith(term):
+            token = vocabulary[idx]
+            idx += 1
+            matches = postings[token]
+            weight = SEARCH_FIELDS[field] * math.log(1 + self.size / len(matches))
+            if token != term:
+                # prefix matches are less relevant
+                weight /= 2
+            for key,count in matches.items():
+                scores[key] = scores.get(key, 0) + weight * count
+        return scores
+    
+    def search(self, query):
+        "Return the keys of refs matching all words of the query, best matches first"
+        result = None
+        for word in query.split():
+            fields = SEARCH_FIELDS
+            if ":" in word:
+                field, word = word.split(":", 1)
+                field = SEARCH_ALIASES.get(field, field)
+                if field not in SEARCH_FIELDS:
+                    print("Unknown search field: "+field)
+                    return []
+                fields = (field,)
+            
+            for term in tokenize(word):
+                scores = {}
+                for field in fields:
+                    for key,score in self.match(field, term).items():
+                        scores[key] = scores.get(key, 0) + score
+                
+                if result is None:
+                    result = scores
+                else:
+                    result = dict( (key, score+scores[key]) for key,score in result.items() if key in scores )
+                if not result:
+                    return []
+        
+        if not result:
+            return []
+        return sorted(result, key=lambda key: (-result[key], key))
+
+
+# links identifying a work: refs sharing one of them are duplicates
+DUPLICATE_LINKS = ("doi", "pmid")
+# minimal similarity between the normalized titles of near-duplicates
+TITLE_SIMILARITY = 0.9
+
+def title_key(ref):
+    "Normalized title: lowercase words without accents and punctuation"
+    return " ".join(tokenize(ref.title or ""))
+
+class DuplicateIndex:
+    """Find refs describing the same work as a new ref.
+    Links (DOI, pubmed ID) are indexed without case. Near-duplicates have similar titles and the same
+    first author (or the same journal when authors are missing). Refs are grouped in blocks
+    sharing a normalized title, or the same first author and year: a new ref is only compared
+    to the refs of its blocks instead of the whole collection.
+    """
+    
+    def __init__(self):
+        self.links = {}
+        self.blocks = {}
+        # key -> (normalized title, year, links, first author, journal) of the indexed refs
+        self.info = {}
+    
+    def add(self, key, ref):
+        if key in self.info:
+            # a stored ref loaded after the index was built
+            return
+        title = title_key(ref)
+        self.info[key] = (title, year_key(ref), ref.links, author_key(ref), journal_key(ref))
+        for link in DUPLICATE_LINKS:
+            if link in ref.links:
+                self.add_link(key, link, ref.links[link])
+        for block in blocking_keys(ref, title):
+            if block not in self.blocks:
+                self.blocks[block] = []
+            self.blocks[block].append(key)
+    
+    def add_link(self, key, link, value):
+        if link in DUPLICATE_LINKS:
+            self.links.setdefault( (link, ("%s" % value).lower()), key )
+    
+    def find(self, ref):
+        "Return a (key, exact) pair for the first duplicate of a ref, or None"
+        for link in DUPLICATE_LINKS:
+            value = ref.links.get(link)
+            if value:
+                key = self.links.get( (link, ("%s" % value).lower()) )
+                if key:
+                    return key, True
+        
+        title = title_key(ref)
+        if not title:
+            return None
+        
+        year = year_key(ref)
+        author = author_key(ref)
+        journal = journal_key(ref)
+        for block in blocking_keys(ref, title):
+            for key in self.blocks.get(block, ()):
+                other_title, other_year, other_links, other_author, other_journal = self.info[key]
+                if year and other_year and year != other_year:
+                    continue
+                if conflicting_links(ref.links, other_links):
+                    continue
+                # short titles ("Editorial", "Reply") are shared by many different works
+                if author and other_author:
+                    if author != other_author:
+                        continue
+                elif not journal or journal != other_journal:
+                    continue
+                if title == other_title or similar_titles(title, other_title):
+                    return key, False
+        return None
+
+def blocking_keys(ref, title):
+    blocks = []
+    if title:
+        blocks.append( ("title", title) )
+    if ref.authors and ref.year:
+        blocks.append( ("author", author_key(ref), year_key(ref)) )
+    return blocks
+
+def author_key(ref):
+    "Normalized surname of the first author"
+    if ref.authors:
+        return " ".join(tokenize(ref.authors[0][0]))
+    return ""
+
+def journal_key(ref):
+    return " ".join(tokenize("%s" % (ref.journal or "")))
+
+def year_key(ref):
+    if ref.year:
+        return "%s" % ref.year
+
+def conflicting_links(links, other_links):
+    "Check if two refs have different DOIs or pubmed IDs (and are thus different works)"
+    for link in DUPLICATE_LINKS:
+        if link in links and link in other_links and ("%s" % links[link]).lower() != ("%s" % other_links[link]).lower():
+            return True
+    return False
+
+def similar_titles(title, other):
+    # titles differing by a number are different parts or volumes
+    if [ w for w in title.split() if w.isdigit() ] != [ w for w in other.split() if w.isdigit() ]:
+        return False
+    import difflib
+    matcher = difflib.SequenceMatcher(None, title, other, autojunk=False)
+    # the quick upper bounds discard most candidates without computing the ratio
+    return (matcher.real_quick_ratio() >= TITLE_SIMILARITY and matcher.quick_ratio() >= TITLE_SIMILARITY
+            and matcher.ratio() >= TITLE_SIMILARITY)
+
+
+def key_suffix(n):
+    "Suffix of the n-th key with the same prefix: '', a..z, aa..az, ba..zz, aaa... (bijective base 26)"
+    suffix = ""
+    while n > 0:
+        n, r = divmod(n-1, 26)
+        suffix = chr(ord("a") + r) + suffix
+    return suffix
+
+@functools.lru_cache(maxsize=100000)
 def remove_accents(input_str):
     nkfd_form = unicodedata.normalize('NFKD', input_str)
     return u"".join([c for c in nkfd_form if unicodedata.category(c)[0] == 'L' and not unicodedata.combining(c) ])
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""Measure the memory used by Ref objects.
+
+Usage: memory.py [number of refs]
+
+Builds a set of synthetic refs with the current Ref class and with a copy
+of the former dict-based implementation, and prints the memory used per ref.
+"""
+
+import os
+import sys
+import json
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from __init__ import Ref, FIELDS
+from synthetic import make_meta
+
+
+class DictRef:
+    "Former implementation of Ref: attributes in a per-instance dict, with empty lists"
+
+    def __init__(self, meta):
+        self.extra = []
+        self.missed = []
+        for key in meta.keys():
+            value = meta[key]
+            if key in FIELDS:
+                setattr(self, key, value)
+            else:
+                self.missed.append((key,value))
+
+        for key in FIELDS:
+            if not hasattr(self, key):
+                setattr(self, key, FIELDS[key])
+
+        if self.title.endswith("."):
+            self.title = self.title[:-1]
+
+        self.tags = set(self.tags)
+        self.alternatives = []
+
+
+def measure(cls, count):
+    "Memory (in bytes) used per ref, including the metadata values it keeps"
+    # parse the metadata from JSON, as when loading a collection
+    raw = [ json.dumps(make_meta(i)) for i in range(count) ]
+
+    tracemalloc.start()
+    refs = [ cls(json.loads(r)) for r in raw ]
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / count
+
+
+def main(args):
+    count = 100000
+    if len(args) > 1:
+        count = int(args[1])
+
+    before = measure(DictRef, count)
+    after = measure(Ref, count)
+    result = {
+        "refs": count,
+        "dict_ref_bytes": round(before),
+        "ref_bytes": round(after),
+        "saved_bytes": round(before - after),
+        "saved_percent": round(100 * (before - after) / before, 1),
+    }
+    print( json.dumps(result, indent=1) )
+
+
+if __name__ == "__main__":
+    main( sys.argv )
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+
+"""Time the main operations on synthetic collections.
+
+Usage: run.py [--sizes 1000,10000,100000] [--only load,save,...] [--repeat <n>]
+              [--workdir <folder>] [--output <file.json>]
+       run.py --compare <before.json> <after.json>
+
+Benchmarks: load, save, find, export, import and lookup (with the mock server
+of plugins/mockserver.py standing in for the DOI system, pubmed and publisher pages). Each measure is the best
+time of several runs, the results are printed (or saved) as JSON.
+Generated files are kept in the work folder (a temporary folder by default),
+so that several runs can reuse them. Benchmarks which need a missing
+dependency are reported as skipped.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import platform
+import tempfile
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from __init__ import Ref, RefCollection
+from plugins import cache as mod_cache
+from plugins import webclient as mod_web
+from plugins import mockserver as mod_mock
+import synthetic
+
+BENCHMARKS = ("load", "save", "find", "export", "import", "lookup")
+DEFAULT_SIZES = (1000, 10000, 100000)
+# storage formats, by extension
+STORAGES = ("json", "sqlite", "refs")
+# number of queries in the find benchmark
+QUERIES = 1000
+# number of identifiers in the lookup benchmark (at most the number of refs)
+LOOKUPS = 200
+LOOKUP_JOBS = 8
+
+
+def timed(function, repeat, setup=None, teardown=None):
+    """Best time (in seconds) of several runs.
+    The result of setup (if any) is given to the function, and then to teardown."""
+    best = None
+    for run in range(repeat):
+        args = ()
+        if setup:
+            args = (setup(),)
+        start = time.perf_counter()
+        function(*args)
+        elapsed = time.perf_counter() - start
+        if teardown:
+            teardown(*args)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def close(collection):
+    collection.storage.close()
+
+def log(message):
+    print(message, file=sys.stderr)
+
+def remove_collection(path):
+    "Remove a collection and its side files (journal, SQLite logs...)"
+    folder, name = os.path.split(path)
+    for filename in os.listdir(folder):
+        if filename.startswith(name):
+            os.remove(os.path.join(folder, filename))
+
+
+class Runner:
+
+    def __init__(self, workdir, repeat):
+        self.workdir = workdir
+        self.repeat = repeat
+        self.results = []
+
+    def record(self, benchmark, case, count, seconds, **details):
+        result = {"benchmark": benchmark, "case": case, "refs": count, "seconds": round(seconds, 6)}
+        result.update(details)
+        self.results.append(result)
+        log("%-8s %-16s %8s refs: %.4fs" % (benchmark, case, count, seconds))
+
+    def skip(self, benchmark, count, reason):
+        self.results.append( {"benchmark": benchmark, "refs": count, "skipped": reason} )
+        log("%-8s skipped: %s" % (benchmark, reason))
+
+    def collection_path(self, count, extension):
+        "Path of a generated collection (created on first use)"
+        path = os.path.join(self.workdir, "collection-%s.%s" % (count, extension))
+        if not os.path.exists(path):
+            log("generating %s" % path)
+            synthetic.write_collection(path, count)
+        return path
+
+    def bibtex_path(self, count):
+        path = os.path.join(self.workdir, "refs-%s.bib" % count)
+        if not os.path.exists(path):
+            log("generating %s" % path)
+            synthetic.write_bibtex(path, count)
+        return path
+
+    def copy_collection(self, count, extension):
+        "Fresh copy of a generated collection, which can be modified"
+        source = self.collection_path(count, extension)
+        path = os.path.join(self.workdir, "copy.%s" % extension)
+        remove_collection(path)
+        shutil.copy(source, path)
+        return path
+
+
+    def bench_load(self, count):
+        for extension in STORAGES:
+            path = self.collection_path(count, extension)
+            def load():
+                RefCollection(path).storage.close()
+            self.record("load", extension, count, timed(load, self.repeat))
+
+            # lazy storages only open the file, also measure the loading of all refs
+            collection = RefCollection(path)
+            lazy = collection.storage.lazy
+            collection.storage.close()
+            if lazy:
+                def load_all():
+                    collection = RefCollection(path)
+                    collection.load_all()
+                    collection.storage.close()
+                self.record("load", extension+"-all", count, timed(load_all, self.repeat))
+
+    def bench_save(self, count):
+        for extension in STORAGES:
+            path = os.path.join(self.workdir, "save.%s" % extension)
+            def new_collection():
+                remove_collection(path)
+                collection = RefCollection(path)
+                for i in range(count):
+                    collection.add_reference(Ref(synthetic.make_meta(i)), synthetic.make_key(i))
+                return collection
+            self.record("save", extension, count, timed(lambda c: c.save(), self.repeat, new_collection, close))
+            remove_collection(path)
+
+            # save a single change in an existing collection
+            def changed_collection():
+                collection = RefCollection(self.copy_collection(count, extension))
+                collection.get(synthetic.make_key(count // 2)).add_tag("changed")
+                return collection
+            self.record("save", extension+"-one", count, timed(lambda c: c.save(), self.repeat, changed_collection, close))
+
+    def bench_find(self, count):
+        rand = random.Random(42)
+        numbers = [ rand.randrange(count) for q in range(QUERIES) ]
+        for extension in STORAGES:
+            path = self.collection_path(count, extension)
+            def find(collection):
+                for i in numbers:
+                    collection.find("doi", synthetic.make_doi(i))
+            self.record("find", extension, count, timed(find, self.repeat, lambda: RefCollection(path), close),
+                        queries=QUERIES)
+            self.record("find", extension+"-tag", count,
+                        timed(lambda c: c.get_references("lab"), self.repeat, lambda: RefCollection(path), close))
+
+    def bench_export(self, count):
+        collection = RefCollection(self.collection_path(count, "json"))
+        prefix = os.path.join(self.workdir, "export")
+
+        from plugins import bibtex as mod_bibtex
+        if mod_bibtex._HAS_DEPS:
+            def export_bibtex():
+                f = open(prefix+".bib", "w")
+                mod_bibtex.write_bibtex(f, collection.iter_references())
+                f.close()
+            self.record("export", "bibtex", count, timed(export_bibtex, self.repeat))
+        else:
+            self.skip("export", count, "bibtex export requires bibtexparser")
+
+        from plugins import export as mod_export
+        processes = min(4, os.cpu_count() or 1)
+        for case,args in ( ("csl+ris", []), ("csl+ris-j%s" % processes, ["-j", str(processes)]) ):
+            def export_all():
+                with contextlib.redirect_stdout(open(os.devnull, "w")):
+                    mod_export.export(collection, args + ["-f", "csl,ris", prefix])
+            self.record("export", case, count, timed(export_all, self.repeat))
+
+    def bench_import(self, count):
+        from plugins import bibtex as mod_bibtex
+        if not mod_bibtex._HAS_DEPS:
+            self.skip("import", count, "requires bibtexparser")
+            return
+
+        path = self.bibtex_path(count)
+        provider = mod_bibtex.BiBTeXProvider()
+        processes = min(4, os.cpu_count() or 1)
+        for case,p in ( ("bibtex", 1), ("bibtex-j%s" % processes, processes) ):
+            self.record("import", case, count, timed(lambda: list(provider.import_file(path, processes=p)), self.repeat))
+
+    def bench_lookup(self, count):
+        from plugins import pubmed as mod_pubmed
+        from plugins import bibtex as mod_bibtex
+        cases = []
+        if mod_pubmed._HAS_DEPS:
+            cases.append( ("pmid", synthetic.make_pmid) )
+        if mod_pubmed._HAS_DEPS or mod_bibtex._HAS_DEPS:
+            cases.append( ("doi", synthetic.make_doi) )
+        cases.append( ("url", lambda i: mod_mock.PAGE_URL % synthetic.make_key(i)) )
+
+        import ref as mod_ref
+        identifiers_count = min(LOOKUPS, count)
+        server = mod_mock.MockServer( mod_mock.Corpus(synthetic.make_corpus(identifiers_count)) ).start()
+        saved = (mod_web.MOCK_SERVER, mod_pubmed.REQUEST_INTERVAL, mod_pubmed.API_KEY_INTERVAL, mod_cache.responses)
+        # send the requests to the mock server, without throttling nor cache
+        mod_web.set_mock_server(server.url)
+        mod_pubmed.REQUEST_INTERVAL = mod_pubmed.API_KEY_INTERVAL = 0
+        mod_cache.responses = None
+        try:
+            for kind,make in cases:
+                identifiers = [ make(i) for i in range(identifiers_count) ]
+                matched = []
+                def sequential():
+                    del matched[:]
+                    matched.extend( ref for ref in map(mod_ref.do_lookup, identifiers) if ref )
+                self.record("lookup", kind, count, timed(sequential, self.repeat),
+                            lookups=identifiers_count, matched=len(matched))
+
+                def threaded():
+                    with ThreadPoolExecutor(max_workers=LOOKUP_JOBS) as pool:
+                        list( pool.map(mod_ref.do_lookup, identifiers) )
+                self.record("lookup", kind+"-threads", count, timed(threaded, self.repeat), lookups=identifiers_count)
+
+                async def gather():
+                    await asyncio.gather( *[ mod_ref.ado_lookup(key) for key in identifiers ] )
+                self.record("lookup", kind+"-async", count, timed(lambda: asyncio.run(gather()), self.repeat),
+                            lookups=identifiers_count)
+        finally:
+            mod_web.set_mock_server(saved[0])
+            mod_pubmed.REQUEST_INTERVAL, mod_pubmed.API_KEY_INTERVAL, mod_cache.responses = saved[1:]
+            server.stop()
+
+
+def compare(before_path, after_path):
+    "Print the ratio between the times of two runs"
+    f = open(before_path)
+    before = json.load(f)
+    f.close()
+    f = open(after_path)
+    after = json.load(f)
+    f.close()
+
+    times = dict( ((r["benchmark"], r["case"], r["refs"]), r["seconds"]) for r in before["results"] if "seconds" in r )
+    for r in after["results"]:
+        key = (r["benchmark"], r.get("case"), r["refs"])
+        if key not in times or "seconds" not in r:
+            continue
+        old, new = times[key], r["seconds"]
+        ratio = new / old if old else float("inf")
+        print("%-8s %-16s %8s refs: %10.4fs -> %10.4fs  x%.2f" % (key[0], key[1], key[2], old, new, ratio))
+
+
+def main(args):
+    sizes = DEFAULT_SIZES
+    selected = BENCHMARKS
+    repeat = 3
+    workdir = None
+    output = None
+
+    args = args[1:]
+    if args and args[0] == "--compare":
+        if len(args) != 3:
+            print(__doc__)
+            return
+        compare(args[1], args[2])
+        return
+
+    while args:
+        if len(args) < 2:
+            print(__doc__)
+            return
+        option, value = args[:2]
+        args = args[2:]
+        if option == "--sizes":
+            sizes = [ int(size) for size in value.split(",") ]
+        elif option == "--only":
+            selected = value.split(",")
+        elif option == "--repeat":
+            repeat = int(value)
+        elif option == "--workdir":
+            workdir = value
+        elif option == "--output":
+            output = value
+        else:
+            print(__doc__)
+            return
+
+    for name in selected:
+        if name not in BENCHMARKS:
+            print("Unknown benchmark: "+name)
+            return
+
+    temporary = workdir is None
+    if temporary:
+        workdir = tempfile.mkdtemp(prefix="pyb-bench-")
+    elif not os.path.isdir(workdir):
+        os.makedirs(workdir)
+
+    runner = Runner(workdir, repeat)
+    try:
+        for count in sizes:
+            for name in selected:
+                getattr(runner, "bench_"+name)(count)
+    finally:
+        if temporary:
+            shutil.rmtree(workdir)
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "sizes": list(sizes),
+        "repeat": repeat,
+        "results": runner.results,
+    }
+    if output:
+        f = open(output, "w")
+        json.dump(report, f, indent=1)
+        f.close()
+    else:
+        print( json.dumps(report, indent=1) )
+
+
+if __name__ == "__main__":
+    main( sys.argv )
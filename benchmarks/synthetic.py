@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+"""Generate synthetic collections and bibtex files for the benchmarks.
+
+Usage: synthetic.py <destination> [number of refs]
+
+The format of the destination depends on its extension: .bib files are
+bibtex files, other files are collections (see the --db option of ref.py).
+The generated data only depends on the number of refs.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from __init__ import Ref, RefCollection
+
+WORDS = ("network", "regulatory", "model", "logical", "analysis", "dynamics", "cell", "signaling",
+         "boolean", "gene", "expression", "control", "stable", "states", "attractors", "pathway",
+         "protein", "interaction", "qualitative", "reduction", "modular", "robust", "cycle", "fate")
+
+
+def make_meta(i):
+    "Metadata of a synthetic ref, with authors and journals shared between refs"
+    meta = {
+        "title": "Synthetic reference number %s." % i,
+        "authors": [ ["Lastname%s" % ((i+k) % 2000), "Given%s" % ((i+k) % 50)] for k in range(1 + i%6) ],
+        "year": str(1980 + i % 40),
+        "journal": "Journal of synthetic results %s" % (i % 300),
+        "volume": str(i % 50),
+        "pages": "%s-%s" % (i % 1000, i % 1000 + 10),
+        "links": {"doi": "10.1000/synthetic.%s" % i},
+    }
+    if i % 10 == 0:
+        meta["tags"] = ["lab"]
+    return meta
+
+def make_title(i):
+    "A title made of words, distinct for each ref"
+    words = [ WORDS[(i // len(WORDS)**k) % len(WORDS)] for k in range(4) ]
+    return "%s of %s %s %s (%s)" % (words[0].capitalize(), words[1], words[2], words[3], i)
+
+def make_key(i):
+    return "Synthetic%s" % i
+
+def make_doi(i):
+    return "10.1000/synthetic.%s" % i
+
+def make_pmid(i):
+    return str(1000000 + i)
+
+def make_corpus(count):
+    "(key, metadata) pairs of the refs served by the mock server, with distinct titles and pubmed IDs"
+    for i in range(count):
+        meta = make_meta(i)
+        meta["title"] = make_title(i)
+        meta["links"]["pmid"] = make_pmid(i)
+        yield make_key(i), meta
+
+
+def write_collection(path, count):
+    "Create a collection of synthetic refs (with their final keys)"
+    collection = RefCollection(path)
+    for i in range(count):
+        collection.add_reference(Ref(make_meta(i)), make_key(i))
+    collection.save()
+    # small JSON collections are saved in the journal: write them in the main file
+    if hasattr(collection.storage, "compact"):
+        collection.storage.compact(collection.refs)
+    collection.storage.close()
+
+def write_bibtex(path, count):
+    "Create a bibtex file with synthetic entries, and a few strings and comments"
+    f = open(path, "w")
+    f.write('@string{jsr = "Journal of synthetic results"}\n\n')
+    for i in range(count):
+        if i % 1000 == 0:
+            f.write("@comment{Block %s}\n\n" % (i // 1000))
+        f.write(bibtex_entry(i))
+        f.write("\n\n")
+    f.close()
+
+def bibtex_entry(i):
+    meta = make_meta(i)
+    authors = " and ".join( "%s, %s" % (last, given) for last,given in meta["authors"] )
+    return ("@article{%s,\n  author = {%s},\n  title = {%s},\n  journal = jsr,\n  year = {%s},\n"
+            "  volume = {%s},\n  pages = {%s},\n  doi = {%s}\n}") % (
+            make_key(i), authors, make_title(i), meta["year"], meta["volume"], meta["pages"].replace("-", "--"), make_doi(i))
+
+
+def main(args):
+    if len(args) < 2:
+        print(__doc__)
+        return
+
+    path = args[1]
+    count = 1000
+    if len(args) > 2:
+        count = int(args[2])
+
+    if os.path.exists(path):
+        print("The destination already exists")
+        return
+
+    if path.endswith(".bib"):
+        write_bibtex(path, count)
+    else:
+        write_collection(path, count)
+
+
+if __name__ == "__main__":
+    main( sys.argv )
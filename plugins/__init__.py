@@ -2,27 +2,223 @@
 
 from __future__ import print_function
 import importlib
+import json
+import time
+import ast
 import sys
 import os
 
+import stats
+
+# list of plugins which can be registered without importing them
+MANIFEST = "plugins.json"
+
+# priority of the providers which do not define one (lower priorities are called first)
+DEFAULT_PRIORITY = 50
+# attributes of the providers used to route lookups, with their default values
+ROUTING = (("identifiers", None), ("priority", DEFAULT_PRIORITY), ("stop_when_found", False))
+
+@stats.timed("plugins.load")
 def load_plugins():
+    """Register the plugins listed in the manifest without importing them,
+    and import the other modules of the folder to call their "ref_load" function.
+    """
     basedir = os.path.dirname(__file__)
     expected_entry = 'ref_load'
     module = sys.modules[__name__]
     
-    for name in os.listdir(basedir):
+    listed = load_manifest(os.path.join(basedir, MANIFEST))
+    
+    for name in sorted(os.listdir(basedir)):
         if name.endswith(".py") and not name.startswith("_"):
+            mod_name,file_ext = os.path.splitext(name)
+            if mod_name in listed:
+                continue
             try:
-                filepath = os.path.join(basedir, name)
-                mod_name,file_ext = os.path.splitext(os.path.split(filepath)[-1])
                 py_mod = importlib.import_module('.%s' % mod_name, module.__name__)
                 if hasattr(py_mod, expected_entry):
                     getattr(py_mod, expected_entry)(module)
             except:
                 print("Error loading "+mod_name)
 
+def load_manifest(path):
+    "Register the content of the plugins listed in the manifest, returns the set of listed modules"
+    if not os.path.isfile(path):
+        return set()
+    
+    f = open(path)
+    manifest = json.load(f)
+    f.close()
+    
+    listed = set()
+    for entry in manifest:
+        plugin = LazyPlugin(entry["module"])
+        listed.add(plugin.name)
+        
+        by_name = {}
+        for p in entry.get("providers", ()):
+            provider = LazyProvider(plugin, p["name"], p["class"])
+            # routing settings are read from the manifest to avoid importing the plugin
+            for attr,default in ROUTING:
+                setattr(provider, attr, p.get(attr, default))
+            by_name[provider.name] = provider
+            add_provider(provider)
+        
+        for c in entry.get("commands", ()):
+            add_command(LazyCommand(plugin, c["name"]), c.get("aliases"))
+        
+        for extension,name in entry.get("importers", {}).items():
+            add_importer(extension, by_name[name])
+    
+    return listed
+
+
+class LazyPlugin:
+    "A plugin module, which is imported on first use"
+    
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+        self.docs = None
+    
+    def load(self):
+        if self.module is None:
+            with stats.timer("plugins.import."+self.name):
+                self.module = importlib.import_module('.%s' % self.name, __name__)
+        return self.module
+    
+    def available(self):
+        "Check that the dependencies of the plugin are installed"
+        return getattr(self.load(), "_HAS_DEPS", True)
+    
+    def get_doc(self, name):
+        "Read the docstring of a function or class from the source, without importing it"
+        if self.docs is None:
+            self.docs = {}
+            f = open(os.path.join(os.path.dirname(__file__), self.name+".py"))
+            tree = ast.parse(f.read())
+            f.close()
+            for node in tree.body:
+                if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                    self.docs[node.name] = ast.get_docstring(node, clean=False)
+        return self.docs.get(name)
+
+class LazyProvider:
+    "Stand-in for a provider, the plugin is imported when the provider is used"
+    
+    def __init__(self, plugin, name, classname):
+        self.plugin = plugin
+        self.name = name
+        self.classname = classname
+        self.provider = None
+    
+    @property
+    def __doc__(self):
+        return self.plugin.get_doc(self.classname)
+    
+    def instance(self):
+        if self.provider is None and self.plugin.available():
+            self.provider = getattr(self.plugin.load(), self.classname)()
+            self.check_routing()
+        return self.provider
+    
+    def check_routing(self):
+        "Warn when the routing settings of the manifest differ from the attributes of the provider class"
+        for attr,default in ROUTING:
+            expected = getattr(self.provider, attr, default)
+            value = getattr(self, attr)
+            if attr == "identifiers" and expected is not None:
+                expected = sorted(expected)
+                value = sorted(value or ())
+            if value != expected:
+                print("Provider %s: %s differs between %s and %s.%s" % (self.name, attr, MANIFEST, self.plugin.name, self.classname))
+    
+    def load_ref(self, key):
+        provider = self.instance()
+        if provider:
+            return provider.load_ref(key)
+    
+    def __getattr__(self, attr):
+        # only called for attributes which are not defined here
+        provider = self.instance()
+        if provider is None:
+            raise AttributeError(attr)
+        return getattr(provider, attr)
+
+class LazyCommand:
+    "Stand-in for a command, the plugin is imported when the command is called"
+    
+    def __init__(self, plugin, name):
+        self.plugin = plugin
+        self.__name__ = name
+    
+    @property
+    def __doc__(self):
+        return self.plugin.get_doc(self.__name__)
+    
+    def __call__(self, collection, args):
+        if not self.plugin.available():
+            print("Missing dependencies for "+self.__name__)
+            return
+        return getattr(self.plugin.load(), self.__name__)(collection, args)
+
 def add_provider(provider):
     providers.append(provider)
+    tiers.clear()
+
+def load_ref(provider, key):
+    """Call a provider, and update its timer ("provider.<name>")
+    and its counters of calls, matches and errors."""
+    name = "provider."+provider.name
+    stats.count(name+".calls")
+    start = time.perf_counter()
+    try:
+        ref = provider.load_ref(key)
+    except Exception:
+        stats.count(name+".errors")
+        raise
+    finally:
+        stats.add_time(name, time.perf_counter() - start)
+    if ref:
+        stats.count(name+".matches")
+    return ref
+
+async def aload_ref(provider, key):
+    """Call a provider from an event loop, with the same statistics as load_ref.
+    Providers with an asynchronous "aload_ref" method are awaited directly,
+    the "load_ref" method of the other providers is called in a thread."""
+    import asyncio
+    if not hasattr(provider, "aload_ref"):
+        return await asyncio.get_running_loop().run_in_executor(None, load_ref, provider, key)
+    
+    name = "provider."+provider.name
+    stats.count(name+".calls")
+    start = time.perf_counter()
+    try:
+        ref = await provider.aload_ref(key)
+    except Exception:
+        stats.count(name+".errors")
+        raise
+    finally:
+        stats.add_time(name, time.perf_counter() - start)
+    if ref:
+        stats.count(name+".matches")
+    return ref
+
+def provider_tiers(kind):
+    """Group the providers which accept a kind of identifier by priority.
+    Providers without an "identifiers" attribute accept all kinds of identifiers.
+    Returns a list of tiers (lists of providers), by increasing priority."""
+    if kind not in tiers:
+        by_priority = {}
+        for p in providers:
+            identifiers = getattr(p, "identifiers", None)
+            if identifiers is not None and kind not in identifiers:
+                continue
+            priority = getattr(p, "priority", DEFAULT_PRIORITY)
+            by_priority.setdefault(priority, []).append(p)
+        tiers[kind] = [ by_priority[priority] for priority in sorted(by_priority) ]
+    return tiers[kind]
 
 def command_aliases(cmd_aliases):
     def decorator(f):
@@ -57,6 +253,8 @@ def get_command_aliases(name):
 
 # list of providers, to be loaded from plugins
 providers = []
+# providers for each kind of identifier, grouped by priority
+tiers = {}
 importers = {}
 commands = {}
 aliases = {}
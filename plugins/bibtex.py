@@ -3,12 +3,19 @@
 import sys
 import json
 from . import doi as mod_doi
+from . import cache as mod_cache
+from . import ident as mod_ident
+from . import webclient as mod_web
 import re
 import os
-from urllib.request import urlopen,Request
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
 try:
     from bibtexparser.bparser import BibTexParser
+    from bibtexparser.bibdatabase import BibDatabase
     from bibtexparser.latexenc import string_to_latex
     from bibtexparser.customization import *
     _HAS_DEPS = True
@@ -32,6 +39,16 @@ meta2bibtex = (
     ("pages","pages"),
 )
 
+DOI_URL = "https://doi.org/%s"
+CROSSREF_URL = "https://api.crossref.org/works/%s/transform/application/x-bibtex"
+
+# number of strings written at once by the exporter
+EXPORT_CHUNK_SIZE = 2000
+# number of entries parsed at once (in a single call of the parser) by imports
+RUN_SIZE = 100
+# number of entries sent at once to a worker process in parallel imports
+CHUNK_SIZE = 500
+
 bibtex2meta = (
     ("year","year"),
     ("volume","volume"),
@@ -41,6 +58,9 @@ bibtex2meta = (
 
 class BiBTeXProvider:
     "Find metadata in the DOI system"
+    identifiers = (mod_ident.DOI, mod_ident.BIBFILE)
+    priority = 20
+    stop_when_found = True
     
     def __init__(self):
         self.name = "doi"
@@ -59,18 +79,61 @@ class BiBTeXProvider:
             print("not a DOI??")
             return
         
+        # DOIs are case insensitive
+        return mod_cache.cached(self.name, doi.lower(), lambda: self.fetch_doi(doi))
+    
+    def fetch_doi(self, doi):
+        """Get the bibtex of a DOI, None if it is unknown.
+        Raises the last error if neither the DOI system nor crossref answered (the answer is then not cached)."""
+        error = None
         try:
-            req = Request("http://dx.doi.org/%s"%doi, headers = {'Accept' : 'application/x-bibtex'})
-            bibtex = urlopen(req).read()
-        except: bibtex = None
+            bibtex = mod_web.get(DOI_URL % doi, headers = {'Accept' : 'application/x-bibtex'})
+        except Exception as e:
+            bibtex = None
+            error = e
         
         # add fallback request to crossref API
         if bibtex is None:
             try:
-                req = Request("http://api.crossref.org/works/%s/transform/application/x-bibtex" % doi)
-                bibtex = urlopen(req).read()
-            except: bibtex = None
+                bibtex = mod_web.get(CROSSREF_URL % doi)
+            except Exception as e:
+                if not mod_web.not_found(e) or error is None:
+                    error = e
+        
+        if bibtex is None and error is not None and not mod_web.not_found(error):
+            raise error
+        return self.ref_from_doi_bibtex(doi, bibtex)
+    
+    async def aload_ref(self, key):
+        "Asynchronous variant of load_ref, only DOIs are retrieved asynchronously"
+        if key.endswith(".bib"):
+            return self.load_bibtex(key)
+        
+        doi = mod_doi.get_doi(key)
+        if not doi:
+            return None
+        return await mod_cache.acached(self.name, doi.lower(), lambda: self.afetch_doi(doi))
+    
+    async def afetch_doi(self, doi):
+        error = None
+        try:
+            bibtex = await mod_web.aget(DOI_URL % doi, headers = {'Accept' : 'application/x-bibtex'})
+        except Exception as e:
+            bibtex = None
+            error = e
         
+        if bibtex is None:
+            try:
+                bibtex = await mod_web.aget(CROSSREF_URL % doi)
+            except Exception as e:
+                if not mod_web.not_found(e) or error is None:
+                    error = e
+        
+        if bibtex is None and error is not None and not mod_web.not_found(error):
+            raise error
+        return self.ref_from_doi_bibtex(doi, bibtex)
+    
+    def ref_from_doi_bibtex(self, doi, bibtex):
         if bibtex is None:
             return None
         
@@ -88,15 +151,13 @@ class BiBTeXProvider:
     def load_bibtex(self, key):
         "Create a ref from a bibtex file"
         f = open(key)
-        result = parse_bibtex(f.read())
+        result = self.parse_bibtex(f.read())
         f.close()
         return result
 
     def parse_bibtex_stream(self, bibtex):
         "Parse a bibtex entry (shared code between the load_bibtex and load_doi functions)"
-        bp = BibTexParser(bibtex, customization=customize_bibtex)
-        entries = bp.get_entry_list()
-        return entries
+        return parse_text(bibtex)
         
     def parse_bibtex(self, bibtex):
         for b in self.parse_bibtex_stream(bibtex):
@@ -125,20 +186,188 @@ class BiBTeXProvider:
             
         return ref
     
-    def import_file(self, path):
-        print("Starting bibtex import...")
-        f = open(path)
-        bibtex = f.read()
-        f.close()
-        bib_refs = self.parse_bibtex_stream(bibtex)
-        if not bib_refs:
-            print("No parsed refs!")
-            return []
-        
-        print("Converting parsed bibtex...")
-        result = [ self.ref_from_bibtex(b) for b in bib_refs ]
-        print("Done")
-        return result
+    def import_file(self, path, processes=1):
+        """Parse a bibtex file by runs of entries.
+        This is a generator: refs are produced a run at a time, and the file is never loaded as a whole.
+        With several processes, large chunks of entries are parsed in parallel and the refs
+        are still produced in the order of the file.
+        """
+        # more processes than processors only add overhead
+        processes = min(processes, os.cpu_count() or 1)
+        if processes > 1:
+            for ref in self.import_parallel(path, processes):
+                yield ref
+            return
+        
+        for text in iter_chunks(path, RUN_SIZE):
+            for ref in self.refs_from_entries(parse_chunk(text)):
+                yield ref
+    
+    def import_parallel(self, path, processes):
+        pool = ProcessPoolExecutor(max_workers=processes)
+        pending = deque()
+        for text in iter_chunks(path, CHUNK_SIZE):
+            pending.append( pool.submit(parse_entries, text) )
+            # keep a bounded number of chunks in memory
+            if len(pending) >= 2*processes:
+                for ref in pending.popleft().result():
+                    yield ref
+        
+        while pending:
+            for ref in pending.popleft().result():
+                yield ref
+        pool.shutdown()
+    
+    def refs_from_entries(self, entries):
+        "Convert parsed entries to refs, skipping the entries without the expected fields"
+        refs = []
+        for b in entries:
+            try:
+                refs.append( self.ref_from_bibtex(b) )
+            except Exception:
+                print("Could not convert entry: %s" % b.get("ID"))
+        return refs
+
+
+def parse_entries(text):
+    "Parse a chunk of a bibtex file (in a worker process)"
+    return BiBTeXProvider().refs_from_entries( parse_chunk(text) )
+
+_local = threading.local()
+
+def get_parser():
+    """Parser of the current thread (or process), with an empty database.
+    Creating a parser builds its whole grammar: it is only done once per thread."""
+    parser = getattr(_local, "parser", None)
+    if parser is None:
+        parser = BibTexParser(customization=customize_bibtex)
+        parser.expect_multiple_parse = True
+        _local.parser = parser
+    parser.bib_database = BibDatabase()
+    parser.bib_database.load_common_strings()
+    return parser
+
+def parse_text(bibtex):
+    "Parse a bibtex text, returns the list of its entries (as dicts)"
+    return get_parser().parse(bibtex).entries
+
+def parse_chunk(text):
+    """Parse a text made of string definitions and entries, returns the list of entries (as dicts).
+    If the text can not be parsed at once, its entries are parsed one by one to skip the broken ones."""
+    try:
+        return parse_text(text)
+    except Exception:
+        pass
+    
+    strings = []
+    entries = []
+    for entry in split_bibtex(text.splitlines(True)):
+        if entry_type(entry) == "string":
+            strings.append(entry)
+            continue
+        try:
+            entries.extend( parse_text("\n".join(strings + [entry])) )
+        except Exception:
+            print("Could not parse entry: %s" % entry[:60])
+    return entries
+
+def iter_chunks(path, size):
+    """Group the entries of a bibtex file into texts of at most "size" entries.
+    The definitions of strings seen so far are added once in front of each text,
+    comments and preambles are skipped.
+    """
+    strings = []
+    chunk = []
+    f = open(path)
+    for entry in split_bibtex(f):
+        kind = entry_type(entry)
+        if kind in ("comment", "preamble"):
+            continue
+        if kind == "string":
+            # the entries before a definition must not see it
+            if chunk:
+                yield "\n".join(strings + chunk)
+                chunk = []
+            strings.append(entry)
+            continue
+        
+        chunk.append(entry)
+        if len(chunk) >= size:
+            yield "\n".join(strings + chunk)
+            chunk = []
+    f.close()
+    if chunk:
+        yield "\n".join(strings + chunk)
+
+
+ENTRY_START = re.compile(r"@\s*([a-zA-Z]+)\s*[{(]")
+CLOSING = {"{": "}", "(": ")"}
+
+def entry_type(entry):
+    "Get the (lowercase) type of a bibtex entry"
+    m = ENTRY_START.match(entry)
+    if m:
+        return m.group(1).lower()
+    return ""
+
+def split_bibtex(lines):
+    """Split a bibtex stream (an iterable of lines) into its entries.
+    An entry starts with '@type{' (or '@type(') and ends with the matching closing delimiter,
+    braces within quoted values are ignored and the text between entries is skipped.
+    An entry which is still open when the next one starts at the beginning of a line
+    is unbalanced: it is produced as is, for the parser to report it.
+    """
+    chunks = []
+    in_entry = False
+    for line in lines:
+        start = 0
+        pos = 0
+        if in_entry and ENTRY_START.match(line.lstrip()):
+            print("Unbalanced bibtex entry: %s" % "".join(chunks)[:60])
+            yield "".join(chunks)
+            chunks = []
+            in_entry = False
+        while pos < len(line):
+            if not in_entry:
+                m = ENTRY_START.search(line, pos)
+                if not m:
+                    break
+                start = m.start()
+                pos = m.end()
+                closing = CLOSING[line[pos-1]]
+                in_entry = True
+                # depth of braces inside the entry, and quoted value (at depth 0)
+                depth = 0
+                quoted = False
+                continue
+            
+            c = line[pos]
+            if c == "\\":
+                # escaped character, like {\"o}
+                pos += 1
+            elif quoted:
+                if c == '"':
+                    quoted = False
+            elif c == "{":
+                depth += 1
+            elif c == "}" and depth > 0:
+                depth -= 1
+            elif depth == 0:
+                if c == '"':
+                    quoted = True
+                elif c == closing:
+                    chunks.append(line[start:pos+1])
+                    yield "".join(chunks)
+                    chunks = []
+                    in_entry = False
+            pos += 1
+        
+        if in_entry:
+            chunks.append(line[start:])
+    
+    if in_entry:
+        print("Unterminated bibtex entry: %s" % "".join(chunks)[:60])
+        yield "".join(chunks)
 
 
 delkeys = ("abstract", "keywords")
@@ -161,50 +390,69 @@ def customize_bibtex(record):
 def bibtex(collection, args):
     """Save the list of stored references in the bibtex format
 This will create/overwrite the 'exported_references.bib' file.
-Provide another filename as argument to change the destination"""
+Provide another filename as argument to change the destination,
+and a tag as second argument to export only the references with this tag.
+
+Usage: bibtex [filename] [tag]"""
     
-    if len(args) > 1:
+    if len(args) > 2:
         print("Too many arguments")
         return
-    if len(args) == 1:
+    filename = "exported_references.bib"
+    tag = None
+    if len(args) > 0:
         filename = args[0]
-    else:
-        filename = "exported_references.bib"
+    if len(args) > 1:
+        tag = args[1]
     
     f = open(filename, "w")
-    for key in sorted(collection.get_references().keys()):
-        ref = collection.get(key)
-        f.write("%s\n\n" % to_bibtex(key,ref.get_meta()))
+    count = write_bibtex(f, collection.iter_references(tag))
     f.close()
+    print("%s references exported" % count)
+
+def write_bibtex(f, refs):
+    "Write a stream of (key,ref) pairs in the bibtex format, by large chunks. Returns the number of refs"
+    count = 0
+    chunk = []
+    for key,ref in refs:
+        chunk.append(to_bibtex(key, ref.get_meta()))
+        chunk.append("\n\n")
+        count += 1
+        if len(chunk) >= EXPORT_CHUNK_SIZE:
+            f.write("".join(chunk))
+            chunk = []
+    f.write("".join(chunk))
+    return count
 
 
 def to_bibtex(key, ref, links=False):
     # TODO: support other refs than article
     
-    fields = []
-    bib_authors = []
-    for last,given in ref["authors"]:
-        if given:
-            bib_authors.append( "{%s}, {%s}" % (last,'%s.'%given[0]) )
-        else:
-            bib_authors.append( "{%s}" % last )
-    fields.append( ("author", " and ".join( bib_authors ) ) )
+    bib_authors = [ latex_author(last, given) for last,given in ref["authors"] ]
+    parts = [ "@article{%s,\n  author = {%s}" % (key, " and ".join(bib_authors)) ]
     
     # export many keys as is
     for meta_key, bibtex_key in meta2bibtex:
         if meta_key in ref:
-            fields.append( (bibtex_key, "%s" % ref[meta_key]) )
+            parts.append( ",\n  %s = {%s}" % (bibtex_key, latex("%s" % ref[meta_key])) )
     
     if links and "links" in ref:
-        for k,v in ref["links"].iteritems():
-            fields.append( (k,v) )
-    
-    # build the bibtex snippet
-    ret = "@article{%s" % key
-    for k,v in fields:
-        ret += ",\n  %s = {%s}" % (k,string_to_latex(v))
-    ret += "\n}\n"
-    return ret
+        for k,v in ref["links"].items():
+            parts.append( ",\n  %s = {%s}" % (k, latex(v)) )
+    
+    parts.append("\n}\n")
+    return "".join(parts)
+
+# journals, years and authors are repeated in many refs: cache their conversion
+@functools.lru_cache(maxsize=100000)
+def latex(value):
+    return string_to_latex(value)
+
+@functools.lru_cache(maxsize=100000)
+def latex_author(last, given):
+    if given:
+        return string_to_latex( "{%s}, {%s}" % (last,'%s.'%given[0]) )
+    return string_to_latex( "{%s}" % last )
 
 
 
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import json
+import time
+import threading
+
+# Default settings, they can be changed using environment variables
+CACHE_PATH = os.environ.get("REF_CACHE", "ref_cache.sqlite")
+CACHE_TTL = float(os.environ.get("REF_CACHE_TTL", 30*24*3600))
+# lifetime of the "not found" answers, shorter as the identifier may be indexed later
+CACHE_MISS_TTL = float(os.environ.get("REF_CACHE_MISS_TTL", 7*24*3600))
+CACHE_SIZE = int(os.environ.get("REF_CACHE_SIZE", 100000))
+
+# In offline mode, providers only use cached answers (even expired ones)
+offline = os.environ.get("REF_OFFLINE", "") not in ("", "0")
+
+# number of insertions between two checks of the cache size
+EVICTION_PERIOD = 100
+
+# returned by get_cached when the cache has no answer (None is a cached "not found" answer)
+ABSENT = object()
+# stored value of the "not found" answers
+MISS = "null"
+
+
+class ResponseCache:
+    """Persistent cache for the answers of metadata providers.
+    Answers are stored in a SQLite database, indexed by provider name and normalized identifier.
+    "Not found" answers are stored as None. Entries expire after "ttl" seconds ("miss_ttl" for
+    "not found" answers, never if it is 0), and the oldest entries are removed when the cache
+    holds more than "max_entries" answers.
+    """
+
+    def __init__(self, path=CACHE_PATH, ttl=CACHE_TTL, max_entries=CACHE_SIZE, miss_ttl=CACHE_MISS_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = None
+        self.insertions = 0
+        # provider name -> number of lookups answered (or not) by the cache
+        self.hits = {}
+        self.misses = {}
+
+    def connect(self):
+        if self.db is None:
+            import sqlite3
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses (provider TEXT, key TEXT, value TEXT, stamp REAL, PRIMARY KEY(provider,key))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_stamp ON responses(stamp)")
+            self.db.commit()
+        return self.db
+
+    def get(self, provider, key, stale=False):
+        """Retrieve a cached answer (None for a "not found" answer),
+        ABSENT if missing or expired (unless stale entries are accepted)"""
+        with self.lock:
+            row = self.connect().execute("SELECT value,stamp FROM responses WHERE provider=? AND key=?", (provider,key)).fetchone()
+            if row:
+                ttl = self.miss_ttl if row[0] == MISS else self.ttl
+                if not (stale or not ttl or time.time() - row[1] <= ttl):
+                    row = None
+            if row:
+                self.hits[provider] = self.hits.get(provider, 0) + 1
+            else:
+                self.misses[provider] = self.misses.get(provider, 0) + 1
+
+        if not row:
+            return ABSENT
+        return json.loads(row[0])
+
+    def put(self, provider, key, value):
+        """Store an answer, empty answers are stored as "not found" answers"""
+        with self.lock:
+            db = self.connect()
+            db.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?,?)",
+                       (provider, key, json.dumps(value) if value else MISS, time.time()))
+            self.insertions += 1
+            if self.insertions % EVICTION_PERIOD == 0:
+                self.evict(db)
+            db.commit()
+
+    def evict(self, db):
+        "Remove the oldest entries if the cache is too large"
+        count = db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        if count > self.max_entries:
+            db.execute("DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses ORDER BY stamp LIMIT ?)", (count - self.max_entries,))
+
+    def purge(self):
+        "Remove expired entries"
+        with self.lock:
+            db = self.connect()
+            if self.ttl:
+                db.execute("DELETE FROM responses WHERE stamp < ? AND value != ?", (time.time() - self.ttl, MISS))
+            if self.miss_ttl:
+                db.execute("DELETE FROM responses WHERE stamp < ? AND value = ?", (time.time() - self.miss_ttl, MISS))
+            self.evict(db)
+            db.commit()
+
+    def clear(self):
+        with self.lock:
+            db = self.connect()
+            db.execute("DELETE FROM responses")
+            db.commit()
+
+    def counters(self):
+        "Hits and misses of each provider since the start, as a flat dict"
+        with self.lock:
+            counters = dict( ("cache.%s.hits" % provider, n) for provider,n in self.hits.items() )
+            counters.update( ("cache.%s.misses" % provider, n) for provider,n in self.misses.items() )
+        return counters
+
+    def stats(self):
+        """Number of cached answers and of "not found" answers for each provider"""
+        with self.lock:
+            rows = self.connect().execute("SELECT provider,COUNT(*),SUM(value = ?) FROM responses GROUP BY provider", (MISS,)).fetchall()
+        return dict( (provider, (count, misses)) for provider,count,misses in rows )
+
+
+# shared cache used by all providers (disabled if the path is empty)
+responses = None
+if CACHE_PATH:
+    responses = ResponseCache()
+
+
+def set_offline(value=True):
+    global offline
+    offline = value
+
+def cached(provider, key, loader):
+    """Return the cached answer of a provider for a normalized identifier.
+    On a cache miss, the loader function is called (unless in offline mode)
+    and its result is cached, even if it is empty ("not found").
+    The loader should raise an exception when the answer is unknown (network errors...),
+    to avoid caching it.
+    """
+
+    value = get_cached(provider, key)
+    if value is ABSENT and not offline:
+        value = loader()
+        store(provider, key, value)
+    if value is ABSENT:
+        return None
+    return value
+
+async def acached(provider, key, loader):
+    """Asynchronous variant of cached, the loader is a coroutine function.
+    The cache is read and written in threads, to keep the event loop running."""
+    
+    import asyncio
+    loop = asyncio.get_running_loop()
+    value = await loop.run_in_executor(None, get_cached, provider, key)
+    if value is ABSENT and not offline:
+        value = await loader()
+        if responses is not None:
+            await loop.run_in_executor(None, store, provider, key, value)
+    if value is ABSENT:
+        return None
+    return value
+
+def get_cached(provider, key):
+    """Return a cached answer (even an expired one in offline mode): None if the identifier
+    was not found by the provider, ABSENT if the answer is not in the cache"""
+    if responses is None:
+        return ABSENT
+    return responses.get(provider, key, stale=offline)
+
+def store(provider, key, value):
+    """Add an answer to the cache (empty answers are cached as "not found")"""
+    if responses is not None:
+        responses.put(provider, key, value)
+
+
+def ref_load(plugins):
+    plugins.add_command(cache)
+
+def cache(collection, args):
+    """Manage the cache of provider answers.
+Usage: cache [stats|purge|clear]
+  stats: show the number of cached answers (default)
+  purge: remove expired answers
+  clear: remove all cached answers"""
+
+    if responses is None:
+        print("The cache is disabled")
+        return
+
+    action = "stats"
+    if args:
+        action = args[0]
+
+    if action == "clear":
+        responses.clear()
+    elif action == "purge":
+        responses.purge()
+    elif action != "stats":
+        print("Unknown action: "+action)
+        return
+
+    for provider,(count,misses) in sorted(responses.stats().items()):
+        print("%s: %s (%s not found)" % (provider, count, misses))
+
+
+def main(args):
+    "Simple CLI to show the content of the cache"
+
+    cache(None, args[1:])
+
+
+if __name__ == "__main__":
+    main( sys.argv )
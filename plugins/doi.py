@@ -3,7 +3,7 @@
 import sys
 import re
 
-DOI_PATTERN = re.compile("(^|\s|doi:|http[s]?://(dx[.])?doi[.]org/)(10[.][0-9]{2}[0-9]+/[^\s'\"&<>]*)($|\s)")
+DOI_PATTERN = re.compile(r"(^|\s|doi:|http[s]?://(dx[.])?doi[.]org/)(10[.][0-9]{2}[0-9]+/[^\s'\"&<>]*)($|\s)")
 
 def get_doi(string):
     """try to extract a DOI from a string.
@@ -16,11 +16,6 @@ def get_doi(string):
     if m:
         return m.groups()[2]
 
-def ref_load(plugins):
-    # empty function to avoid the "no entry point" message
-    pass
-
-
 
 def main(args):
     "Simple CLI to test if the argument contains a valid DOI"
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import sys
+import re
+import json
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+# Export the collection in several formats in a single pass over the refs
+
+def ref_load(plugins):
+    plugins.add_command(export)
+
+# number of refs rendered together (by a worker process in parallel exports)
+SHARD_SIZE = 2000
+# characters of a tag which are replaced in the name of its files (path separators...)
+UNSAFE_TAG = re.compile(r"[^\w.-]+")
+EXPORT_USAGE = "Usage: export [-j <processes>] [-f <format1,format2>] [--tags] <prefix> [tag]"
+
+
+def render_bibtex(key, meta):
+    from .bibtex import to_bibtex
+    return to_bibtex(key, meta)
+
+def render_csl(key, meta):
+    "Render a ref as a CSL-JSON item"
+    item = {"id": key, "type": "article-journal"}
+    if "title" in meta:
+        item["title"] = meta["title"]
+    if "authors" in meta:
+        item["author"] = [ {"family": last, "given": given} for last,given in meta["authors"] ]
+    if "journal" in meta:
+        item["container-title"] = meta["journal"]
+    if "year" in meta:
+        year = "%s" % meta["year"]
+        if year.isdigit():
+            item["issued"] = {"date-parts": [[int(year)]]}
+        else:
+            item["issued"] = {"literal": year}
+    for meta_key, csl_key in meta2csl:
+        if meta_key in meta:
+            item[csl_key] = "%s" % meta[meta_key]
+    for link, csl_key in links2csl:
+        if link in meta.get("links", ()):
+            item[csl_key] = meta["links"][link]
+    return json.dumps(item, ensure_ascii=False)
+
+def render_ris(key, meta):
+    "Render a ref as a RIS record"
+    lines = ["TY  - JOUR", "ID  - %s" % key]
+    for last,given in meta.get("authors", ()):
+        if given:
+            lines.append("AU  - %s, %s" % (last, given))
+        else:
+            lines.append("AU  - %s" % last)
+    for meta_key, ris_key in meta2ris:
+        if meta_key in meta:
+            lines.append("%s  - %s" % (ris_key, meta[meta_key]))
+    if "pages" in meta:
+        pages = ("%s" % meta["pages"]).split("-", 1)
+        lines.append("SP  - %s" % pages[0])
+        if len(pages) > 1:
+            lines.append("EP  - %s" % pages[1])
+    for link, ris_key in links2ris:
+        if link in meta.get("links", ()):
+            lines.append("%s  - %s" % (ris_key, meta["links"][link]))
+    lines.append("ER  - \n")
+    return "\n".join(lines)
+
+meta2csl = (
+    ("volume","volume"),
+    ("issue","issue"),
+    ("pages","page"),
+)
+links2csl = (
+    ("doi","DOI"),
+    ("pmid","PMID"),
+    ("url","URL"),
+)
+meta2ris = (
+    ("title","TI"),
+    ("journal","JO"),
+    ("year","PY"),
+    ("volume","VL"),
+    ("issue","IS"),
+)
+links2ris = (
+    ("doi","DO"),
+    ("url","UR"),
+)
+
+# name: (extension, header, separator, footer, renderer)
+FORMATS = {
+    "bibtex": ("bib", "", "\n\n", "\n\n", render_bibtex),
+    "csl": ("json", "[\n", ",\n", "\n]\n", render_csl),
+    "ris": ("ris", "", "\n", "\n", render_ris),
+}
+
+def available_formats():
+    "Names of the formats which can be used (the bibtex format requires bibtexparser)"
+    from . import bibtex as mod_bibtex
+    return [ name for name in sorted(FORMATS) if name != "bibtex" or mod_bibtex._HAS_DEPS ]
+
+
+def tag_label(tag):
+    "Name of the files of a tag, tags which only differ by unsafe characters share their files"
+    return UNSAFE_TAG.sub("_", tag)
+
+def render_shard(items, formats, per_tag):
+    """Render a group of (key, meta) pairs in several formats.
+    Returns a dict associating (format, label) pairs (the label of a tag, see tag_label,
+    or None for the complete export) to the rendered text and the number of refs in it.
+    """
+    rendered = {}
+    for key,meta in items:
+        targets = [None]
+        if per_tag:
+            # a ref is written once in a file shared by several of its tags
+            targets.extend( sorted(set( tag_label(t) for t in meta.get("tags", ()) )) )
+        for name in formats:
+            text = FORMATS[name][4](key, meta)
+            for tag in targets:
+                if (name,tag) not in rendered:
+                    rendered[(name,tag)] = []
+                rendered[(name,tag)].append(text)
+
+    result = {}
+    for (name,tag),texts in rendered.items():
+        result[(name,tag)] = (FORMATS[name][2].join(texts), len(texts))
+    return result
+
+
+class Output:
+    "A file receiving the export of a format, for all refs or for a tag"
+
+    def __init__(self, path, name):
+        self.path = path
+        extension, self.header, self.separator, self.footer, render = FORMATS[name]
+        self.file = open(path, "w")
+        self.file.write(self.header)
+        self.count = 0
+
+    def write(self, text, count):
+        if not count:
+            return
+        if self.count:
+            self.file.write(self.separator)
+        self.file.write(text)
+        self.count += count
+
+    def close(self):
+        self.file.write(self.footer)
+        self.file.close()
+
+
+def export(collection, args):
+    """Export the stored references in several formats at once (bibtex, csl and ris by default).
+Usage: export [-j <processes>] [-f <format1,format2>] [--tags] <prefix> [tag]
+
+Creates one file per format: <prefix>.bib, <prefix>.json (CSL-JSON) and <prefix>.ris.
+With --tags, it also creates files for each tag (<prefix>-<tag>.bib, ...).
+The characters of tags which are not letters, digits, dots or dashes are replaced
+by "_" in the file names: tags which only differ by these characters share their files.
+If a tag is given, only the references with this tag are exported.
+With -j, large collections are rendered in several processes."""
+
+    processes = 1
+    formats = available_formats()
+    per_tag = False
+    while args and args[0].startswith("-"):
+        option = args[0]
+        if option == "--tags":
+            per_tag = True
+            args = args[1:]
+        elif option == "-j" and len(args) > 1:
+            if not args[1].isdigit() or int(args[1]) < 1:
+                print(EXPORT_USAGE)
+                return
+            processes = int(args[1])
+            args = args[2:]
+        elif option == "-f" and len(args) > 1:
+            formats = args[1].split(",")
+            args = args[2:]
+        else:
+            print("Unknown option: "+option)
+            return
+
+    if len(args) not in (1,2):
+        print(EXPORT_USAGE)
+        return
+    for name in formats:
+        if name not in available_formats():
+            print("Unavailable format: "+name)
+            return
+
+    prefix = args[0]
+    tag = None
+    if len(args) > 1:
+        tag = args[1]
+
+    outputs = {}
+    def write(result):
+        for (name,label),(text,count) in result.items():
+            if (name,label) not in outputs:
+                extension = FORMATS[name][0]
+                if label is None:
+                    path = "%s.%s" % (prefix, extension)
+                else:
+                    path = "%s-%s.%s" % (prefix, label, extension)
+                outputs[(name,label)] = Output(path, name)
+            outputs[(name,label)].write(text, count)
+
+    # the files of the complete export exist even if they are empty
+    for name in formats:
+        write({ (name,None): ("", 0) })
+
+    pool = None
+    pending = deque()
+    if processes > 1:
+        pool = ProcessPoolExecutor(max_workers=processes)
+
+    for shard in shards(collection.iter_references(tag), SHARD_SIZE):
+        if pool is None:
+            write( render_shard(shard, formats, per_tag) )
+            continue
+        pending.append( pool.submit(render_shard, shard, formats, per_tag) )
+        # keep a bounded number of shards in memory, results are written in order
+        if len(pending) >= 2*processes:
+            write( pending.popleft().result() )
+    while pending:
+        write( pending.popleft().result() )
+    if pool is not None:
+        pool.shutdown()
+
+    for name,label in sorted(outputs, key=lambda o: (o[0], o[1] or "")):
+        output = outputs[(name,label)]
+        output.close()
+        print("%s: %s references" % (output.path, output.count))
+
+def shards(refs, size):
+    "Group a stream of (key, ref) pairs into lists of (key, metadata) pairs"
+    shard = []
+    for key,ref in refs:
+        shard.append( (key, ref.get_meta()) )
+        if len(shard) >= size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+def main(args):
+    "Simple CLI to show a ref (given as JSON) in all export formats"
+
+    if len(args) != 2:
+        print( "Usage: %s <JSON file>" % args[0] )
+        return
+
+    f = open(args[1])
+    meta = json.load(f)
+    f.close()
+    for name in available_formats():
+        print(FORMATS[name][4]("ref", meta))
+
+
+if __name__ == "__main__":
+    main( sys.argv )
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import sys
+import re
+import functools
+from . import doi as mod_doi
+
+# kinds of identifiers which can be given to a lookup
+PMID = "pmid"
+DOI = "doi"
+BIBFILE = "bibfile"
+URL = "url"
+UNKNOWN = "unknown"
+
+PMID_PATTERN = re.compile(r"^(?:(?:pmid|pubmed):)?(\d+)$")
+PMID_URL_PATTERN = re.compile(r"^http[s]?://(?:www[.]ncbi[.]nlm[.]nih[.]gov/pubmed|pubmed[.]ncbi[.]nlm[.]nih[.]gov)/(\d+)/?([?].*)?$")
+URL_PATTERN = re.compile(r"^(http[s]?://[\w.]*[.][\w]{2,6}(/.*)?)$")
+
+
+@functools.lru_cache(maxsize=10000)
+def classify(key):
+    """Detect the kind of an identifier.
+    Returns a (kind, value) pair, where the value is the pure identifier (for example the DOI
+    extracted from a doi.org URL). Pubmed and DOI URLs are recognized before other URLs.
+    """
+
+    m = PMID_PATTERN.match(key)
+    if m:
+        return PMID, m.group(1)
+
+    m = PMID_URL_PATTERN.match(key)
+    if m:
+        return PMID, m.group(1)
+
+    doi = mod_doi.get_doi(key)
+    if doi:
+        return DOI, doi
+
+    if key.endswith(".bib"):
+        return BIBFILE, key
+
+    m = URL_PATTERN.match(key)
+    if m:
+        return URL, m.group(1)
+
+    return UNKNOWN, key
+
+
+def main(args):
+    "Simple CLI to show the kind of an identifier"
+
+    if len(args) != 2:
+        print( "Usage: %s <ID>" % args[0] )
+        return
+
+    print( "%s: %s" % classify(args[1]) )
+
+
+if __name__ == "__main__":
+    main( sys.argv )
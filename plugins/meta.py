@@ -1,64 +1,99 @@
 #!/usr/bin/env python3
 
-import sys
 import re
-from urllib.request import urlopen
+import sys
+import codecs
+import html.parser
+from . import cache as mod_cache
+from . import ident as mod_ident
+from . import webclient as mod_web
 
-try:
-    import bs4 as BeautifulSoup
-    _HAS_DEPS = True
-    
-    def ref_load(plugins):
-        plugins.add_provider( HTMLMetaProvider() )
-except:
-    print("Missing deps for the HTML-meta parser")
-    _HAS_DEPS = False
+
+def ref_load(plugins):
+    plugins.add_provider( HTMLMetaProvider() )
+
+# number of bytes at the start of a document where its charset is looked for
+CHARSET_SCAN = 1024
+CHARSET_PATTERN = re.compile(br'''charset\s*=\s*["']?([\w.:-]+)''', re.I)
+# number of characters given at once to the parser, which stops between them once the head is read
+FEED_SIZE = 4096
+# tags which start the body of a document, even without a <body> tag
+BODY_TAGS = set( ("body", "div", "p", "h1", "h2", "h3", "table", "ul", "ol", "main", "article",
+                  "section", "header", "footer", "nav", "form") )
 
 ignored_tags = set( ("reference", "author_institution", "publisher", "language",
                      "isbn", "issn", "pdf_url", "abstract_html_url")
                )
 
-URL_PATTERN = "(^http[s]?://[\w.]*[.][\w]{2,6}(/.*)?)$"
-
 class HTMLMetaProvider:
     "Find metadata in <meta> tags of web pages"
+    identifiers = (mod_ident.URL,)
+    priority = 30
+    stop_when_found = False
     
     def __init__(self):
         self.name = "meta"
 
     def load_ref(self, key):
-        match = re.search(URL_PATTERN, key)
-        if not match:
+        kind, url = mod_ident.classify(key)
+        if kind != mod_ident.URL:
             return None
         
-        url = match.groups()[0]
+        return mod_cache.cached(self.name, url, lambda: self.load_url(url))
+    
+    def load_url(self, url):
+        "Read the page until the end of its head"
         try:
-            html = urlopen(url).read()
-            soup = BeautifulSoup.BeautifulSoup(html)
-        except:
+            with mod_web.open_url(url) as response:
+                parser = HeadParser( response.headers.get_content_charset() )
+                for block in response:
+                    if parser.feed_bytes(block):
+                        break
+        except Exception as e:
+            # other errors are raised, to avoid caching a "not found" answer
+            if mod_web.not_found(e):
+                return None
+            raise
+        parser.close()
+        return self.parse_meta(url, parser.metas)
+    
+    async def aload_ref(self, key):
+        "Asynchronous variant of load_ref"
+        kind, url = mod_ident.classify(key)
+        if kind != mod_ident.URL:
             return None
         
-        if not soup.head:
-            return
+        return await mod_cache.acached(self.name, url, lambda: self.aload_url(url))
+    
+    async def aload_url(self, url):
+        parser = HeadParser()
+        def feed(headers, block):
+            if parser.encoding is None:
+                parser.encoding = headers.get_content_charset()
+            return parser.feed_bytes(block)
         
-        metas = soup.head.findAll("meta")
+        try:
+            await mod_web.aget(url, stop=feed)
+        except Exception as e:
+            if mod_web.not_found(e):
+                return None
+            raise
+        parser.close()
+        return self.parse_meta(url, parser.metas)
+    
+    def parse_meta(self, url, metas):
+        "Build a ref from the (name, content) pairs of the meta tags of a page"
         authors = []
         pages = ""
         links = {"url":url}
         ref = {"authors":authors, "links":links}
         missed = []
-        for m in metas:
-            if "name" not in m.attrs:
-                continue
-            
-            name = m.attrs["name"]
+        for name,value in metas:
             if name.startswith("citation"):
                 name = name[9:]
                 if name in ignored_tags:
                     continue
                 
-                value = m.attrs["content"]
-                
                 if name == "title":
                     ref["title"] = value
                 elif name == "author":
@@ -105,6 +140,79 @@ class HTMLMetaProvider:
         return None
 
 
+class HeadParser(html.parser.HTMLParser):
+    """Collect the (name, content) pairs of the <meta> tags in the head of a HTML document.
+    The document can be given block by block, "done" is set when the parser reaches the end of the head
+    (or the start of the body): the rest of the document does not need to be read.
+    Without a known encoding, the charset is looked for at the start of the document (UTF-8 by default).
+    """
+    
+    def __init__(self, encoding=None):
+        html.parser.HTMLParser.__init__(self)
+        self.encoding = encoding
+        self.decoder = None
+        self.start = b""
+        self.metas = []
+        self.done = False
+    
+    def feed_bytes(self, block):
+        "Parse a block of the document, returns True once the head has been read"
+        if self.done:
+            return True
+        
+        if self.decoder is None:
+            # wait for the start of the document to find its charset
+            self.start += block
+            if self.encoding is None and len(self.start) < CHARSET_SCAN:
+                return False
+            block, self.start = self.start, b""
+            self.decoder = make_decoder(self.encoding or sniff_charset(block))
+        
+        self.feed_text( self.decoder.decode(block) )
+        return self.done
+    
+    def feed_text(self, text):
+        "Parse a decoded block of the document by small pieces, until the end of the head"
+        for start in range(0, len(text), FEED_SIZE):
+            if self.done:
+                return
+            self.feed( text[start:start+FEED_SIZE] )
+    
+    def close(self):
+        if self.start:
+            self.decoder = make_decoder(self.encoding or sniff_charset(self.start))
+            self.feed_text( self.decoder.decode(self.start, True) )
+            self.start = b""
+        html.parser.HTMLParser.close(self)
+    
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == "meta":
+            attrs = dict(attrs)
+            if attrs.get("name") and attrs.get("content") is not None:
+                self.metas.append( (attrs["name"], attrs["content"]) )
+        elif tag in BODY_TAGS:
+            self.done = True
+    
+    def handle_endtag(self, tag):
+        if tag == "head":
+            self.done = True
+
+def sniff_charset(start):
+    "Charset declared at the start of a document (in a meta tag or XML declaration), UTF-8 by default"
+    match = CHARSET_PATTERN.search(start[:CHARSET_SCAN])
+    if match:
+        return match.group(1).decode("ascii")
+    return "utf-8"
+
+def make_decoder(encoding):
+    try:
+        return codecs.getincrementaldecoder(encoding)(errors="replace")
+    except LookupError:
+        return codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+
 def prep_author(author):
     "Split a raw author name into lastname,givenname"
     
@@ -131,10 +239,6 @@ def prep_author(author):
 def main(args):
     "Simple CLI to load a ref from a URL, using meta tags in the HTML header"
     
-    if not _HAS_DEPS:
-        print( "Missing dependencies, exiting" )
-        return
-    
     if len(args) != 2:
         print( "Usage: %s <ID>" % args[0] )
         print("The ID must be a URL")
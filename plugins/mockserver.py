@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs, unquote
+from xml.sax.saxutils import escape
+
+
+def ref_load(plugins):
+    plugins.add_command(mockserver)
+
+
+# address of the page of each ref of the corpus (in addition to its own "url" link)
+PAGE_URL = "https://articles.example.org/%s"
+# size (in characters) of the body of the pages, publisher pages are often large
+PAGE_SIZE = 50000
+
+# hosts of the services used by the providers (see bibtex.py and pubmed.py)
+DOI_HOSTS = ("doi.org", "dx.doi.org")
+CROSSREF_HOST = "api.crossref.org"
+EUTILS_HOST = "eutils.ncbi.nlm.nih.gov"
+
+ESEARCH_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE eSearchResult PUBLIC "-//NLM//DTD esearch 20060628//EN" "https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20060628/esearch.dtd">
+'''
+EPOST_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE ePostResult PUBLIC "-//NLM//DTD epost 20090526//EN" "https://eutils.ncbi.nlm.nih.gov/eutils/dtd/20090526/epost.dtd">
+'''
+EFETCH_HEADER = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE PubmedArticleSet PUBLIC "-//NLM//DTD PubMedArticle, 1st January 2019//EN" "https://dtd.nlm.nih.gov/ncbi/pubmed/out/pubmed_190101.dtd">
+'''
+
+
+class Corpus:
+    "Metadata of the refs served by the mock server, indexed by DOI, pubmed ID and page address"
+
+    def __init__(self, items=()):
+        self.by_doi = {}
+        self.by_pmid = {}
+        self.by_page = {}
+        for key,meta in items:
+            self.add(key, meta)
+
+    def add(self, key, meta):
+        links = meta.get("links", {})
+        if links.get("doi"):
+            self.by_doi[links["doi"].lower()] = (key, meta)
+        if links.get("pmid"):
+            self.by_pmid[str(links["pmid"])] = (key, meta)
+        self.by_page[page_address(PAGE_URL % key)] = (key, meta)
+        if links.get("url"):
+            self.by_page[page_address(links["url"])] = (key, meta)
+
+    def __len__(self):
+        return len(self.by_page)
+
+def page_address(url):
+    "Host and path of a URL: the scheme is lost when requests are sent to the mock server"
+    parts = urlsplit(url)
+    address = parts.netloc.lower() + (parts.path or "/")
+    if parts.query:
+        address += "?" + parts.query
+    return address
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    """Local server standing in for the DOI system, crossref, the Entrez E-utilities and publisher pages.
+    The first part of the path of each request is the host of the real service
+    (see the REF_MOCK_SERVER setting of webclient.py), for example /doi.org/<doi>.
+    Answers are delayed by "latency" seconds, and a fraction ("error_rate") of the requests
+    fail with "error_status", in a sequence which only depends on the seed.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, corpus, port=0, latency=0.0, error_rate=0.0, error_status=503, retry_after=None,
+                 page_size=PAGE_SIZE, seed=0):
+        HTTPServer.__init__(self, ("127.0.0.1", port), MockHandler)
+        self.corpus = corpus
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.page_size = page_size
+        self.url = "http://127.0.0.1:%s" % self.server_port
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        # lists of pubmed IDs stored by epost and esearch (usehistory)
+        self.history = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        "Serve in a background thread"
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # clients which only need the start of a page close the connection early
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def count_request(self):
+        "Count a request and tell if it should fail"
+        with self.lock:
+            self.requests += 1
+            fail = self.error_rate and self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        return fail
+
+    def store(self, pmids):
+        with self.lock:
+            key = str(len(self.history) + 1)
+            self.history[key] = pmids
+        return key
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.answer( parse_qs(urlsplit(self.path).query) )
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8")
+        self.answer( parse_qs(body) )
+
+    def answer(self, params):
+        server = self.server
+        fail = server.count_request()
+        if server.latency:
+            time.sleep(server.latency)
+        if fail:
+            headers = {}
+            if server.retry_after is not None:
+                headers["Retry-After"] = str(server.retry_after)
+            self.send(server.error_status, b"", "text/plain", headers)
+            return
+
+        params = dict( (name, values[0]) for name,values in params.items() )
+        host, sep, path = self.path.lstrip("/").partition("/")
+        host = host.lower()
+        content = None
+        content_type = "text/plain"
+        if host in DOI_HOSTS:
+            content = self.bibtex( unquote(path.split("?")[0]) )
+            content_type = "application/x-bibtex"
+        elif host == CROSSREF_HOST:
+            if path.startswith("works/"):
+                content = self.bibtex( unquote(path[6:].split("/transform")[0]) )
+            content_type = "application/x-bibtex"
+        elif host == EUTILS_HOST:
+            utility = os.path.basename(path.split("?")[0]).split(".")[0]
+            if utility in ("esearch", "epost", "efetch"):
+                content = getattr(self, utility)(params)
+                content_type = "text/xml"
+        else:
+            found = server.corpus.by_page.get( host + "/" + path )
+            if found:
+                content = render_page(found[1], server.page_size)
+                content_type = "text/html; charset=utf-8"
+
+        if content is None:
+            self.send(404, b"", content_type)
+        else:
+            self.send(200, content.encode("utf-8"), content_type)
+
+    def send(self, status, content, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        for name,value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def bibtex(self, doi):
+        found = self.server.corpus.by_doi.get(doi.lower())
+        if found:
+            return render_bibtex(*found)
+
+    def esearch(self, params):
+        pmids = []
+        for term in params.get("term", "").split(" OR "):
+            if term.endswith("[doi]"):
+                found = self.server.corpus.by_doi.get(term[:-5].lower())
+                if found and found[1]["links"].get("pmid"):
+                    pmids.append( str(found[1]["links"]["pmid"]) )
+        history = ""
+        if params.get("usehistory") == "y":
+            history = "<QueryKey>%s</QueryKey><WebEnv>mock</WebEnv>" % self.server.store(pmids)
+        ids = "".join( "<Id>%s</Id>" % pmid for pmid in pmids )
+        return ESEARCH_HEADER + ("<eSearchResult><Count>%s</Count><RetMax>%s</RetMax><RetStart>0</RetStart>%s"
+                                 "<IdList>%s</IdList><TranslationSet/><QueryTranslation/></eSearchResult>") % (len(pmids), len(pmids), history, ids)
+
+    def epost(self, params):
+        key = self.server.store( params.get("id", "").split(",") )
+        return EPOST_HEADER + "<ePostResult><QueryKey>%s</QueryKey><WebEnv>mock</WebEnv></ePostResult>" % key
+
+    def efetch(self, params):
+        if "query_key" in params:
+            pmids = self.server.history.get(params["query_key"], [])
+            start = int(params.get("retstart", 0))
+            pmids = pmids[start:start + int(params.get("retmax", len(pmids)))]
+        else:
+            pmids = params.get("id", "").split(",")
+        by_pmid = self.server.corpus.by_pmid
+        articles = [ render_article(by_pmid[pmid][1]) for pmid in pmids if pmid in by_pmid ]
+        return EFETCH_HEADER + "<PubmedArticleSet>%s</PubmedArticleSet>" % "".join(articles)
+
+
+def render_bibtex(key, meta):
+    "A bibtex entry as sent by the DOI system"
+    fields = [ ("author", " and ".join( "%s, %s" % (last, given) for last,given in meta.get("authors", []) )),
+               ("title", meta.get("title", "")), ("journal", meta.get("journal", "")), ("year", meta.get("year", "")),
+               ("volume", meta.get("volume", "")), ("pages", meta.get("pages", "").replace("-", "--")),
+               ("doi", meta.get("links", {}).get("doi", "")) ]
+    return "@article{%s,\n%s\n}" % (key, ",\n".join( "  %s = {%s}" % field for field in fields if field[1] ))
+
+def render_article(meta):
+    "A PubmedArticle element as sent by efetch"
+    links = meta.get("links", {})
+    authors = "".join( '<Author ValidYN="Y"><LastName>%s</LastName><ForeName>%s</ForeName></Author>' % (escape(last), escape(given))
+                       for last,given in meta.get("authors", []) )
+    doi = ""
+    if links.get("doi"):
+        doi = '<ELocationID EIdType="doi" ValidYN="Y">%s</ELocationID>' % escape(links["doi"])
+    journal = escape(meta.get("journal", ""))
+    return ('<PubmedArticle><MedlineCitation Status="MEDLINE" Owner="NLM"><PMID Version="1">%s</PMID>'
+            '<Article PubModel="Print"><Journal><JournalIssue CitedMedium="Print"><Volume>%s</Volume><Issue>%s</Issue>'
+            '<PubDate><Year>%s</Year></PubDate></JournalIssue><Title>%s</Title><ISOAbbreviation>%s</ISOAbbreviation></Journal>'
+            '<ArticleTitle>%s</ArticleTitle><Pagination><MedlinePgn>%s</MedlinePgn></Pagination>'
+            '%s<AuthorList CompleteYN="Y">%s</AuthorList></Article></MedlineCitation></PubmedArticle>') % (
+            links["pmid"], escape(meta.get("volume", "")), escape(meta.get("issue", "")), meta.get("year", ""),
+            journal, journal, escape(meta.get("title", "")), escape(meta.get("pages", "")), doi, authors)
+
+def render_page(meta, size=PAGE_SIZE):
+    "A HTML page with citation_* meta tags in its head, and a body of about the given size"
+    links = meta.get("links", {})
+    tags = [ ("citation_title", meta.get("title")), ("citation_journal_title", meta.get("journal")),
+             ("citation_publication_date", meta.get("year") and meta["year"]+"/01/01"),
+             ("citation_volume", meta.get("volume")), ("citation_doi", links.get("doi")), ("citation_pmid", links.get("pmid")) ]
+    tags.extend( ("citation_author", "%s %s" % (given, last)) for last,given in meta.get("authors", []) )
+    head = "\n".join( '<meta name="%s" content="%s">' % (name, escape(str(value), {'"': "&quot;"})) for name,value in tags if value )
+    paragraph = "<p>%s</p>\n" % escape(meta.get("title", "text"))
+    body = paragraph * (size // len(paragraph) + 1)
+    return "<html><head><title>%s</title>\n%s\n</head>\n<body>\n%s</body></html>" % (escape(meta.get("title", "")), head, body)
+
+
+def serve(corpus, args):
+    "Parse the options of the mockserver command and serve the corpus until interrupted"
+    options = {}
+    port = 8000
+    while args:
+        if len(args) < 2:
+            print(mockserver.__doc__)
+            return
+        option, value = args[:2]
+        args = args[2:]
+        if option == "--port":
+            port = int(value)
+        elif option == "--latency":
+            options["latency"] = float(value)
+        elif option == "--errors":
+            options["error_rate"] = float(value)
+        elif option == "--status":
+            options["error_status"] = int(value)
+        elif option == "--retry-after":
+            options["retry_after"] = int(value)
+        elif option == "--page-size":
+            options["page_size"] = int(value)
+        elif option == "--seed":
+            options["seed"] = int(value)
+        else:
+            print(mockserver.__doc__)
+            return
+
+    server = MockServer(corpus, port, **options)
+    print("Serving %s refs on %s" % (len(corpus), server.url))
+    print("Set REF_MOCK_SERVER=%s to send the requests of the providers to it" % server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+    print("%s requests, %s errors" % (server.requests, server.errors))
+
+def mockserver(collection, args):
+    """Serve the refs of the collection as the metadata services would, for offline tests and load tests.
+Usage: mockserver [--port 8000] [--latency <seconds>] [--errors <rate>] [--status 503]
+                  [--retry-after <seconds>] [--page-size 50000] [--seed 0]
+The DOI system and crossref answer bibtex entries, the Entrez E-utilities answer
+pubmed XML for the refs with a DOI and a pubmed ID, and the page of each ref
+(its URL link, or https://articles.example.org/<key>) has citation_* meta tags.
+Set the REF_MOCK_SERVER environment variable to the address of the server
+to send the requests of the providers to it.
+--latency: delay of each answer
+--errors: fraction of the requests which fail with the given status,
+          in a sequence which only depends on the seed"""
+
+    corpus = Corpus( (key, ref.get_meta()) for key,ref in collection.iter_references() )
+    serve(corpus, args)
+
+
+def main(args):
+    "Simple CLI to serve a JSON file of refs (as saved in references.json)"
+
+    if len(args) < 2:
+        print( "Usage: %s <file.json> [options of the mockserver command]" % args[0] )
+        return
+
+    f = open(args[1])
+    corpus = Corpus( json.load(f).items() )
+    f.close()
+    serve(corpus, args[2:])
+
+
+if __name__ == "__main__":
+    main( sys.argv )
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
 from __future__ import print_function
-from . import doi as mod_doi
-from urllib.request import urlopen,Request
+from . import ident as mod_ident
+from . import cache as mod_cache
+from . import webclient as mod_web
+from io import BytesIO
 import sys
-import re
+import time
+import asyncio
+import threading
 
 try:
     from Bio import Entrez
@@ -18,8 +22,15 @@ except:
     print( "Missing deps for the pubmed provider" )
     _HAS_DEPS = False
 
-PM_PATTERN = "^((pmid|pubmed):)?(\d*)$"
-PM_PATTERN_LONG = "http[s]?://www[.]ncbi[.]nlm[.]nih[.]gov/pubmed/(\d*)([?].*)$"
+# number of articles retrieved by a single efetch request
+BATCH_SIZE = 200
+# number of DOIs searched by a single esearch request
+DOI_BATCH_SIZE = 50
+
+EUTILS_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/%s.fcgi"
+# minimal delay between two requests to NCBI, without and with an API key
+REQUEST_INTERVAL = 1.0 / 3
+API_KEY_INTERVAL = 1.0 / 10
 
 
 
@@ -30,7 +41,7 @@ def test_raw():
     fetch = "efetch.fcgi?db=pubmed&id=%s&rettype=xml&retmode=text"
     url = base+fetch % "4655"
 
-    xml = urlopen(url).read()
+    xml = mod_web.get(url)
     soup = bs4.BeautifulSoup(xml)
 
     article = soup.find("article")
@@ -38,6 +49,10 @@ def test_raw():
 
 class PubmedProvider:
     "Find metadata on Pubmed"
+    identifiers = (mod_ident.PMID, mod_ident.DOI)
+    priority = 10
+    stop_when_found = True
+    
     def __init__(self):
         self.name = "pubmed"
     
@@ -50,78 +65,306 @@ class PubmedProvider:
             return self.load_pubmed(pmid)
     
     def get_pmid(self, string):
-        m = re.search(PM_PATTERN, string)
-        if m:
-            return m.groups()[2]
+        kind, value = mod_ident.classify(string)
+        if kind == mod_ident.PMID:
+            return value
         
-        m = re.search(PM_PATTERN_LONG, string)
-        if m:
-            return m.groups()[0]
-        
-        doi = mod_doi.get_doi(string)
-        if doi:
-            return self.find_pmid_for_doi(doi)
+        if kind == mod_ident.DOI:
+            return self.find_pmid_for_doi(value)
 
     def find_pmid_for_doi(self, doi):
         "Search a pubmed entry for a given doi, return None if not found (or multiple matches)"
-        
-        handle = Entrez.esearch(db='pubmed', term=doi+"[doi]", retmax=3)
-        record = Entrez.read(handle)
-        handle.close()
-        
-        results = record["IdList"]
-        if len(results) != 1:
-            return None
-        
-        return results[0]
+        return mod_cache.cached("pubmed-doi", doi.lower(), lambda: self.search_doi(doi))
+    
+    def search_doi(self, doi):
+        return read_single_pmid( _entrez("esearch", db='pubmed', term=doi+"[doi]", retmax=3) )
     
     
     def load_pubmed(self, pmid):
         """Load a reference from pubmed.
-        This will retrieve the metadata from pubmed, and create a Ref object based on it.
+        This will retrieve the metadata from pubmed (or from the cache), and create a Ref object based on it.
         """
-        handle = Entrez.efetch(db='pubmed', id=pmid, retmode='text', rettype='xml')
-        record = Entrez.read(handle)['PubmedArticle'][0]['MedlineCitation']['Article']
+        return mod_cache.cached(self.name, pmid, lambda: self.fetch_pubmed(pmid))
+    
+    def fetch_pubmed(self, pmid):
+        return read_single_article( _entrez("efetch", db='pubmed', id=pmid, retmode='text', rettype='xml') )
+    
+    async def aload_ref(self, key):
+        "Asynchronous variant of load_ref"
+        kind, value = mod_ident.classify(key)
+        if kind == mod_ident.DOI:
+            pmid = await mod_cache.acached("pubmed-doi", value.lower(), lambda: self.asearch_doi(value))
+        elif kind == mod_ident.PMID:
+            pmid = value
+        else:
+            return None
         
-        title = record["ArticleTitle"]
-        authors = []
-        for a in record["AuthorList"]:
-            if "LastName" in a:
-                authors.append( (a["LastName"], a["ForeName"]) )
-            else:
-                authors.append((a["CollectiveName"],""))
+        if pmid:
+            return await mod_cache.acached(self.name, pmid, lambda: self.afetch_pubmed(pmid))
+    
+    async def asearch_doi(self, doi):
+        return read_single_pmid( await _aentrez("esearch", db='pubmed', term=doi+"[doi]", retmax=3) )
+    
+    async def afetch_pubmed(self, pmid):
+        return read_single_article( await _aentrez("efetch", db='pubmed', id=pmid, retmode='text', rettype='xml') )
+    
+    def prefetch(self, keys):
+        "Load a group of identifiers in a few requests to fill the cache before a batch lookup"
+        if mod_cache.responses is not None and not mod_cache.offline:
+            self.load_refs(keys)
+    
+    def load_refs(self, keys):
+        """Load many references at once.
+        Returns a dict associating the keys (pubmed IDs, URLs or DOIs) to the matching refs.
+        """
+        pmids = {}
+        dois = {}
+        for key in keys:
+            kind, value = mod_ident.classify(key)
+            if kind == mod_ident.PMID:
+                pmids[key] = value
+            elif kind == mod_ident.DOI:
+                dois[key] = value
         
-        journal = record["Journal"]
-        journal_name  = journal["ISOAbbreviation"]
-        journal_issue = journal["JournalIssue"]
-        vol, issue = None,None
-        if "Volume" in journal_issue:
-            vol = journal_issue["Volume"]
-        if "Issue" in journal_issue:
-            issue = journal_issue["Issue"]
-        year = journal_issue["PubDate"]["Year"]
+        result = {}
+        found = self.load_pubmed_batch(set(pmids.values()))
+        for key,pmid in pmids.items():
+            if pmid in found:
+                result[key] = found[pmid]
         
-        pages = record["Pagination"]["MedlinePgn"]
+        found = self.load_doi_batch(set(dois.values()))
+        for key,doi in dois.items():
+            if doi.lower() in found:
+                result[key] = found[doi.lower()]
         
-        ref = {
-            "title": title,
-            "authors": authors,
-            "journal": journal_name,
-            "year": year,
-            "volume": vol,
-            "issue": issue,
-            "pages": pages
-        }
+        return result
+    
+    def load_pubmed_batch(self, pmids):
+        """Load many references from pubmed.
+        Returns a dict associating each pubmed ID to its ref. Large groups of IDs are posted
+        once on the history server, and the articles are then retrieved by pages.
+        """
+        result = {}
+        missing = []
+        for pmid in pmids:
+            ref = mod_cache.get_cached(self.name, pmid)
+            if ref is mod_cache.ABSENT:
+                missing.append(pmid)
+            elif ref:
+                result[pmid] = ref
         
-        ref_links = {"pmid":pmid}
-        ref["links"] = ref_links
+        if not missing or mod_cache.offline:
+            return result
         
-        links = record["ELocationID"]
-        for l in links:
-            ref_links[l.attributes["EIdType"]] = l.title()
+        if len(missing) <= BATCH_SIZE:
+            handle = _entrez("efetch", db='pubmed', id=",".join(missing), retmode='xml')
+            self.read_articles(handle, result)
+        else:
+            handle = _entrez("epost", db='pubmed', id=",".join(missing))
+            posted = Entrez.read(handle)
+            handle.close()
+            self.fetch_history(posted["WebEnv"], posted["QueryKey"], len(missing), result)
         
+        for pmid in missing:
+            if pmid not in result:
+                mod_cache.store(self.name, pmid, None)
+        return result
+    
+    def load_doi_batch(self, dois):
+        """Search pubmed entries for many DOIs.
+        Returns a dict associating the (lowercase) DOIs to the matching refs.
+        """
+        result = {}
+        missing = []
+        for doi in dois:
+            pmid = mod_cache.get_cached("pubmed-doi", doi.lower())
+            if pmid is None:
+                # known to have no pubmed entry
+                continue
+            ref = mod_cache.ABSENT
+            if pmid is not mod_cache.ABSENT:
+                ref = mod_cache.get_cached(self.name, pmid)
+            if ref is mod_cache.ABSENT:
+                missing.append(doi)
+            elif ref:
+                result[doi.lower()] = ref
+        
+        if mod_cache.offline:
+            return result
+        
+        for idx in range(0, len(missing), DOI_BATCH_SIZE):
+            chunk = missing[idx:idx+DOI_BATCH_SIZE]
+            term = " OR ".join( [ "%s[doi]" % doi for doi in chunk ] )
+            handle = _entrez("esearch", db='pubmed', term=term, retmax=len(chunk), usehistory='y')
+            record = Entrez.read(handle)
+            handle.close()
+            
+            count = int(record["Count"])
+            found = {}
+            if count > 0:
+                self.fetch_history(record["WebEnv"], record["QueryKey"], count, found)
+            
+            # a pubmed entry matches a DOI if it is listed in its links
+            wanted = set( doi.lower() for doi in chunk )
+            for pmid,ref in found.items():
+                doi = ref["links"].get("doi", "").lower()
+                if doi in wanted:
+                    result[doi] = ref
+                    mod_cache.store("pubmed-doi", doi, pmid)
+            for doi in wanted:
+                if doi not in result:
+                    mod_cache.store("pubmed-doi", doi, None)
+        
+        return result
+    
+    def fetch_history(self, webenv, query_key, count, result):
+        "Retrieve the articles stored on the history server by pages"
+        for start in range(0, count, BATCH_SIZE):
+            handle = _entrez("efetch", db='pubmed', webenv=webenv, query_key=query_key,
+                             retstart=start, retmax=BATCH_SIZE, retmode='xml')
+            self.read_articles(handle, result)
+    
+    def read_articles(self, handle, result):
+        "Parse a set of articles, add them to the result and to the cache"
+        articles = Entrez.read(handle)['PubmedArticle']
         handle.close()
-        return ref
+        for article in articles:
+            try:
+                ref = parse_article(article)
+            except:
+                continue
+            pmid = ref["links"]["pmid"]
+            result[pmid] = ref
+            mod_cache.store(self.name, pmid, ref)
+
+
+def read_single_pmid(handle):
+    "Return the pubmed ID found by a search, None if not found (or multiple matches)"
+    record = Entrez.read(handle)
+    handle.close()
+    
+    results = record["IdList"]
+    if len(results) != 1:
+        return None
+    
+    return results[0]
+
+def read_single_article(handle):
+    article = Entrez.read(handle)['PubmedArticle'][0]
+    handle.close()
+    return parse_article(article)
+
+def parse_article(article):
+    "Create a ref dict from a parsed pubmed article"
+    
+    citation = article['MedlineCitation']
+    pmid = str(citation['PMID'])
+    record = citation['Article']
+    
+    title = record["ArticleTitle"]
+    authors = []
+    for a in record["AuthorList"]:
+        if "LastName" in a:
+            authors.append( (a["LastName"], a["ForeName"]) )
+        else:
+            authors.append((a["CollectiveName"],""))
+    
+    journal = record["Journal"]
+    journal_name  = journal["ISOAbbreviation"]
+    journal_issue = journal["JournalIssue"]
+    vol, issue = None,None
+    if "Volume" in journal_issue:
+        vol = journal_issue["Volume"]
+    if "Issue" in journal_issue:
+        issue = journal_issue["Issue"]
+    year = journal_issue["PubDate"]["Year"]
+    
+    pages = record["Pagination"]["MedlinePgn"]
+    
+    ref = {
+        "title": title,
+        "authors": authors,
+        "journal": journal_name,
+        "year": year,
+        "volume": vol,
+        "issue": issue,
+        "pages": pages
+    }
+    
+    ref_links = {"pmid":pmid}
+    ref["links"] = ref_links
+    
+    links = record["ELocationID"]
+    for l in links:
+        ref_links[l.attributes["EIdType"]] = l.title()
+    
+    return ref
+
+
+_throttle_lock = threading.Lock()
+_last_request = [0]
+
+def _entrez(utility, **params):
+    """Send a request to the E-utilities using the shared HTTP client (with keep-alive connections).
+    Returns a handle on the answer, to be parsed by Entrez.read"""
+    throttle()
+    return BytesIO( mod_web.post(EUTILS_URL % utility, entrez_params(params)) )
+
+async def _aentrez(utility, **params):
+    "Asynchronous variant of _entrez"
+    await athrottle()
+    return BytesIO( await mod_web.apost(EUTILS_URL % utility, entrez_params(params)) )
+
+def entrez_params(params):
+    params["tool"] = getattr(Entrez, "tool", "biopython")
+    params["email"] = Entrez.email
+    if getattr(Entrez, "api_key", None):
+        params["api_key"] = Entrez.api_key
+    # POST requests accept long lists of IDs
+    return params
+
+def throttle():
+    "Wait before sending a request to NCBI: at most 3 requests per second (10 with an API key)"
+    time.sleep( max(0, reserve_request() - time.time()) )
+
+def request_interval():
+    if getattr(Entrez, "api_key", None):
+        return API_KEY_INTERVAL
+    return REQUEST_INTERVAL
+
+def reserve_request():
+    "Reserve the time of the next request to NCBI, and return it"
+    with _throttle_lock:
+        slot = max(time.time(), _last_request[0] + request_interval())
+        _last_request[0] = slot
+    return slot
+
+def cancel_request(slot):
+    "Give back the time reserved for a request which was not sent, unless later requests were reserved"
+    with _throttle_lock:
+        if _last_request[0] == slot:
+            _last_request[0] = slot - request_interval()
+
+# requests from an event loop wait for their turn on a lock, to only reserve a time right before sending
+_async_gates = {}
+
+async def athrottle():
+    """Asynchronous variant of throttle.
+    Only the first waiting request holds a reservation: a request cancelled
+    (after a timeout) does not delay the next ones."""
+    loop = asyncio.get_running_loop()
+    gate = _async_gates.get(loop)
+    if gate is None:
+        _async_gates.clear()
+        gate = _async_gates[loop] = asyncio.Lock()
+    
+    async with gate:
+        slot = reserve_request()
+        try:
+            await asyncio.sleep( max(0, slot - time.time()) )
+        except asyncio.CancelledError:
+            cancel_request(slot)
+            raise
 
 
 def main(args):
@@ -0,0 +1,562 @@
+#!/usr/bin/env python3
+
+import sys
+import os
+import ssl
+import time
+import zlib
+import asyncio
+import threading
+import http.client
+from email.parser import Parser
+from urllib.parse import urlsplit, urljoin, urlencode
+
+# Default settings, they can be changed using environment variables
+TIMEOUT = float(os.environ.get("REF_HTTP_TIMEOUT", 20))
+RETRIES = int(os.environ.get("REF_HTTP_RETRIES", 3))
+POOL_SIZE = int(os.environ.get("REF_HTTP_POOL", 8))
+# maximal number of asynchronous requests sent at once to a host
+MAX_CONNECTIONS = int(os.environ.get("REF_HTTP_CONNECTIONS", 16))
+# address of a local mock server receiving all requests instead of the real hosts (see mockserver.py)
+MOCK_SERVER = os.environ.get("REF_MOCK_SERVER", "")
+
+# delay (in seconds) before the first retry, doubled after each failure
+BACKOFF = 0.5
+MAX_REDIRECTS = 10
+# size of the blocks read from the responses
+READ_SIZE = 64*1024
+USER_AGENT = "pyb/0.1 (reference manager)"
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+# answers telling that a resource does not exist
+NOT_FOUND_STATUS = (404, 410)
+
+
+class HTTPError(Exception):
+    "Error status in the answer of a server"
+
+    def __init__(self, url, status, reason):
+        Exception.__init__(self, "HTTP error %s (%s) for %s" % (status, reason, url))
+        self.url = url
+        self.status = status
+
+def not_found(error):
+    "Check if a request failed because the resource does not exist (and not because of the network or server)"
+    return isinstance(error, HTTPError) and error.status in NOT_FOUND_STATUS
+
+
+class ConnectionPool:
+    """Keep-alive connections, grouped by host.
+    A connection is used by a single request at a time: it is taken from the pool
+    when sending a request and given back when the response has been read.
+    At most "size" idle connections are kept for each host.
+    """
+
+    def __init__(self, size=POOL_SIZE):
+        self.size = size
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, scheme, host, timeout):
+        "Return an idle connection to a host (or a new one), and whether it was reused"
+        with self.lock:
+            idle = self.idle.get( (scheme,host) )
+            if idle:
+                conn = idle.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        return self.connect(scheme, host, timeout), False
+
+    def connect(self, scheme, host, timeout):
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, timeout=timeout)
+        return http.client.HTTPConnection(host, timeout=timeout)
+
+    def put(self, scheme, host, conn):
+        with self.lock:
+            idle = self.idle.setdefault( (scheme,host), [] )
+            if len(idle) < self.size:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def clear(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+
+
+# shared pool used by all plugins
+pool = ConnectionPool()
+
+
+class Response:
+    """Answer to a request.
+    The body is decompressed on the fly, it can be read at once with "read",
+    or block by block (by iterating over the response) to stop early on large documents.
+    The connection goes back to the pool once the body has been read completely,
+    call "close" (or use the response as a context manager) to drop it otherwise.
+    """
+
+    def __init__(self, url, raw, release):
+        self.url = url
+        self.raw = raw
+        self.status = raw.status
+        self.reason = raw.reason
+        self.headers = raw.headers
+        self.release = release
+
+        self.decoder = body_decoder(raw.headers)
+
+    def __iter__(self):
+        while self.raw is not None:
+            block = self.raw.read1(READ_SIZE)
+            if not block:
+                self.finish()
+                if self.decoder:
+                    block = self.decoder.flush()
+                    if block:
+                        yield block
+                return
+
+            if self.decoder:
+                block = self.decoder.decompress(block)
+            if block:
+                yield block
+
+    def read(self):
+        return b"".join(self)
+
+    def finish(self):
+        "The body has been read: the connection can be reused"
+        raw, self.raw = self.raw, None
+        if raw is not None:
+            # closing the response keeps the socket of the connection open
+            reusable = not raw.will_close
+            raw.close()
+            self.release(reusable)
+
+    def discard(self):
+        "Skip the body of an answer which is not used: a short body is read to reuse the connection"
+        length = self.headers.get("Content-Length", "")
+        if length.isdigit() and int(length) <= READ_SIZE:
+            self.read()
+        else:
+            self.close()
+
+    def close(self):
+        "Drop the connection if the body was not read completely"
+        raw, self.raw = self.raw, None
+        if raw is not None:
+            raw.close()
+            self.release(False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_url(url, data=None, headers=None, timeout=None, retries=None):
+    """Send a request (a POST if data is given) and return the response, following redirects.
+    Connection errors and temporary failures (status 429 and 5xx) are retried after an increasing delay.
+    Raises HTTPError for other error statuses, or the last error if all attempts failed.
+    """
+
+    if timeout is None:
+        timeout = TIMEOUT
+    if retries is None:
+        retries = RETRIES
+
+    delay = BACKOFF
+    attempt = 0
+    redirects = 0
+    while True:
+        try:
+            response = send(url, data, headers, timeout)
+        except (OSError, http.client.HTTPException):
+            if attempt >= retries:
+                raise
+            attempt += 1
+            time.sleep(delay)
+            delay *= 2
+            continue
+
+        status = response.status
+        location = response.headers.get("Location")
+        if status in REDIRECT_STATUS and location:
+            # read the (short) body to keep the connection alive
+            response.read()
+            redirects += 1
+            if redirects > MAX_REDIRECTS:
+                raise HTTPError(url, status, "too many redirects")
+            url = urljoin(url, location)
+            if status == 303 or (status in (301,302) and data is not None):
+                data = None
+            continue
+
+        if status in RETRY_STATUS and attempt < retries:
+            wait = retry_after(response.headers, delay)
+            response.discard()
+            attempt += 1
+            time.sleep(wait)
+            delay *= 2
+            continue
+
+        if status >= 400:
+            response.discard()
+            raise HTTPError(url, status, response.reason)
+
+        return response
+
+def send(url, data, headers, timeout):
+    "Send a single request on a pooled connection"
+    scheme, host, path = split_url(url)
+    method, request_headers = prepare_request(data, headers)
+
+    conn, reused = pool.get(scheme, host, timeout)
+    while True:
+        try:
+            conn.request(method, path, body=data, headers=request_headers)
+            raw = conn.getresponse()
+            break
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+            # the server closed an idle connection: try again on a new one
+            conn, reused = pool.connect(scheme, host, timeout), False
+
+    def release(reusable):
+        if reusable:
+            pool.put(scheme, host, conn)
+        else:
+            conn.close()
+
+    return Response(url, raw, release)
+
+def split_url(url):
+    """Return the scheme, host and path (with the query) of a URL.
+    With a mock server, the request goes to the mock server and its path starts with the real host."""
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    if scheme not in ("http", "https"):
+        raise ValueError("Unsupported URL: "+url)
+
+    path = parts.path or "/"
+    if parts.query:
+        path += "?" + parts.query
+    if MOCK_SERVER:
+        mock = urlsplit(MOCK_SERVER)
+        return mock.scheme.lower(), mock.netloc, "/" + parts.netloc + path
+    return scheme, parts.netloc, path
+
+def set_mock_server(url):
+    "Send all requests to a mock server (given by its address), or to the real hosts if url is empty"
+    global MOCK_SERVER
+    MOCK_SERVER = url
+
+def prepare_request(data, headers):
+    "Return the method and headers of a request"
+    request_headers = {"User-Agent": USER_AGENT, "Accept-Encoding": "gzip, deflate"}
+    if data is not None:
+        request_headers["Content-Type"] = "application/x-www-form-urlencoded"
+    if headers:
+        request_headers.update(headers)
+    if data is not None:
+        return "POST", request_headers
+    return "GET", request_headers
+
+def retry_after(headers, delay):
+    "Delay before retrying a request, given by the server or the default backoff"
+    value = headers.get("Retry-After", "")
+    if value.isdigit():
+        return min(float(value), 60)
+    return delay
+
+def body_decoder(headers):
+    "Return a decompressor for the body of an answer, None if it is not compressed"
+    encoding = headers.get("Content-Encoding", "").lower()
+    if encoding == "gzip":
+        return zlib.decompressobj(16+zlib.MAX_WBITS)
+    if encoding == "deflate":
+        return zlib.decompressobj()
+    return None
+
+
+def get(url, headers=None, timeout=None):
+    "Return the (decompressed) content of a document"
+    return open_url(url, headers=headers, timeout=timeout).read()
+
+def post(url, fields, headers=None, timeout=None):
+    "Send a form and return the (decompressed) answer"
+    data = urlencode(fields).encode("utf-8")
+    return open_url(url, data=data, headers=headers, timeout=timeout).read()
+
+
+
+class AsyncConnectionPool:
+    """Keep-alive connections (pairs of asyncio streams) for the requests sent from an event loop.
+    As asyncio streams can not be shared between loops, each loop gets its own pool (see get_async_pool).
+    """
+
+    def __init__(self, loop, size=POOL_SIZE, limit=MAX_CONNECTIONS):
+        self.loop = loop
+        self.size = size
+        self.limit = limit
+        self.idle = {}
+        self.slots = {}
+
+    def slot(self, scheme, host):
+        "Semaphore limiting the number of connections used at once for a host"
+        key = (scheme, host)
+        if key not in self.slots:
+            self.slots[key] = asyncio.Semaphore(self.limit)
+        return self.slots[key]
+
+    def get(self, scheme, host):
+        "Return an idle connection to a host, or None"
+        idle = self.idle.get( (scheme,host) )
+        if idle:
+            return idle.pop()
+
+    async def connect(self, scheme, host, timeout):
+        parts = urlsplit("//"+host)
+        if scheme == "https":
+            port = parts.port or 443
+            opening = asyncio.open_connection(parts.hostname, port, ssl=ssl_context())
+        else:
+            port = parts.port or 80
+            opening = asyncio.open_connection(parts.hostname, port)
+        return await asyncio.wait_for(opening, timeout)
+
+    def put(self, scheme, host, connection):
+        idle = self.idle.setdefault( (scheme,host), [] )
+        if len(idle) < self.size:
+            idle.append(connection)
+        else:
+            connection[1].close()
+
+    def clear(self):
+        idle, self.idle = self.idle, {}
+        for connections in idle.values():
+            for reader,writer in connections:
+                writer.close()
+
+_async_pool = [None]
+_ssl_context = [None]
+
+def get_async_pool():
+    "Pool of connections for the running event loop"
+    loop = asyncio.get_running_loop()
+    if _async_pool[0] is None or _async_pool[0].loop is not loop:
+        _async_pool[0] = AsyncConnectionPool(loop)
+    return _async_pool[0]
+
+def ssl_context():
+    if _ssl_context[0] is None:
+        _ssl_context[0] = ssl.create_default_context()
+    return _ssl_context[0]
+
+# errors which can be raised when sending an asynchronous request
+ASYNC_ERRORS = (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, http.client.HTTPException)
+
+async def aopen_url(url, data=None, headers=None, timeout=None, retries=None, stop=None):
+    """Asynchronous variant of open_url, for the providers used from an event loop.
+    Returns the status, headers and (decompressed) body of the answer.
+    If a "stop" function is given, it is called with the headers and each block of a successful answer,
+    and the rest of the body is not read once it returns True (the body is then incomplete)."""
+
+    if timeout is None:
+        timeout = TIMEOUT
+    if retries is None:
+        retries = RETRIES
+
+    delay = BACKOFF
+    attempt = 0
+    redirects = 0
+    while True:
+        try:
+            status, reason, response_headers, body = await asend(url, data, headers, timeout, stop)
+        except ASYNC_ERRORS:
+            if attempt >= retries:
+                raise
+            attempt += 1
+            await asyncio.sleep(delay)
+            delay *= 2
+            continue
+
+        location = response_headers.get("Location")
+        if status in REDIRECT_STATUS and location:
+            redirects += 1
+            if redirects > MAX_REDIRECTS:
+                raise HTTPError(url, status, "too many redirects")
+            url = urljoin(url, location)
+            if status == 303 or (status in (301,302) and data is not None):
+                data = None
+            continue
+
+        if status in RETRY_STATUS and attempt < retries:
+            attempt += 1
+            await asyncio.sleep( retry_after(response_headers, delay) )
+            delay *= 2
+            continue
+
+        if status >= 400:
+            raise HTTPError(url, status, reason)
+
+        return status, response_headers, body
+
+async def asend(url, data, headers, timeout, stop=None):
+    "Send a single request on a pooled connection and read the answer (see aopen_url for stop)"
+    scheme, host, path = split_url(url)
+    method, request_headers = prepare_request(data, headers)
+    request_headers["Host"] = host
+    if data is not None:
+        request_headers["Content-Length"] = str(len(data))
+    lines = [ "%s %s HTTP/1.1" % (method, path) ]
+    lines.extend( "%s: %s" % item for item in request_headers.items() )
+    request = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+    if data is not None:
+        request += data
+
+    pool = get_async_pool()
+    async with pool.slot(scheme, host):
+        connection = pool.get(scheme, host)
+        reused = connection is not None
+        while True:
+            if connection is None:
+                connection = await pool.connect(scheme, host, timeout)
+            reader, writer = connection
+            try:
+                writer.write(request)
+                await writer.drain()
+                answer = await asyncio.wait_for(read_response(reader, method, stop), timeout)
+                break
+            except ASYNC_ERRORS:
+                writer.close()
+                if not reused:
+                    raise
+                # the server closed an idle connection: try again on a new one
+                connection, reused = None, False
+            except BaseException:
+                # cancelled in the middle of an answer: the connection can not be reused
+                writer.close()
+                raise
+
+        status, reason, response_headers, body, keep_alive = answer
+        if keep_alive:
+            pool.put(scheme, host, connection)
+        else:
+            writer.close()
+    return status, reason, response_headers, body
+
+async def read_response(reader, method, stop=None):
+    """Read an HTTP/1.1 answer from a stream, with a decompressed body.
+    If a "stop" function returns True for a block of a successful answer (it is called with the headers
+    and the block), the rest of the body is not read
+    and the connection can not be reused."""
+    line = await reader.readline()
+    if not line:
+        raise http.client.RemoteDisconnected("Remote end closed connection without response")
+    parts = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+        raise http.client.BadStatusLine(line)
+    version = parts[0]
+    status = int(parts[1])
+    reason = ""
+    if len(parts) > 2:
+        reason = parts[2]
+
+    header_lines = []
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        header_lines.append(line.decode("latin-1"))
+    headers = Parser(_class=http.client.HTTPMessage).parsestr("".join(header_lines))
+
+    keep_alive = version == "HTTP/1.1" and headers.get("Connection", "").lower() != "close"
+    if not 200 <= status < 300:
+        stop = None
+    decoder = body_decoder(headers)
+    blocks = []
+    def add(block):
+        "Keep a block of the body, returns True to stop reading"
+        if decoder:
+            block = decoder.decompress(block)
+        if not block:
+            return False
+        blocks.append(block)
+        return bool(stop and stop(headers, block))
+
+    stopped = False
+    if method == "HEAD" or status in (204, 304) or status < 200:
+        pass
+    elif "chunked" in headers.get("Transfer-Encoding", "").lower():
+        while True:
+            size = int(( await reader.readline() ).split(b";")[0], 16)
+            if size == 0:
+                break
+            stopped = add( await reader.readexactly(size) )
+            if stopped:
+                break
+            await reader.readexactly(2)
+        # skip the trailers
+        while not stopped and ( await reader.readline() ) not in (b"\r\n", b"\n", b""):
+            pass
+    elif headers.get("Content-Length"):
+        remaining = int(headers["Content-Length"])
+        while remaining and not stopped:
+            block = await reader.read( min(READ_SIZE, remaining) )
+            if not block:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            remaining -= len(block)
+            stopped = add(block)
+    else:
+        while not stopped:
+            block = await reader.read(READ_SIZE)
+            if not block:
+                break
+            stopped = add(block)
+        keep_alive = False
+
+    if stopped:
+        keep_alive = False
+    elif decoder:
+        blocks.append( decoder.flush() )
+    return status, reason, headers, b"".join(blocks), keep_alive
+
+
+async def aget(url, headers=None, timeout=None, stop=None):
+    "Asynchronous variant of get (see aopen_url for stop)"
+    status, response_headers, body = await aopen_url(url, headers=headers, timeout=timeout, stop=stop)
+    return body
+
+async def apost(url, fields, headers=None, timeout=None):
+    "Asynchronous variant of post"
+    data = urlencode(fields).encode("utf-8")
+    status, response_headers, body = await aopen_url(url, data=data, headers=headers, timeout=timeout)
+    return body
+
+
+def main(args):
+    "Simple CLI to retrieve a document with the shared HTTP client"
+
+    if len(args) != 2:
+        print( "Usage: %s <URL>" % args[0] )
+        return
+
+    response = open_url(args[1])
+    content = response.read()
+    print( "%s %s: %s bytes from %s" % (response.status, response.reason, len(content), response.url) )
+
+
+if __name__ == "__main__":
+    main( sys.argv )
@@ -1,19 +1,87 @@
 #!/usr/bin/env python3
 
 from __init__ import *
+from collections import deque
 import os
 import sys
+import json
+import time
+import stats
 import plugins
+from plugins import ident
+
+# maximal time (in seconds) to wait for a provider during a lookup
+LOOKUP_TIMEOUT = 30
+# number of simultaneous lookups in batch mode
+BATCH_JOBS = 8
+# number of simultaneous lookups in asynchronous batch mode: pubmed answers 3 requests
+# per second, more lookups would wait longer than LOOKUP_TIMEOUT for their turn
+ASYNC_JOBS = 64
+# number of identifiers given at once to the providers which can prefetch them
+PREFETCH_SIZE = 500
+# number of matches added in batch mode between two saves of the collection
+SAVE_INTERVAL = 100
+# maximal number of search results to show
+SEARCH_LIMIT = 50
 
 def main(args):
     """Simple CLI to load a ref from the proper source depending on the argument
 
 Usage
 =====
-ref.py <command> <arguments>
+ref.py [--offline] [--db[=]<file>] [--stats[=<file.json>]] [--profile[=<file>]] <command> <arguments>
+
+--offline: only use the cached answers of metadata providers
+--db: use another collection than references.json (or the REF_DB environment variable).
+      Collections stored in .sqlite or .db files are SQLite databases.
+--stats: show the time spent loading plugins, opening and saving the collection and in each
+         provider, with the calls, matches, errors and cache hits of providers.
+         The statistics are saved as JSON in the given file, if any.
+--profile: run the command with cProfile and show the slowest functions.
+           The profile is saved in the given file, if any (see the pstats module).
 """
     
-    collection = RefCollection()
+    if "--offline" in args:
+        args = [ a for a in args if a != "--offline" ]
+        from plugins import cache
+        cache.set_offline()
+    
+    path = None
+    show_stats = profile = False
+    stats_path = profile_path = None
+    while len(args) > 1 and args[1].startswith("--"):
+        option, sep, value = args[1].partition("=")
+        if option == "--db" and sep:
+            path = value
+        elif option == "--db" and len(args) > 2:
+            path = args[2]
+            args = args[:1] + args[3:]
+            continue
+        elif option == "--stats":
+            show_stats = True
+            stats_path = value or None
+        elif option == "--profile":
+            profile = True
+            profile_path = value or None
+        else:
+            break
+        args = args[:1] + args[2:]
+    
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        run_command(path, args)
+    finally:
+        if profile:
+            profiler.disable()
+            print_profile(profiler, profile_path)
+        if show_stats:
+            print_stats(stats_path)
+
+def run_command(path, args):
+    collection = RefCollection(path)
     
     if len(args) < 2:
         help(short=True)
@@ -29,7 +97,28 @@ ref.py <command> <arguments>
         help(short=True)
         return
     
-    plugins.commands[command](collection, args[2:])
+    with stats.timer("command."+command):
+        plugins.commands[command](collection, args[2:])
+
+def print_stats(path=None):
+    "Show the statistics of the run on stderr (with the cache counters), and save them if a path is given"
+    from plugins import cache
+    data = stats.report()
+    if cache.responses is not None:
+        data["counters"].update(cache.responses.counters())
+        data["counters"] = dict(sorted(data["counters"].items()))
+    print("", file=sys.stderr)
+    stats.print_report(data)
+    if path:
+        stats.dump(data, path)
+
+def print_profile(profiler, path=None, limit=25):
+    "Show the functions with the largest cumulative time on stderr, and save the profile if a path is given"
+    import pstats
+    if path:
+        profiler.dump_stats(path)
+    print("", file=sys.stderr)
+    pstats.Stats(profiler, stream=sys.stderr).sort_stats("cumulative").print_stats(limit)
 
 
 def get_short_doc(n):
@@ -108,6 +197,15 @@ Note: when a match is found by several metadata providers, it saves alternative
         print( "Found "+key )
         print(ref)
         print()
+        duplicate = collection.find_duplicate(ref)
+        if duplicate:
+            refkey, exact = duplicate
+            if exact:
+                print("Already in the collection: "+refkey)
+                continue
+            print("Possible duplicate of [%s]" % refkey)
+            print(collection.get(refkey).short())
+            print()
         askAdd = input("Add this ref? [y/N] ")
         if askAdd.strip().lower() == "y":
             key = collection.add_reference(ref)
@@ -116,29 +214,309 @@ Note: when a match is found by several metadata providers, it saves alternative
         else:
             print("NOT added")
 
-def do_lookup(key):
+def do_lookup(key, timeout=LOOKUP_TIMEOUT, errors=None):
+    """Call the providers which accept the kind of identifier given as key.
+Providers are called by increasing priority: all providers with the same priority are called at once,
+and the next ones are only called if none of them found a match and stops the lookup ("stop_when_found").
+The match of the first provider (by priority, then in registration order) is the main ref,
+matches from the other providers are added as alternatives.
+A provider which does not answer within its timeout is ignored.
+If a list is given as "errors", the names of failing providers are added to it."""
+
+    kind, value = ident.classify(key)
+    tiers = plugins.provider_tiers(kind)
+    if not tiers:
+        return None
+
+    from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+    pool = ThreadPoolExecutor(max_workers=max( len(tier) for tier in tiers ))
     main_ref = None
-    for p in plugins.providers:
+    for tier in tiers:
+        start = time.time()
+        futures = [ pool.submit(plugins.load_ref, p, key) for p in tier ]
+
+        found = False
+        for p,future in zip(tier, futures):
+            deadline = start + getattr(p, "timeout", timeout)
+            try:
+                ref = future.result( max(0, deadline - time.time()) )
+            except FutureTimeout:
+                print("timeout in "+p.name)
+                stats.count("provider.%s.timeouts" % p.name)
+                ref = None
+                if errors is not None: errors.append(p.name)
+            except:
+                print("error in "+p.name)
+                ref = None
+                if errors is not None: errors.append(p.name)
+
+            if not ref:
+                continue
+
+            ref = Ref(ref)
+            if main_ref:
+                main_ref.add_alternative(ref)
+            else:
+                main_ref = ref
+            if getattr(p, "stop_when_found", False):
+                found = True
+
+        if found:
+            break
+
+    # do not wait for providers which timed out
+    pool.shutdown(wait=False)
+    return main_ref
+
+async def ado_lookup(key, timeout=LOOKUP_TIMEOUT, errors=None):
+    """Asynchronous variant of do_lookup, to be called from an event loop.
+Asynchronous providers run in the loop, the others in threads (see plugins.aload_ref)."""
+    # asyncio is only imported by the commands which use it (it slows down the start of the others)
+    import asyncio
+
+    kind, value = ident.classify(key)
+    main_ref = None
+    for tier in plugins.provider_tiers(kind):
+        results = await asyncio.gather( *[ asyncio.wait_for(plugins.aload_ref(p, key), getattr(p, "timeout", timeout))
+                                           for p in tier ], return_exceptions=True )
+
+        found = False
+        for p,ref in zip(tier, results):
+            if isinstance(ref, asyncio.TimeoutError):
+                print("timeout in "+p.name)
+                stats.count("provider.%s.timeouts" % p.name)
+                ref = None
+                if errors is not None: errors.append(p.name)
+            elif isinstance(ref, BaseException):
+                print("error in "+p.name)
+                ref = None
+                if errors is not None: errors.append(p.name)
+
+            if not ref:
+                continue
+
+            ref = Ref(ref)
+            if main_ref:
+                main_ref.add_alternative(ref)
+            else:
+                main_ref = ref
+            if getattr(p, "stop_when_found", False):
+                found = True
+
+        if found:
+            break
+
+    return main_ref
+
+@plugins.command_aliases("bl")
+def batch(collection, args):
+    """Lookup many references without asking for confirmation.
+The identifiers are read (one per line) from the given files, or from the
+standard input if no file (or "-") is given. Several identifiers are resolved
+at the same time and all matches are added to the collection.
+
+Usage: batch [--async] [--force] [-j <jobs>] [file1 file2 ...]
+
+With --async, the lookups run in a single thread using the asynchronous providers,
+which allows many more simultaneous lookups.
+Matches which are already in the collection (same DOI or pubmed ID) are skipped,
+unless the --force option is given. Matches which are very similar to a stored ref
+are added, and reported as possible duplicates.
+The collection is saved every SAVE_INTERVAL matches, and when the batch stops
+(even if it is interrupted)."""
+
+    use_async = False
+    force = False
+    jobs = None
+    while args and args[0].startswith("-") and args[0] != "-":
+        if args[0] == "--async":
+            use_async = True
+            args = args[1:]
+        elif args[0] == "--force":
+            force = True
+            args = args[1:]
+        elif args[0] == "-j" and len(args) > 1:
+            jobs = int(args[1])
+            args = args[2:]
+        else:
+            print("Unknown option: "+args[0])
+            return
+    if jobs is None:
+        jobs = ASYNC_JOBS if use_async else BATCH_JOBS
+    if not args:
+        args = ["-"]
+
+    matched, unmatched, failed, duplicates, possible = [], [], [], [], []
+    if not force:
+        # build the index before the lookups, not in the middle of them (or on the event loop)
+        collection.get_duplicate_index()
+
+    def report(key, ref, errors):
+        duplicate = None
         try:
-            ref = p.load_ref(key)
-        except:
-            print("error in "+p.name)
+            if ref and not force:
+                duplicate = collection.find_duplicate(ref)
+            if ref and not (duplicate and duplicate[1]):
+                refkey = collection.add_reference(ref)
+        except Exception as e:
+            # e.g. a match without authors, which gets no key
             ref = None
-        
-        if not ref:
+            errors.append("%s: %s" % (type(e).__name__, e))
+        if duplicate and duplicate[1]:
+            duplicates.append(key)
+            print("Already in the collection %s: %s" % (key, duplicate[0]))
+        elif ref:
+            matched.append(key)
+            if duplicate:
+                possible.append(refkey)
+                print("Found %s: %s (possible duplicate of %s)" % (key, refkey, duplicate[0]))
+            else:
+                print("Found %s: %s" % (key, refkey))
+            if len(matched) % SAVE_INTERVAL == 0:
+                collection.save()
+        elif errors:
+            failed.append(key)
+            print("FAILED for %s (%s)" % (key, ", ".join(errors)))
+        else:
+            unmatched.append(key)
+            print("NO MATCH for "+key)
+
+    try:
+        if use_async:
+            import asyncio
+            asyncio.run( batch_async(read_identifiers(args), jobs, report) )
+        else:
+            batch_threads(read_identifiers(args), jobs, report)
+    finally:
+        # keep the matches found before an error or an interruption
+        collection.save()
+
+    print()
+    print("Matched: %s, duplicates: %s, unmatched: %s, failed: %s" % (len(matched), len(duplicates), len(unmatched), len(failed)))
+    if unmatched:
+        print("Unmatched keys: "+" ".join(unmatched))
+    if failed:
+        print("Failed keys: "+" ".join(failed))
+    if possible:
+        print("Possible duplicates: "+" ".join(possible))
+
+def batch_threads(identifiers, jobs, report):
+    "Lookup identifiers in a pool of 'jobs' threads"
+    from concurrent.futures import ThreadPoolExecutor
+    pool = ThreadPoolExecutor(max_workers=jobs)
+    pending = deque()
+
+    def collect():
+        key, errors, future = pending.popleft()
+        try:
+            ref = future.result()
+        except Exception as e:
+            ref = None
+            errors.append("%s: %s" % (type(e).__name__, e))
+        report(key, ref, errors)
+
+    try:
+        for block in read_blocks(identifiers, PREFETCH_SIZE):
+            prefetch(block)
+            for key in block:
+                errors = []
+                pending.append( (key, errors, pool.submit(do_lookup, key, errors=errors)) )
+                # keep a bounded number of lookups in flight
+                if len(pending) >= 2*jobs:
+                    collect()
+        while pending:
+            collect()
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+async def batch_async(identifiers, jobs, report):
+    "Lookup identifiers from an event loop, with at most 'jobs' lookups in flight"
+    import asyncio
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(jobs)
+    running = set()
+
+    async def lookup(key):
+        errors = []
+        try:
+            ref = await ado_lookup(key, errors=errors)
+        except Exception as e:
+            ref = None
+            errors.append("%s: %s" % (type(e).__name__, e))
+        finally:
+            slots.release()
+        report(key, ref, errors)
+
+    for block in read_blocks(identifiers, PREFETCH_SIZE):
+        # prefetching is synchronous: run it in a thread to keep the lookups going
+        await loop.run_in_executor(None, prefetch, block)
+        for key in block:
+            await slots.acquire()
+            task = asyncio.ensure_future(lookup(key))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    if running:
+        await asyncio.wait(running)
+
+def prefetch(keys):
+    "Let the providers which support it load a group of identifiers in a few requests"
+    for p in plugins.providers:
+        if hasattr(p, "prefetch"):
+            try:
+                p.prefetch(keys)
+            except:
+                print("error in "+p.name)
+
+def read_blocks(iterable, size):
+    block = []
+    for item in iterable:
+        block.append(item)
+        if len(block) >= size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+def read_identifiers(paths):
+    "Iterate over the identifiers listed in a set of files (one per line, '-' for stdin)"
+    for path in paths:
+        if path == "-":
+            f = sys.stdin
+        elif not os.path.isfile(path):
+            print("no such file: "+path)
             continue
-        
-        ref = Ref(ref)
-        if main_ref:
-            main_ref.add_alternative(ref)
         else:
-            main_ref = ref
-    
-    return main_ref
+            f = open(path)
+
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield line
+
+        if f is not sys.stdin:
+            f.close()
 
 @plugins.command_aliases("import")
 def import_file(collection, args):
-    """Import an existing file in the collection"""
+    """Import an existing file in the collection
+Usage: import [-j <processes>] [--force] file1 file2 ...
+
+With the -j option, files are parsed in several processes (if the importer supports it).
+Refs which are already in the collection (same DOI or pubmed ID, or a very similar title,
+first author and year) are skipped, unless the --force option is given."""
+
+    processes = 1
+    force = False
+    while args and args[0].startswith("-"):
+        if args[0] == "--force":
+            force = True
+            args = args[1:]
+        elif args[0] == "-j" and len(args) > 1:
+            processes = int(args[1])
+            args = args[2:]
+        else:
+            print("Unknown option: "+args[0])
+            return
 
     for path in args:
         if not os.path.exists(path):
@@ -151,30 +529,77 @@ def import_file(collection, args):
             return
         
         p = plugins.importers[extension]
+        # the parsed refs are kept in a temporary file to add them without parsing the file again
+        import tempfile
+        spool = tempfile.TemporaryFile("w+")
         try:
-            refs = p.import_file(path)
-        except:
-            print("error in "+p.name)
+            preview_and_add(collection, p, path, processes, force, spool)
+        finally:
+            spool.close()
+
+def preview_and_add(collection, importer, path, processes, force, spool):
+    "Show the refs of a file and add them after confirmation"
+    count = 0
+    known = 0
+    try:
+        # importers produce the refs one by one, only show them for now
+        for ref in read_file(importer, path, processes):
+            spool.write(json.dumps(ref))
+            spool.write("\n")
+            ref = Ref(ref)
+            print(ref)
+            duplicate = collection.find_duplicate(ref)
+            if duplicate and duplicate[1]:
+                print("(already in the collection: %s)" % duplicate[0])
+                known += 1
+            elif duplicate:
+                print("(possible duplicate of %s)" % duplicate[0])
+            print()
+            count += 1
+    except Exception:
+        print("error in "+importer.name)
+        return
+    
+    if count < 1:
+        print("No ref found")
+        return
+    
+    if known and not force:
+        askAdd = input("Add these %s refs (%s already in the collection will be skipped)? [y/N] " % (count, known))
+    else:
+        askAdd = input("Add these %s refs? [y/N] " % count)
+    if askAdd.strip().lower() != "y":
+        print("NOT added")
+        return
+    
+    keys = []
+    skipped = []
+    possible = []
+    spool.seek(0)
+    for line in spool:
+        ref = Ref(json.loads(line))
+        # also catches duplicates inside the imported file
+        duplicate = None
+        if not force:
+            duplicate = collection.find_duplicate(ref)
+        if duplicate and duplicate[1]:
+            skipped.append(duplicate[0])
             continue
-        
-        l = len(refs)
-        if l < 1:
-            print("No ref found")
-            return
-        
-        refs = [ Ref(ref) for ref in refs ]
-        for r in refs:
-            print(r)
-        
-        askAdd = raw_input("Add these %s refs? [y/N] " % len(refs))
-        if askAdd.strip().lower() == "y":
-            keys = []
-            for ref in refs:
-                keys.append( collection.add_reference(ref) )
-            collection.save()
-            print("References added: ", keys)
-        else:
-            print("NOT added")
+        keys.append( collection.add_reference(ref) )
+        if duplicate:
+            possible.append( "%s (%s)" % (keys[-1], duplicate[0]) )
+    collection.save()
+    print("References added: ", keys)
+    if skipped:
+        print("Duplicates skipped: ", skipped)
+    if possible:
+        print("Possible duplicates added: ", possible)
+
+
+def read_file(importer, path, processes=1):
+    if processes > 1:
+        return importer.import_file(path, processes=processes)
+    return importer.import_file(path)
 
 
 @plugins.command_aliases("ls,l")
@@ -192,11 +617,22 @@ def list(collection, args):
 @plugins.add_command
 def search(collection, args):
     """Search in the stored references
-NOT YET IMPLEMENTED"""
+Usage: search <word1> <word2> ...
+
+References must match all words, which can be the start of a word in the title,
+authors, journal or year. Words can be restricted to a field: author:Naldi year:2015"""
     
     result = collection.search(args)
-    if result:
-        print(result)
+    if not result:
+        print("No match")
+        return
+    
+    for key,ref in result[:SEARCH_LIMIT]:
+        print("[%s]" % key)
+        print( ref.short() )
+        print()
+    if len(result) > SEARCH_LIMIT:
+        print("... %s more matches" % (len(result) - SEARCH_LIMIT))
 
 @plugins.add_command
 def show(collection, args):
@@ -221,6 +657,31 @@ Usage: save <ref1> <ref2> <dest_folder>"""
     for key in args[:-1]:
         collection.save_ref(key, destfolder)
 
+@plugins.add_command
+def convert(collection, args):
+    """Copy all stored references into another file.
+Usage: convert <destination>
+
+The format of the destination depends on its extension (see the --db option)."""
+    if len(args) != 1:
+        print("Usage: convert <destination>")
+        return
+    
+    destination = RefCollection(args[0])
+    if destination.keys():
+        print("The destination must be empty")
+        return
+    
+    refs = collection.get_references()
+    for key in sorted(refs.keys()):
+        ref = refs[key]
+        meta = ref.get_meta()
+        meta["alternatives"] = [ alt.get_meta() for alt in ref.alternatives ]
+        destination.add_reference(Ref(meta), key)
+    destination.save()
+    destination.storage.close()
+    print("%s references copied" % len(refs))
+
 if __name__ == "__main__":
     main( sys.argv )
 
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+"""Timers and counters for the hot paths of the CLI.
+
+Timers accumulate the number of calls, the total and the longest duration
+of an operation (loading the plugins or the collection, calling a provider...),
+counters are plain numbers (calls, matches and errors of providers...).
+They are always collected, as they only cost a few microseconds per call,
+and shown with the --stats option of ref.py.
+"""
+
+from __future__ import print_function
+import functools
+import threading
+import json
+import time
+import sys
+
+# name -> [calls, total time, longest time] (times in seconds)
+timers = {}
+# name -> number
+counters = {}
+
+_lock = threading.Lock()
+
+
+class timer:
+    "Context manager adding the time spent in its block to a timer"
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add_time(self.name, time.perf_counter() - self.start)
+
+def timed(name):
+    "Decorator adding the time spent in each call of a function to a timer"
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                add_time(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+def add_time(name, seconds):
+    with _lock:
+        t = timers.get(name)
+        if t is None:
+            timers[name] = [1, seconds, seconds]
+        else:
+            t[0] += 1
+            t[1] += seconds
+            if seconds > t[2]:
+                t[2] = seconds
+
+def count(name, n=1):
+    with _lock:
+        counters[name] = counters.get(name, 0) + n
+
+def reset():
+    with _lock:
+        timers.clear()
+        counters.clear()
+
+
+def report():
+    "Snapshot of the timers and counters, as a JSON-compatible dict"
+    with _lock:
+        return {
+            "timers": dict( (name, {"calls": calls, "total": round(total, 6), "mean": round(total / calls, 6), "max": round(longest, 6)})
+                            for name,(calls,total,longest) in sorted(timers.items()) ),
+            "counters": dict(sorted(counters.items())),
+        }
+
+def print_report(data, out=sys.stderr):
+    "Print a report as two tables"
+    if data["timers"]:
+        width = max( len(name) for name in data["timers"] )
+        print("%-*s %8s %10s %10s %10s" % (width, "timer", "calls", "total", "mean", "max"), file=out)
+        for name,t in data["timers"].items():
+            print("%-*s %8s %9.4fs %9.4fs %9.4fs" % (width, name, t["calls"], t["total"], t["mean"], t["max"]), file=out)
+    if data["counters"]:
+        width = max( len(name) for name in data["counters"] )
+        print("%-*s %8s" % (width, "counter", "value"), file=out)
+        for name,value in data["counters"].items():
+            print("%-*s %8s" % (width, name, value), file=out)
+
+def dump(data, path):
+    f = open(path, "w")
+    json.dump(data, f, indent=1)
+    f.close()
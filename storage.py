@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+
+"""Storage backends for the collection of references.
+
+A storage loads the metadata of references (as dicts) and saves Ref objects.
+Eager storages load everything at once ("load_all"), lazy storages load refs
+on demand ("keys", "contains" and "load"), and can answer link and tag queries
+by themselves ("find" and "tagged") and give the fields compared to find
+duplicates without loading the refs ("duplicate_items").
+"""
+
+from __future__ import print_function
+import marshal
+import mmap
+import sys
+import struct
+import json
+import os
+
+# version of the marshal format used in binary files (stable since python 3.4)
+MARSHAL_VERSION = 4
+
+# the journal is merged into the main file when it has more entries
+# than this or than a quarter of the collection
+JOURNAL_MIN_SIZE = 1000
+
+# fields of the metadata compared to find duplicates (see DuplicateIndex)
+DUPLICATE_FIELDS = ("title", "authors", "year", "journal", "links")
+
+
+class JSONStorage:
+    """Save all refs in a JSON file.
+    Changes are first appended to a journal file, which is merged
+    into the main file when it becomes too large.
+    The journal only makes saves cheaper: the whole main file is still parsed
+    when the collection is opened (use a lazy storage for large collections).
+    """
+
+    lazy = False
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.journal_size = 0
+        self.journal_broken = False
+
+    def load_all(self):
+        "Return a dict associating keys to the metadata of refs"
+        rawrefs = {}
+        if os.path.isfile(self.path):
+            f = open(self.path)
+            rawrefs = json.load(f)
+            f.close()
+
+        # replay the changes saved after the last compaction
+        if os.path.isfile(self.journal_path):
+            f = open(self.journal_path)
+            for line in f:
+                try:
+                    change = json.loads(line)
+                except ValueError:
+                    # incomplete write, ignore it and rewrite everything on the next save
+                    print("Ignoring a broken entry in "+self.journal_path)
+                    self.journal_broken = True
+                    continue
+                rawrefs[change["key"]] = change["ref"]
+                self.journal_size += 1
+            f.close()
+
+        return rawrefs
+
+    def save(self, refs, dirty, added=(), rekey=None):
+        "Save the refs which changed since the last save in the journal"
+        if self.journal_broken or self.journal_size + len(dirty) > max(JOURNAL_MIN_SIZE, len(refs) / 4):
+            self.compact(refs)
+            return
+
+        f = open(self.journal_path, "a")
+        for key in sorted(dirty):
+            f.write( json.dumps( {"key": key, "ref": refs[key].get_meta()} ) )
+            f.write("\n")
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        self.journal_size += len(dirty)
+
+    def compact(self, refs):
+        "Rewrite the whole collection in the main file and clear the journal"
+        encoder = json.JSONEncoder()
+        tmp_path = self.path + ".tmp"
+        f = open(tmp_path, "w")
+        f.write("{\n")
+        isfirst = True
+        for key in sorted(refs.keys()):
+            ref = refs[key]
+            if isfirst:
+                isfirst = False
+            else:
+                f.write(",\n")
+
+            f.write('"%s": %s' % (key,ref.encode(encoder)) )
+
+        f.write("\n}\n")
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+
+        # replace the main file at once, the journal is then obsolete
+        os.replace(tmp_path, self.path)
+        if os.path.isfile(self.journal_path):
+            os.remove(self.journal_path)
+        self.journal_size = 0
+        self.journal_broken = False
+
+    def close(self):
+        pass
+
+
+class SQLiteStorage:
+    """Save refs in a SQLite database.
+    Links, tags and alternatives are kept in indexed tables: refs are loaded
+    on demand and link or tag queries are answered by the database.
+    The database can be shared by several processes.
+    """
+
+    lazy = True
+
+    def __init__(self, path):
+        self.path = path
+        # only imported by the commands which open a SQLite collection
+        import sqlite3
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS refs (key TEXT PRIMARY KEY, meta TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS links (key TEXT, type TEXT, value TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS tags (key TEXT, tag TEXT)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS alternatives (key TEXT, position INTEGER, meta TEXT)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS links_value ON links(type,value)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS links_key ON links(key)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS tags_tag ON tags(tag)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS tags_key ON tags(key)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS alternatives_key ON alternatives(key)")
+
+    def keys(self):
+        return [ row[0] for row in self.db.execute("SELECT key FROM refs") ]
+
+    def load(self, key):
+        "Load the metadata of a ref (and its alternatives), None if it is missing"
+        row = self.db.execute("SELECT meta FROM refs WHERE key=?", (key,)).fetchone()
+        if not row:
+            return None
+
+        meta = json.loads(row[0])
+        rows = self.db.execute("SELECT meta FROM alternatives WHERE key=? ORDER BY position", (key,)).fetchall()
+        if rows:
+            meta["alternatives"] = [ json.loads(row[0]) for row in rows ]
+        return meta
+
+    def load_all(self):
+        rawrefs = dict( (key, json.loads(meta)) for key,meta in self.db.execute("SELECT key,meta FROM refs") )
+        for key,meta in self.db.execute("SELECT key,meta FROM alternatives ORDER BY key,position"):
+            rawrefs[key].setdefault("alternatives", []).append( json.loads(meta) )
+        return rawrefs
+
+    def find(self, link, value):
+        "Get the key of the first ref with a given link"
+        row = self.db.execute("SELECT key FROM links WHERE type=? AND value=? ORDER BY rowid LIMIT 1", (link,value)).fetchone()
+        if row:
+            return row[0]
+
+    def tagged(self, tag):
+        return [ row[0] for row in self.db.execute("SELECT key FROM tags WHERE tag=?", (tag,)) ]
+
+    def duplicate_items(self):
+        """Iterate over the keys and the fields compared to find duplicates (title, first author,
+        year, journal, DOI and pubmed ID) of all refs, without decoding the rest of their metadata"""
+        links = {}
+        for key,link,value in self.db.execute("SELECT key,type,value FROM links WHERE type IN ('doi','pmid')"):
+            links.setdefault(key, {})[link] = value
+        rows = self.db.execute("SELECT key, json_extract(meta, '$.title'), json_extract(meta, '$.authors[0]'), "
+                               "json_extract(meta, '$.year'), json_extract(meta, '$.journal') FROM refs")
+        for key,title,author,year,journal in rows:
+            meta = {"title": title or "", "year": year, "journal": journal, "links": links.get(key)}
+            if author:
+                meta["authors"] = [ json.loads(author) ]
+            yield key, meta
+
+    def contains(self, key):
+        return self.db.execute("SELECT 1 FROM refs WHERE key=?", (key,)).fetchone() is not None
+
+    def save(self, refs, dirty, added=(), rekey=None):
+        """Save the refs which changed since the last save, in a single transaction.
+        The refs added since then are inserted: if another process saved a ref with the same key
+        in the meantime, the ref is moved to the key given by rekey(key).
+        """
+        import sqlite3
+        with self.db:
+            for key in sorted(dirty):
+                meta = json.dumps(refs[key].get_meta())
+                if key not in added:
+                    self.db.execute("INSERT OR REPLACE INTO refs VALUES (?,?)", (key, meta))
+                else:
+                    while True:
+                        try:
+                            self.db.execute("INSERT INTO refs VALUES (?,?)", (key, meta))
+                            break
+                        except sqlite3.IntegrityError:
+                            key = rekey(key)
+                ref = refs[key]
+                self.db.execute("DELETE FROM links WHERE key=?", (key,))
+                self.db.execute("DELETE FROM tags WHERE key=?", (key,))
+                self.db.execute("DELETE FROM alternatives WHERE key=?", (key,))
+                self.db.executemany("INSERT INTO links VALUES (?,?,?)",
+                                    [ (key, link, value) for link,value in ref.links.items() ])
+                self.db.executemany("INSERT INTO tags VALUES (?,?)", [ (key, tag) for tag in ref.tags ])
+                self.db.executemany("INSERT INTO alternatives VALUES (?,?,?)",
+                                    [ (key, idx, json.dumps(alt.get_meta())) for idx,alt in enumerate(ref.alternatives) ])
+
+    def close(self):
+        self.db.close()
+
+
+class BinaryStorage:
+    """Save all refs in a compact binary file, faster to save than JSON.
+    The file contains a header, the records sorted by key, a table of record offsets and a footer.
+    Each record is made of the lengths of the key and of the data, the key (utf-8) and
+    the metadata of the ref (with its alternatives) serialized with marshal.
+    The file is memory-mapped: refs are decoded only when they are needed.
+    """
+
+    lazy = True
+
+    def __init__(self, path):
+        self.path = path
+        self.mapped = None
+        if os.path.isfile(path):
+            self.mapped = MappedRefFile(path)
+
+    def keys(self):
+        if self.mapped is None:
+            return []
+        return self.mapped.keys()
+
+    def contains(self, key):
+        return self.mapped is not None and self.mapped.index(key) >= 0
+
+    def load(self, key):
+        if self.mapped is None:
+            return None
+        return self.mapped.load(key)
+
+    def load_all(self):
+        if self.mapped is None:
+            return {}
+        return dict( self.mapped.items() )
+
+    def duplicate_items(self):
+        "Iterate over the keys and the fields compared to find duplicates of all refs, one record at a time"
+        if self.mapped is None:
+            return
+        for key,meta in self.mapped.items():
+            yield key, dict( (field, meta[field]) for field in DUPLICATE_FIELDS if field in meta )
+
+    def save(self, refs, dirty, added=(), rekey=None):
+        """Rewrite the whole file.
+        The records of refs which have not been loaded are copied without decoding them.
+        """
+        records = {}
+        if self.mapped is not None:
+            records = dict( self.mapped.raw_items() )
+        for key,ref in refs.items():
+            records[key] = encode_record(ref)
+        write_binary(self.path, sorted(records.items()))
+
+        if self.mapped is not None:
+            self.mapped.close()
+        self.mapped = MappedRefFile(self.path)
+
+    def close(self):
+        if self.mapped is not None:
+            self.mapped.close()
+            self.mapped = None
+
+
+class MappedRefFile:
+    """Read-only access to a binary collection file.
+    The file is memory-mapped (and shared by processes reading it), refs are found by a binary
+    search on the sorted keys through the table of offsets, and only the requested records are decoded.
+    """
+
+    def __init__(self, path):
+        f = open(path, "rb")
+        self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        self.data = memoryview(self.map)
+
+        table, self.count = read_footer(self.data, path)
+        offsets = self.data[table:table + OFFSET.size*self.count]
+        if sys.byteorder == "little":
+            self.offsets = offsets.cast("Q")
+        else:
+            self.offsets = [ o[0] for o in OFFSET.iter_unpack(offsets) ]
+
+    def key_at(self, idx):
+        pos = self.offsets[idx]
+        keylen, datalen = RECORD_HEADER.unpack_from(self.data, pos)
+        pos += RECORD_HEADER.size
+        return str(self.data[pos:pos+keylen], "utf-8")
+
+    def index(self, key):
+        "Position of a key in the file, -1 if it is missing"
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.key_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.key_at(low) == key:
+            return low
+        return -1
+
+    def load(self, key):
+        idx = self.index(key)
+        if idx < 0:
+            return None
+        key, meta, pos = read_record(self.data, self.offsets[idx])
+        return meta
+
+    def keys(self):
+        return [ self.key_at(idx) for idx in range(self.count) ]
+
+    def items(self):
+        "Decode all records, in the order of the file"
+        pos = len(BINARY_MAGIC)
+        for idx in range(self.count):
+            key, meta, pos = read_record(self.data, pos)
+            yield key, meta
+
+    def raw_items(self):
+        "Iterate over the keys and the (still encoded) data of all records"
+        for idx in range(self.count):
+            pos = self.offsets[idx]
+            keylen, datalen = RECORD_HEADER.unpack_from(self.data, pos)
+            pos += RECORD_HEADER.size
+            yield str(self.data[pos:pos+keylen], "utf-8"), bytes(self.data[pos+keylen:pos+keylen+datalen])
+
+    def close(self):
+        self.offsets = None
+        self.data.release()
+        self.map.close()
+
+
+BINARY_MAGIC = b"PYBREFS1"
+RECORD_HEADER = struct.Struct("<II")
+OFFSET = struct.Struct("<Q")
+# position of the table of offsets and number of records
+FOOTER = struct.Struct("<QQ")
+
+def read_footer(data, path):
+    "Get the position of the table of offsets and the number of records"
+    if bytes(data[:len(BINARY_MAGIC)]) != BINARY_MAGIC:
+        raise ValueError("Not a binary collection: "+path)
+    return FOOTER.unpack_from(data, len(data) - FOOTER.size)
+
+def read_record(data, pos):
+    "Decode the record at a given position, returns the key, the metadata and the position of the next record"
+    keylen, datalen = RECORD_HEADER.unpack_from(data, pos)
+    pos += RECORD_HEADER.size
+    key = str(data[pos:pos+keylen], "utf-8")
+    pos += keylen
+    meta = marshal.loads(data[pos:pos+datalen])
+    return key, meta, pos+datalen
+
+def encode_record(ref):
+    meta = ref.get_meta()
+    if ref.alternatives:
+        meta["alternatives"] = [ alt.get_meta() for alt in ref.alternatives ]
+    try:
+        return marshal.dumps(meta, MARSHAL_VERSION)
+    except ValueError:
+        # marshal only supports the exact builtin types
+        return marshal.dumps(plain(meta), MARSHAL_VERSION)
+
+def plain(value):
+    "Convert a value using subclasses of builtin types (for example parsed XML strings)"
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, dict):
+        return dict( (plain(k), plain(v)) for k,v in value.items() )
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [ plain(v) for v in value ]
+    return value
+
+def write_binary(path, items):
+    "Write a sorted list of (key, encoded record) pairs in a binary file, replacing it at once"
+    tmp_path = path + ".tmp"
+    f = open(tmp_path, "wb")
+    f.write(BINARY_MAGIC)
+    pos = len(BINARY_MAGIC)
+    offsets = []
+    chunk = []
+    for key,data in items:
+        bkey = key.encode("utf-8")
+        offsets.append(pos)
+        chunk.append(RECORD_HEADER.pack(len(bkey), len(data)))
+        chunk.append(bkey)
+        chunk.append(data)
+        pos += RECORD_HEADER.size + len(bkey) + len(data)
+        if len(chunk) > 3000:
+            f.write(b"".join(chunk))
+            chunk = []
+    f.write(b"".join(chunk))
+    f.write(struct.pack("<%sQ" % len(offsets), *offsets))
+    f.write(FOOTER.pack(pos, len(offsets)))
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+    os.replace(tmp_path, path)
+
+
+# storage classes associated to file extensions
+STORAGES = {
+    "json": JSONStorage,
+    "sqlite": SQLiteStorage,
+    "db": SQLiteStorage,
+    "refs": BinaryStorage,
+}
+
+def open_storage(path):
+    "Open the storage matching the extension of a file"
+    extension = os.path.splitext(path)[1][1:].lower()
+    if extension not in STORAGES:
+        raise ValueError("No storage for "+path)
+    return STORAGES[extension](path)
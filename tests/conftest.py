@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+
+# the tests never use the persistent cache nor the network
+os.environ["REF_CACHE"] = ""
+os.environ.pop("REF_OFFLINE", None)
+os.environ.pop("REF_DB", None)
+
+from plugins import mockserver as mod_mock
+from plugins import webclient as mod_web
+from plugins import cache as mod_cache
+import synthetic
+
+
+@pytest.fixture
+def mock_server(monkeypatch):
+    "Mock server serving 20 synthetic refs, which receives all requests of the providers"
+    server = mod_mock.MockServer( mod_mock.Corpus(synthetic.make_corpus(20)) ).start()
+    monkeypatch.setattr(mod_web, "MOCK_SERVER", server.url)
+    monkeypatch.setattr(mod_cache, "responses", None)
+    yield server
+    server.stop()
@@ -0,0 +1,49 @@
+import pytest
+
+from __init__ import Ref, RefCollection
+from plugins import bibtex as mod_bibtex
+import synthetic
+
+pytestmark = pytest.mark.skipif(not mod_bibtex._HAS_DEPS, reason="requires bibtexparser")
+
+
+def entry(key, ref):
+    "A bibtex entry converted one field at a time, as the exporter did before caching conversions"
+    fields = []
+    bib_authors = []
+    for last,given in ref["authors"]:
+        if given:
+            bib_authors.append( "{%s}, {%s}" % (last,'%s.'%given[0]) )
+        else:
+            bib_authors.append( "{%s}" % last )
+    fields.append( ("author", " and ".join( bib_authors ) ) )
+    for meta_key, bibtex_key in mod_bibtex.meta2bibtex:
+        if meta_key in ref:
+            fields.append( (bibtex_key, "%s" % ref[meta_key]) )
+    ret = "@article{%s" % key
+    for k,v in fields:
+        ret += ",\n  %s = {%s}" % (k,mod_bibtex.string_to_latex(v))
+    ret += "\n}\n"
+    return ret
+
+def test_export(tmp_path, monkeypatch, capsys):
+    path = str(tmp_path / "refs.json")
+    collection = RefCollection(path)
+    for key,meta in synthetic.make_corpus(120):
+        collection.add_reference(Ref(meta), key)
+    collection.add_reference(Ref({"title": "Café & co: 50% off", "authors": [["Müller", "Jürgen"], ["Ñandú", ""]],
+                                  "year": "2001", "journal": "Über {braces}", "tags": ["lab"]}), "Muller2001")
+    collection.save()
+    # several chunks
+    monkeypatch.setattr(mod_bibtex, "EXPORT_CHUNK_SIZE", 30)
+
+    for tag in (None, "lab"):
+        output = str(tmp_path / ("%s.bib" % tag))
+        mod_bibtex.bibtex(RefCollection(path), [output] + ([tag] if tag else []))
+        refs = sorted( (key,ref) for key,ref in collection.refs.items() if tag is None or tag in ref.tags )
+        expected = "".join( entry(key, ref.get_meta()) + "\n\n" for key,ref in refs )
+        f = open(output)
+        assert f.read() == expected
+        f.close()
+        assert "%s references exported" % len(refs) in capsys.readouterr().out
+    assert len(refs) == 13
@@ -0,0 +1,79 @@
+import pytest
+
+from plugins import bibtex as mod_bibtex
+import synthetic
+
+pytestmark = pytest.mark.skipif(not mod_bibtex._HAS_DEPS, reason="requires bibtexparser")
+
+TRICKY = r'''@string{nat = "Nature"}
+
+@article{Quoted2001,
+  author = {Doe, Jane and Roe, Richard},
+  title = "A { brace in quotes",
+  journal = nat,
+  year = {2001}
+}
+
+@article(Paren2002,
+  author = {M{\"u}ller, Hans},
+  title = {Entry delimited by (parentheses)},
+  journal = {Journal of {Nested} Braces},
+  year = 2002
+)
+
+@comment{ignored @article{Comment2000, title = {not an entry}} }
+
+@article{Escaped2003,
+  author = {Smith, John},
+  title = {An escaped quote \" in braces},
+  journal = {J},
+  year = {2003}
+}
+
+@article{Balanced2004,
+  author = {Doe, Jane},
+  title = "A {B}alanced brace in quotes",
+  journal = {J},
+  year = {2004}
+}
+'''
+
+
+def whole_file(path):
+    "Refs of a bibtex file parsed at once, as the importer did before parsing by runs"
+    f = open(path)
+    text = f.read()
+    f.close()
+    parser = mod_bibtex.BibTexParser(customization=mod_bibtex.customize_bibtex)
+    return mod_bibtex.BiBTeXProvider().refs_from_entries( parser.parse(text).entries )
+
+def test_runs_match_whole_file(tmp_path, monkeypatch):
+    path = str(tmp_path / "refs.bib")
+    synthetic.write_bibtex(path, 250)
+    # several runs, with a string definition used by all of them
+    monkeypatch.setattr(mod_bibtex, "RUN_SIZE", 40)
+    refs = list( mod_bibtex.BiBTeXProvider().import_file(path) )
+    assert len(refs) == 250
+    assert refs == whole_file(path)
+
+def test_tricky_entries(tmp_path):
+    path = tmp_path / "tricky.bib"
+    path.write_text(TRICKY)
+    refs = list( mod_bibtex.BiBTeXProvider().import_file(str(path)) )
+    # the unbalanced brace in quotes is invalid for the parser, but it does not hide the next entries
+    assert [ ref["year"] for ref in refs ] == ["2002", "2003", "2004"]
+    assert refs == whole_file(str(path))
+
+def test_split_quoted_brace():
+    entries = list( mod_bibtex.split_bibtex(TRICKY.splitlines(True)) )
+    assert [ mod_bibtex.entry_type(e) for e in entries ] == ["string", "article", "article", "comment", "article", "article"]
+    assert entries[1].rstrip().endswith("}")
+    assert entries[2].rstrip().endswith(")")
+
+def test_unbalanced_entry(tmp_path, capsys):
+    path = tmp_path / "broken.bib"
+    path.write_text('@article{Broken,\n  title = {Missing brace,\n  year = {1999}\n\n'
+                    '@article{Good2000,\n  author = {Doe, Jane},\n  title = {Fine},\n  journal = {J},\n  year = {2000}\n}\n')
+    refs = list( mod_bibtex.BiBTeXProvider().import_file(str(path)) )
+    assert [ ref["title"] for ref in refs ] == ["Fine"]
+    assert "Unbalanced bibtex entry" in capsys.readouterr().out
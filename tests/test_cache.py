@@ -0,0 +1,117 @@
+import time
+
+import pytest
+
+import ref as mod_ref
+from plugins import bibtex as mod_bibtex
+from plugins import cache as mod_cache
+from plugins import pubmed as mod_pubmed
+from plugins import webclient as mod_web
+import synthetic
+
+
+def make_cache(tmp_path, **settings):
+    return mod_cache.ResponseCache(str(tmp_path / "cache.sqlite"), **settings)
+
+def test_answers_and_misses(tmp_path):
+    cache = make_cache(tmp_path)
+    assert cache.get("doi", "10.1/a") is mod_cache.ABSENT
+    cache.put("doi", "10.1/a", {"title": "A"})
+    cache.put("doi", "10.1/b", None)
+    assert cache.get("doi", "10.1/a") == {"title": "A"}
+    assert cache.get("doi", "10.1/b") is None
+    assert cache.stats() == {"doi": (2, 1)}
+
+def test_expiration(tmp_path):
+    cache = make_cache(tmp_path, ttl=100, miss_ttl=10)
+    cache.put("doi", "found", {"title": "A"})
+    cache.put("doi", "missing", None)
+    db = cache.connect()
+    db.execute("UPDATE responses SET stamp = ?", (time.time() - 50,))
+    db.commit()
+    assert cache.get("doi", "found") == {"title": "A"}
+    # "not found" answers expire sooner
+    assert cache.get("doi", "missing") is mod_cache.ABSENT
+    assert cache.get("doi", "missing", stale=True) is None
+
+    cache.purge()
+    assert cache.stats() == {"doi": (1, 0)}
+
+def test_purge_without_ttl(tmp_path):
+    cache = make_cache(tmp_path, ttl=0, miss_ttl=0, max_entries=3)
+    for i in range(5):
+        cache.put("doi", str(i), {"title": str(i)})
+    db = cache.connect()
+    db.execute("UPDATE responses SET stamp = stamp - 1000000")
+    db.commit()
+    cache.purge()
+    # nothing expires, only the size limit applies
+    assert cache.stats() == {"doi": (3, 0)}
+    assert cache.get("doi", "4") == {"title": "4"}
+
+def test_cached_loader(tmp_path, monkeypatch):
+    monkeypatch.setattr(mod_cache, "responses", make_cache(tmp_path))
+    calls = []
+    def loader():
+        calls.append(1)
+        return None
+    assert mod_cache.cached("doi", "10.1/missing", loader) is None
+    assert mod_cache.cached("doi", "10.1/missing", loader) is None
+    assert len(calls) == 1
+
+    def failing():
+        raise OSError("network down")
+    with pytest.raises(OSError):
+        mod_cache.cached("doi", "10.1/other", failing)
+    assert mod_cache.get_cached("doi", "10.1/other") is mod_cache.ABSENT
+
+@pytest.mark.skipif(not mod_bibtex._HAS_DEPS, reason="requires bibtexparser")
+def test_lookups_cache_not_found(tmp_path, mock_server, monkeypatch):
+    monkeypatch.setattr(mod_cache, "responses", make_cache(tmp_path))
+    monkeypatch.setattr(mod_pubmed, "REQUEST_INTERVAL", 0)
+    monkeypatch.setattr(mod_pubmed, "API_KEY_INTERVAL", 0)
+    errors = []
+    assert mod_ref.do_lookup("10.1000/unknown", errors=errors) is None
+    assert not errors
+    requests = mock_server.requests
+    assert requests > 0
+    assert mod_ref.do_lookup("10.1000/unknown") is None
+    assert mock_server.requests == requests
+
+def test_errors_are_not_cached(tmp_path, mock_server, monkeypatch):
+    monkeypatch.setattr(mod_cache, "responses", make_cache(tmp_path))
+    monkeypatch.setattr(mod_web, "RETRIES", 0)
+    mock_server.error_rate = 1
+    url = "https://articles.example.org/Synthetic1"
+    errors = []
+    assert mod_ref.do_lookup(url, errors=errors) is None
+    assert errors
+    assert mod_cache.get_cached("meta", url) is mod_cache.ABSENT
+
+def test_size_limit(tmp_path, monkeypatch):
+    monkeypatch.setattr(mod_cache, "EVICTION_PERIOD", 10)
+    cache = make_cache(tmp_path, max_entries=25)
+    for i in range(100):
+        cache.put("pubmed", str(i), {"title": str(i)})
+    assert cache.stats()["pubmed"][0] <= 25 + 10
+    # the oldest answers are removed first
+    assert cache.get("pubmed", "99") == {"title": "99"}
+    assert cache.get("pubmed", "0") is mod_cache.ABSENT
+
+@pytest.mark.skipif(not mod_bibtex._HAS_DEPS, reason="requires bibtexparser")
+def test_offline_lookups(tmp_path, mock_server, monkeypatch):
+    monkeypatch.setattr(mod_cache, "responses", make_cache(tmp_path, ttl=10))
+    monkeypatch.setattr(mod_pubmed, "REQUEST_INTERVAL", 0)
+    monkeypatch.setattr(mod_pubmed, "API_KEY_INTERVAL", 0)
+    doi = synthetic.make_doi(1)
+    found = mod_ref.do_lookup(doi).get_meta()
+    db = mod_cache.responses.connect()
+    db.execute("UPDATE responses SET stamp = stamp - 100")
+    db.commit()
+
+    monkeypatch.setattr(mod_cache, "offline", True)
+    requests = mock_server.requests
+    # expired answers are used offline
+    assert mod_ref.do_lookup(doi).get_meta() == found
+    assert mod_ref.do_lookup(synthetic.make_doi(2)) is None
+    assert mock_server.requests == requests
@@ -0,0 +1,118 @@
+import json
+import os
+
+import pytest
+
+from __init__ import Ref, RefCollection
+import ref as mod_ref
+from plugins import bibtex as mod_bibtex
+from plugins import pubmed as mod_pubmed
+import synthetic
+
+
+def make_collection(path, tags=()):
+    collection = RefCollection(path)
+    collection.add_reference(Ref({"title": "Listed title", "authors": [["Doe", "Jane"]], "year": "2001",
+                                  "tags": list(tags)}))
+    collection.save()
+
+def test_db_option(tmp_path, capsys):
+    for option in ("--db=%s", "--db %s"):
+        path = str(tmp_path / ("refs%s.sqlite" % len(option)))
+        make_collection(path)
+        mod_ref.main( ["ref.py"] + (option % path).split(" ") + ["list"] )
+        assert "Listed title" in capsys.readouterr().out
+
+def test_empty_export(tmp_path):
+    path = str(tmp_path / "empty.json")
+    prefix = str(tmp_path / "out")
+    mod_ref.main( ["ref.py", "--db=" + path, "export", prefix] )
+    f = open(prefix + ".json")
+    assert json.load(f) == []
+    f.close()
+
+def test_export_tag_names(tmp_path):
+    path = str(tmp_path / "refs.json")
+    make_collection(path, tags=["../outside"])
+    os.mkdir(str(tmp_path / "export"))
+    mod_ref.main( ["ref.py", "--db=" + path, "export", "-f", "csl", "--tags", str(tmp_path / "export" / "out")] )
+    assert sorted(os.listdir(str(tmp_path / "export"))) == ["out-.._outside.json", "out.json"]
+    assert not os.path.exists(str(tmp_path / "outside.json"))
+
+def test_light_commands_skip_heavy_imports(tmp_path):
+    import subprocess
+    import sys
+    script = ("import runpy, sys; sys.argv = ['ref.py', '--db', %r, 'ls']; runpy.run_path('ref.py', run_name='__main__'); "
+              "print(sorted( m for m in ('asyncio', 'sqlite3', 'tempfile', 'difflib') if m in sys.modules ))") % str(tmp_path / "refs.json")
+    output = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(mod_ref.__file__),
+                            stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    assert output.strip().splitlines()[-1] == "[]"
+
+def test_batch_keeps_matches(tmp_path, monkeypatch, capsys):
+    path = str(tmp_path / "refs.json")
+    identifiers = tmp_path / "ids.txt"
+    identifiers.write_text("first\nno-authors\nbroken\nsecond\ninterrupt\nlast\n")
+    def lookup(key, errors=None):
+        if key == "broken":
+            raise RuntimeError("network down")
+        if key == "interrupt":
+            raise KeyboardInterrupt()
+        if key == "no-authors":
+            return Ref({"title": "Anonymous"})
+        return Ref({"title": key, "authors": [["Doe", "Jane"]], "year": "2001"})
+    monkeypatch.setattr(mod_ref, "do_lookup", lookup)
+    monkeypatch.setattr(mod_ref, "prefetch", lambda keys: None)
+    monkeypatch.setattr(mod_ref, "SAVE_INTERVAL", 1)
+    saves = []
+    save = RefCollection.save
+    monkeypatch.setattr(RefCollection, "save", lambda self: saves.append(len(self.dirty)) or save(self))
+    try:
+        mod_ref.main( ["ref.py", "--db=" + path, "batch", "-j", "1", str(identifiers)] )
+    except KeyboardInterrupt:
+        pass
+    else:
+        assert False, "the interruption was not raised"
+    out = capsys.readouterr().out
+    assert "FAILED for no-authors (TypeError" in out
+    assert "FAILED for broken (RuntimeError: network down)" in out
+    # saved after each match, and when interrupted
+    assert saves[:2] == [1, 1]
+    assert sorted( ref.title for ref in RefCollection(path).refs.values() ) == ["first", "second"]
+
+def test_export_tags_sharing_a_file(tmp_path, capsys):
+    path = str(tmp_path / "refs.json")
+    collection = RefCollection(path)
+    collection.add_reference(Ref({"title": "First", "authors": [["Doe", "Jane"]], "year": "2001", "tags": ["a/b"]}))
+    collection.add_reference(Ref({"title": "Second", "authors": [["Roe", "Rob"]], "year": "2002", "tags": ["a b", "a/b"]}))
+    collection.add_reference(Ref({"title": "Third", "authors": [["Moe", "Max"]], "year": "2003", "tags": ["a b"]}))
+    collection.save()
+    prefix = str(tmp_path / "out")
+    mod_ref.main( ["ref.py", "--db=" + path, "export", "-f", "csl", "--tags", prefix] )
+    f = open(prefix + "-a_b.json")
+    assert sorted( item["title"] for item in json.load(f) ) == ["First", "Second", "Third"]
+    f.close()
+
+    for jobs in ("x", "0"):
+        mod_ref.main( ["ref.py", "--db=" + path, "export", "-j", jobs, str(tmp_path / "bad")] )
+        assert capsys.readouterr().out.strip().endswith("<prefix> [tag]")
+    assert not os.path.exists(str(tmp_path / "bad.json"))
+
+@pytest.mark.skipif(not mod_bibtex._HAS_DEPS, reason="requires bibtexparser")
+def test_batch(tmp_path, mock_server, monkeypatch, capsys):
+    monkeypatch.setattr(mod_pubmed, "REQUEST_INTERVAL", 0)
+    monkeypatch.setattr(mod_pubmed, "API_KEY_INTERVAL", 0)
+    path = str(tmp_path / "refs.json")
+    identifiers = tmp_path / "ids.txt"
+    identifiers.write_text("# from the manuscript\n%s\n\n10.1000/unknown\n%s\n%s\n" %
+                           (synthetic.make_doi(1), synthetic.make_doi(2), synthetic.make_doi(3)))
+    for options in ([], ["--async"]):
+        mod_ref.main( ["ref.py", "--db=" + path, "batch"] + options + [str(identifiers)] )
+        out = capsys.readouterr().out
+        if not options:
+            assert "Matched: 3, duplicates: 0, unmatched: 1, failed: 0" in out
+        else:
+            # the matches of the first run are found in the collection
+            assert "Matched: 0, duplicates: 3, unmatched: 1, failed: 0" in out
+        assert "Unmatched keys: 10.1000/unknown" in out
+    titles = sorted( ref.title for ref in RefCollection(path).refs.values() )
+    assert titles == sorted( synthetic.make_title(i) for i in (1, 2, 3) )
@@ -0,0 +1,130 @@
+import json
+
+from __init__ import Ref, RefCollection
+
+
+def test_shared_links(tmp_path):
+    collection = RefCollection(str(tmp_path / "refs.json"))
+    first = collection.add_reference(Ref({"title": "First", "authors": [["Doe", "Jane"]], "year": "2001",
+                                          "links": {"doi": "10.1000/shared"}}))
+    second = collection.add_reference(Ref({"title": "Second", "authors": [["Roe", "Rob"]], "year": "2002",
+                                           "links": {"doi": "10.1000/shared"}}))
+    assert collection.find("doi", "10.1000/shared").key == first
+
+    collection.get(first).add_link("doi", "10.1000/first")
+    assert collection.find("doi", "10.1000/shared").key == second
+    assert collection.find("doi", "10.1000/first").key == first
+    # the same value again does not change which ref is found
+    collection.get(second).add_link("doi", "10.1000/shared")
+    assert collection.find("doi", "10.1000/shared").key == second
+
+    collection.get(first).add_link("doi", "10.1000/shared")
+    new_key = collection.rekey(second)
+    assert collection.find("doi", "10.1000/shared").key == first
+    collection.get(first).add_link("doi", "10.1000/first")
+    assert collection.find("doi", "10.1000/shared").key == new_key
+
+def linear_find(collection, link, value):
+    return set( key for key,ref in collection.refs.items() if ref.links.get(link) == value )
+
+def test_indexes_match_linear_scans(tmp_path):
+    import random
+    rng = random.Random(7)
+    collection = RefCollection(str(tmp_path / "refs.json"))
+    for i in range(200):
+        meta = {"title": "Title %s" % i, "authors": [["Doe", "Jane"]], "year": "2001"}
+        if rng.random() < 0.7:
+            meta["links"] = {"doi": "10.1000/%s" % rng.randrange(50)}
+        if rng.random() < 0.5:
+            meta["tags"] = ["t%s" % rng.randrange(5)]
+        collection.add_reference(Ref(meta))
+    keys = sorted(collection.refs)
+    for i in range(300):
+        ref = collection.get(rng.choice(keys))
+        if rng.random() < 0.5:
+            ref.add_link( rng.choice(("doi", "pmid")), "10.1000/%s" % rng.randrange(50) )
+        else:
+            ref.add_tag("t%s" % rng.randrange(8))
+    for key in rng.sample(keys, 20):
+        keys.remove(key)
+        keys.append( collection.rekey(key) )
+
+    for link in ("doi", "pmid"):
+        for i in range(50):
+            value = "10.1000/%s" % i
+            found = collection.find(link, value)
+            expected = linear_find(collection, link, value)
+            assert set( collection.link_index.get((link, value), ()) ) == expected
+            if expected:
+                assert found.key in expected
+            else:
+                assert found is None
+    for i in range(8):
+        tag = "t%s" % i
+        tagged = set( key for key,ref in collection.refs.items() if tag in ref.tags )
+        assert set(collection.get_references(tag)) == tagged
+
+def test_tags_after_rekey(tmp_path):
+    path = str(tmp_path / "refs.sqlite")
+    first = RefCollection(path)
+    second = RefCollection(path)
+    meta = {"title": "Tagged", "authors": [["Doe", "Jane"]], "year": "2001", "tags": ["todo"], "links": {"pmid": "1"}}
+    first.add_reference(Ref(meta))
+    second.add_reference(Ref(dict(meta, title="Other", links={"pmid": "2"})))
+    second.save()
+    first.save()
+    assert set(first.get_references("todo")) == {"Doe2001", "Doe2001a"}
+    assert first.find("pmid", "1").key == "Doe2001a"
+    assert first.find("pmid", "2").key == "Doe2001"
+
+def test_ref_round_trip():
+    meta = {"title": "A title", "authors": [["Doe", "Jane"], ["Roe", "Rob"]], "year": "2001", "journal": "J",
+            "volume": "3", "issue": "2", "pages": "1-10", "links": {"doi": "10.1000/a"}, "tags": ["b", "a"]}
+    ref = Ref(dict(meta, title="A title.", note="unknown field", alternatives=[ {"title": "Preprint", "year": "2000"} ]))
+    assert not hasattr(ref, "__dict__")
+    assert ref.get_meta() == dict(meta, authors=(("Doe", "Jane"), ("Roe", "Rob")), tags=["a", "b"])
+    assert Ref(ref.get_meta()).get_meta() == ref.get_meta()
+    assert json.loads(ref.encode(json.JSONEncoder())) == dict(meta, tags=["a", "b"])
+    assert ref.missed == [("note", "unknown field")]
+    assert [ alt.title for alt in ref.alternatives ] == ["Preprint"]
+
+    other = Ref({"title": "Other", "authors": [["Doe", "Jane"]], "year": "2001", "journal": "J"})
+    # repeated values are shared
+    assert other.authors[0] is ref.authors[0]
+    assert other.journal is ref.journal
+    assert other.links == {} and other.tags == set() and other.missed == () and other.alternatives == ()
+    other.add_tag("new")
+    other.add_link("pmid", "1")
+    assert other.get_meta()["tags"] == ["new"]
+    assert Ref({"title": "Third"}).tags == set()
+
+def test_key_suffix():
+    from __init__ import key_suffix
+    assert [ key_suffix(n) for n in (0, 1, 26, 27, 52, 702, 703) ] == ["", "a", "z", "aa", "az", "zz", "aaa"]
+    suffixes = [ key_suffix(n) for n in range(20000) ]
+    assert len(set(suffixes)) == len(suffixes)
+    assert all( s.isalpha() and s.islower() for s in suffixes[1:] )
+    # ordered by length, then alphabetically
+    assert suffixes == sorted(suffixes, key=lambda s: (len(s), s))
+
+def test_key_counters(tmp_path):
+    path = str(tmp_path / "refs.sqlite")
+    meta = {"title": "Same author and year", "authors": [["Dö", "Jane"]], "year": "2001"}
+    collection = RefCollection(path)
+    keys = [ collection.add_reference(Ref(meta)) for i in range(30) ]
+    assert keys[:3] == ["Do2001", "Do2001a", "Do2001b"]
+    assert keys[-4:] == ["Do2001z", "Do2001aa", "Do2001ab", "Do2001ac"]
+    collection.save()
+
+    # keys freed in the stored file are used again by the next session
+    import sqlite3
+    db = sqlite3.connect(path)
+    db.execute("DELETE FROM refs WHERE key IN ('Do2001a', 'Do2001c')")
+    db.commit()
+    db.close()
+    collection = RefCollection(path)
+    assert [ collection.add_reference(Ref(meta)) for i in range(3) ] == ["Do2001a", "Do2001c", "Do2001ad"]
+    # but not the key of a ref moved in the same session
+    assert collection.rekey("Do2001a") == "Do2001ae"
+    assert collection.add_reference(Ref(meta)) == "Do2001af"
+    assert not collection.loaded
@@ -0,0 +1,89 @@
+import asyncio
+import time
+
+import pytest
+
+import plugins
+import ref as mod_ref
+from plugins import bibtex as mod_bibtex
+from plugins import pubmed as mod_pubmed
+import synthetic
+
+
+class SlowProvider:
+    "A provider answering after a delay"
+
+    def __init__(self, name, delay, priority=30, stop_when_found=False, timeout=None, fails=False):
+        self.name = name
+        self.delay = delay
+        self.identifiers = ("url",)
+        self.priority = priority
+        self.stop_when_found = stop_when_found
+        if timeout is not None:
+            self.timeout = timeout
+        self.fails = fails
+        self.calls = 0
+
+    def load_ref(self, key):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fails:
+            raise OSError("unreachable")
+        return {"title": self.name, "authors": [["Doe", "Jane"]], "year": "2001"}
+
+    async def aload_ref(self, key):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        if self.fails:
+            raise OSError("unreachable")
+        return {"title": self.name, "authors": [["Doe", "Jane"]], "year": "2001"}
+
+def lookup_all(identifiers):
+    "Metadata found by sequential and asynchronous lookups"
+    sync = [ mod_ref.do_lookup(key) for key in identifiers ]
+    async def gather():
+        return await asyncio.gather( *[ mod_ref.ado_lookup(key) for key in identifiers ] )
+    asynchronous = asyncio.run(gather())
+    return ( [ ref and ref.get_meta() for ref in sync ], [ ref and ref.get_meta() for ref in asynchronous ] )
+
+@pytest.mark.skipif(not mod_bibtex._HAS_DEPS, reason="requires bibtexparser")
+def test_doi_lookups(mock_server, monkeypatch):
+    monkeypatch.setattr(mod_pubmed, "REQUEST_INTERVAL", 0)
+    monkeypatch.setattr(mod_pubmed, "API_KEY_INTERVAL", 0)
+    sync, asynchronous = lookup_all( [ synthetic.make_doi(i) for i in range(20) ] )
+    # DOIs are case insensitive
+    assert [ meta["links"]["doi"].lower() for meta in sync ] == [ synthetic.make_doi(i) for i in range(20) ]
+    assert sync == asynchronous
+
+@pytest.mark.skipif(not mod_pubmed._HAS_DEPS, reason="requires BioPython")
+def test_pmid_lookups(mock_server, monkeypatch):
+    monkeypatch.setattr(mod_pubmed, "REQUEST_INTERVAL", 0)
+    monkeypatch.setattr(mod_pubmed, "API_KEY_INTERVAL", 0)
+    sync, asynchronous = lookup_all( [ synthetic.make_pmid(i) for i in range(20) ] )
+    assert [ meta["title"] for meta in sync ] == [ synthetic.make_title(i) for i in range(20) ]
+    assert sync == asynchronous
+
+def test_providers_run_at_once(monkeypatch, capsys):
+    providers = [ SlowProvider("slow", 0.3), SlowProvider("fast", 0.1), SlowProvider("hanging", 1, timeout=0.2),
+                  SlowProvider("failing", 0, fails=True), SlowProvider("last", 0, priority=40) ]
+    monkeypatch.setattr(plugins, "providers", providers)
+    monkeypatch.setattr(plugins, "tiers", {})
+    for lookup in (mod_ref.do_lookup, lambda key, errors: asyncio.run(mod_ref.ado_lookup(key, errors=errors))):
+        errors = []
+        start = time.time()
+        ref = lookup("https://articles.example.org/page", errors=errors)
+        # the slowest answer (or timeout) of a tier, not the sum of all of them
+        assert time.time() - start < 0.6
+        # the first provider (in registration order) gives the main ref, whichever answers first
+        assert [ref.title] + [ alt.title for alt in ref.alternatives ] == ["slow", "fast", "last"]
+        assert sorted(errors) == ["failing", "hanging"]
+    assert "timeout in hanging" in capsys.readouterr().out
+
+def test_stop_when_found(monkeypatch):
+    providers = [ SlowProvider("first", 0, priority=10, stop_when_found=True), SlowProvider("second", 0, priority=20) ]
+    monkeypatch.setattr(plugins, "providers", providers)
+    monkeypatch.setattr(plugins, "tiers", {})
+    assert mod_ref.do_lookup("https://articles.example.org/page").title == "first"
+    assert providers[1].calls == 0
+    providers[0].fails = True
+    assert mod_ref.do_lookup("https://articles.example.org/page").title == "second"
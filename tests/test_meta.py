@@ -0,0 +1,58 @@
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from plugins import meta as mod_meta
+from plugins import mockserver as mod_mock
+from test_lookup import lookup_all
+import synthetic
+
+PAGE = '''<html><head><title>Caf\xe9</title>
+<script>if (old) document.write("<body>");</script><!-- <body> -->
+<meta name="citation_title" content="Caf\xe9 au lait">
+<meta name="citation_author" content="Jane Doe"><meta name="citation_author" content="Hans M\xfcller">
+<meta name="citation_publication_date" content="2001/01/01">
+</head><body><p>text</p></body></html>'''.encode("latin-1")
+
+
+def test_page_lookups(mock_server):
+    sync, asynchronous = lookup_all( [ mod_mock.PAGE_URL % synthetic.make_key(i) for i in range(20) ] )
+    assert any(sync)
+    assert sync == asynchronous
+
+def test_head_parser_stops_at_the_body():
+    parser = mod_meta.HeadParser("latin-1")
+    # small blocks, to cut tags and the script
+    for start in range(0, len(PAGE), 7):
+        parser.feed_bytes(PAGE[start:start+7])
+    parser.close()
+    assert parser.done
+    assert parser.metas[:3] == [ ("citation_title", "Caf\xe9 au lait"), ("citation_author", "Jane Doe"),
+                                 ("citation_author", "Hans M\xfcller") ]
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.send_response(200)
+        # the charset is only given by the headers
+        self.send_header("Content-Type", "text/html; charset=iso-8859-1")
+        self.send_header("Content-Length", str(len(PAGE)))
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+def test_page_charset():
+    server = HTTPServer(("127.0.0.1", 0), PageHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        url = "http://127.0.0.1:%s/page" % server.server_port
+        provider = mod_meta.HTMLMetaProvider()
+        assert provider.load_url(url)["title"] == "Caf\xe9 au lait"
+        assert asyncio.run(provider.aload_url(url))["title"] == "Caf\xe9 au lait"
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,33 @@
+import os
+import subprocess
+import sys
+
+import plugins
+
+
+def test_plugins_are_not_imported_on_start():
+    script = ("import sys, plugins; print(sorted(plugins.commands)); "
+              "print(sorted( m for m in sys.modules if m.split('.')[0] in ('Bio', 'bibtexparser', 'bs4') "
+              "or m in ('plugins.pubmed', 'plugins.bibtex', 'plugins.meta', 'plugins.export') ))")
+    output = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.dirname(plugins.__file__)),
+                            stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    commands, imported = output.strip().splitlines()[-2:]
+    assert all( name in commands for name in ("'bibtex'", "'cache'", "'export'", "'mockserver'") )
+    assert imported == "[]"
+
+def test_manifest_matches_the_plugins(capsys):
+    for provider in plugins.providers:
+        if not provider.plugin.available():
+            continue
+        instance = provider.instance()
+        assert type(instance).__name__ == provider.classname
+        assert provider.__doc__ == type(instance).__doc__
+    assert "differs" not in capsys.readouterr().out
+
+    for name,command in plugins.commands.items():
+        if isinstance(command, plugins.LazyCommand) and command.plugin.available():
+            function = getattr(command.plugin.load(), name)
+            assert command.__doc__ == function.__doc__
+    for extension,provider in plugins.importers.items():
+        if provider.plugin.available():
+            assert hasattr(provider.instance(), "import_file")
@@ -0,0 +1,49 @@
+from __init__ import Ref, RefCollection, SEARCH_FIELDS, SEARCH_ALIASES, search_text, tokenize
+import synthetic
+
+QUERIES = ["network", "net", "regulatory model", "author:lastname12", "year:1995", "journal:results journal:7",
+           "cell 199", "qualitative author:given3", "Boolean", "missing", "author:Müller"]
+
+
+def make_collection(path, count=500):
+    collection = RefCollection(path)
+    for key,meta in synthetic.make_corpus(count):
+        collection.add_reference(Ref(meta), key)
+    return collection
+
+def linear_search(collection, query):
+    "Keys of the refs with a word starting with each term of the query, as a scan of all refs would find them"
+    keys = set(collection.refs)
+    for word in query.split():
+        fields = SEARCH_FIELDS
+        if ":" in word:
+            field, word = word.split(":", 1)
+            fields = (SEARCH_ALIASES.get(field, field),)
+        for term in tokenize(word):
+            keys = set( key for key in keys if any( token.startswith(term) for field in fields
+                                                    for token in tokenize(search_text(collection.refs[key], field)) ) )
+    return keys
+
+def test_search_matches_linear_scan(tmp_path):
+    collection = make_collection(str(tmp_path / "refs.json"))
+    collection.add_reference(Ref({"title": "Café society", "authors": [["Müller", "Jürgen"]], "year": "2001"}))
+    for query in QUERIES:
+        found = [ key for key,ref in collection.search(query.split()) ]
+        assert len(found) == len(set(found))
+        assert set(found) == linear_search(collection, query), query
+
+def test_ranking(tmp_path):
+    collection = RefCollection(str(tmp_path / "refs.json"))
+    collection.add_reference(Ref({"title": "Networks of cells", "authors": [["Doe", "Jane"]], "year": "2001"}), "Prefix")
+    collection.add_reference(Ref({"title": "A network", "authors": [["Doe", "Jane"]], "year": "2001"}), "Exact")
+    collection.add_reference(Ref({"title": "Other", "authors": [["Network", "Nat"]], "year": "2001"}), "Author")
+    # authors weigh more than titles, exact words more than prefixes
+    assert [ key for key,ref in collection.search(["network"]) ] == ["Author", "Exact", "Prefix"]
+    assert [ key for key,ref in collection.search(["title:network"]) ] == ["Exact", "Prefix"]
+    assert collection.search(["unknown:network"]) == []
+
+def test_refs_added_after_the_index(tmp_path):
+    collection = make_collection(str(tmp_path / "refs.json"), 50)
+    assert collection.search(["Café"]) == []
+    collection.add_reference(Ref({"title": "Café society", "authors": [["Müller", "Jürgen"]], "year": "2001"}))
+    assert [ key for key,ref in collection.search(["cafe", "author:muller"]) ] == ["Muller2001"]
@@ -0,0 +1,146 @@
+import os
+
+import pytest
+
+from __init__ import Ref, RefCollection
+from storage import JSONStorage, open_storage
+import synthetic
+
+REFS = {
+    "Doe2001": {"title": "A first title", "authors": [["Doe", "Jane"], ["Roe", "Richard"]], "year": "2001",
+                "journal": "Journal", "links": {"doi": "10.1000/a", "pmid": "123"}, "tags": ["b", "a"]},
+    "Müller2002": {"title": "Café — unicode", "authors": [["Müller", "Hans"]], "year": 2002,
+                        "volume": "3", "pages": "1-10", "extra": "unknown field",
+                        "alternatives": [ {"title": "Another version", "authors": [["Müller", "H"]]} ]},
+    "Smith2003": {"title": "No links", "authors": [["Smith", "John"]], "year": "2003"},
+}
+
+
+def make_collection(path):
+    collection = RefCollection(path)
+    for key in sorted(REFS):
+        collection.add_reference(Ref(REFS[key]), key)
+    collection.save()
+    return collection
+
+def read(path):
+    f = open(path, "rb")
+    data = f.read()
+    f.close()
+    return data
+
+def convert(source, destination):
+    import ref as mod_ref
+    mod_ref.convert(RefCollection(source), [destination])
+
+def test_journal_replay_after_crash(tmp_path, capsys):
+    path = str(tmp_path / "refs.json")
+    collection = make_collection(path)
+    collection.storage.compact(collection.refs)
+
+    collection.add_reference(Ref({"title": "Saved in the journal", "authors": [["Late", "Lou"]], "year": "2004"}))
+    collection.get("Smith2003").add_tag("changed")
+    collection.save()
+    assert os.path.isfile(path + ".journal")
+    # a crash in the middle of the next write
+    f = open(path + ".journal", "a")
+    f.write('{"key": "Lost2005", "ref": {"title": "Trunc')
+    f.close()
+
+    reopened = RefCollection(path)
+    assert "Ignoring a broken entry" in capsys.readouterr().out
+    assert sorted(reopened.keys()) == ["Doe2001", "Late2004", "Müller2002", "Smith2003"]
+    assert reopened.get("Smith2003").tags == {"changed"}
+    assert reopened.storage.journal_broken
+
+    # the next save rewrites the main file and removes the broken journal
+    reopened.get("Doe2001").add_tag("c")
+    reopened.save()
+    assert not os.path.isfile(path + ".journal")
+    assert sorted(RefCollection(path).get("Doe2001").tags) == ["a", "b", "c"]
+
+def test_sqlite_concurrent_keys(tmp_path, capsys):
+    path = str(tmp_path / "refs.sqlite")
+    first = RefCollection(path)
+    second = RefCollection(path)
+    meta = {"authors": [["Doe", "Jane"]], "year": "2001"}
+    assert first.add_reference(Ref(dict(meta, title="First"))) == "Doe2001"
+    assert second.add_reference(Ref(dict(meta, title="Second"))) == "Doe2001"
+    second.save()
+    first.save()
+
+    saved = RefCollection(path)
+    assert saved.get("Doe2001").title == "Second"
+    assert saved.get("Doe2001a").title == "First"
+    assert "saved as Doe2001a" in capsys.readouterr().out
+
+def test_round_trip(tmp_path):
+    source = str(tmp_path / "source.json")
+    make_collection(source).storage.compact( RefCollection(source).refs )
+
+    convert(source, str(tmp_path / "copy.sqlite"))
+    convert(str(tmp_path / "copy.sqlite"), str(tmp_path / "copy.refs"))
+    convert(str(tmp_path / "copy.refs"), str(tmp_path / "copy.json"))
+
+    copy = RefCollection(str(tmp_path / "copy.json"))
+    copy.storage.compact(copy.refs)
+    assert read(str(tmp_path / "copy.json")) == read(source)
+
+def test_duplicates_need_the_same_first_author(tmp_path):
+    collection = RefCollection(str(tmp_path / "refs.json"))
+    collection.add_reference(Ref({"title": "Editorial.", "authors": [["Jones", "Ann"]], "year": "2015", "journal": "Cell"}))
+    collection.add_reference(Ref({"title": "Editorial", "year": "2015", "journal": "Science"}), "Anonymous2015")
+    other_author = Ref({"title": "Editorial", "authors": [["Smith", "Bob"]], "year": "2015", "journal": "Nature"})
+    assert collection.find_duplicate(other_author) is None
+    same_author = Ref({"title": "editorial", "authors": [["Jonés", "A"]], "year": "2015"})
+    assert collection.find_duplicate(same_author) == ("Jones2015", False)
+    # without authors, the journal must match
+    assert collection.find_duplicate(Ref({"title": "Editorial", "year": "2015", "journal": "Science"})) == ("Anonymous2015", False)
+    assert collection.find_duplicate(Ref({"title": "Editorial", "year": "2015", "journal": "Nature"})) is None
+
+def test_duplicates_without_loading(tmp_path):
+    for extension in ("sqlite", "refs"):
+        path = str(tmp_path / ("refs." + extension))
+        make_collection(path)
+        collection = RefCollection(path)
+        similar = Ref({"title": "A first title.", "authors": [["Doe", "J"]], "year": "2001"})
+        assert collection.find_duplicate(similar) == ("Doe2001", False)
+        same_doi = Ref({"title": "Other", "authors": [["X", "Y"]], "links": {"doi": "10.1000/A"}})
+        assert collection.find_duplicate(same_doi) == ("Doe2001", True)
+        assert collection.find_duplicate(Ref({"title": "Unrelated", "authors": [["X", "Y"]]})) is None
+        assert not collection.loaded
+
+def test_storage_extension(tmp_path):
+    folder = tmp_path / "v1.sqlite"
+    folder.mkdir()
+    collection = make_collection(str(folder / "refs.JSON"))
+    assert isinstance(collection.storage, JSONStorage)
+    assert sorted(RefCollection(str(folder / "refs.JSON")).keys()) == sorted(REFS)
+    with pytest.raises(ValueError):
+        open_storage(str(folder / "refs"))
+
+def test_binary_lookups(tmp_path):
+    path = str(tmp_path / "refs.refs")
+    collection = RefCollection(path)
+    keys = [ synthetic.make_key(i) for i in range(300) ] + ["Müller2002", "Zoé2001", "Ábel1999"]
+    for key in keys:
+        collection.add_reference(Ref(dict(synthetic.make_meta(len(key)), title=key)), key)
+    collection.save()
+
+    reopened = RefCollection(path)
+    for key in keys:
+        assert reopened.get(key).title == key
+    for key in ("", "A", "Synthetic", "Synthetic1000", "Synthetic99a", "Zz"):
+        assert not reopened.contains(key)
+        assert reopened.storage.load(key) is None
+
+    # only the requested refs are decoded, the others are copied as they are
+    reopened = RefCollection(path)
+    reopened.get("Synthetic42").add_tag("read")
+    reopened.save()
+    assert list(reopened.refs) == ["Synthetic42"]
+    assert not reopened.loaded
+    saved = RefCollection(path)
+    assert sorted(saved.keys()) == sorted(keys)
+    assert saved.get("Synthetic42").tags == {"read"}
+    assert saved.get("Zoé2001").get_meta() == collection.get("Zoé2001").get_meta()
@@ -0,0 +1,82 @@
+import asyncio
+import gzip
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from plugins import webclient as mod_web
+
+BODY = b"<html>" + b"compressed " * 1000 + b"</html>"
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.connections.add(self.client_address)
+        server.requests.append(self.path)
+        if self.path == "/redirect":
+            self.answer(302, b"", [("Location", "/page")])
+        elif self.path == "/flaky" and server.requests.count("/flaky") < 3:
+            self.answer(503, b"busy", [("Retry-After", "0")])
+        elif self.path in ("/page", "/flaky"):
+            assert "gzip" in self.headers.get("Accept-Encoding", "")
+            self.answer(200, gzip.compress(BODY), [("Content-Encoding", "gzip")])
+        else:
+            self.answer(404, b"not found")
+
+    def answer(self, status, body, headers=()):
+        self.send_response(status)
+        for name,value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.connections = set()
+    server.requests = []
+    server.url = "http://127.0.0.1:%s" % server.server_port
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    monkeypatch.setattr(mod_web, "MOCK_SERVER", "")
+    monkeypatch.setattr(mod_web, "BACKOFF", 0)
+    monkeypatch.setattr(mod_web, "pool", mod_web.ConnectionPool())
+    yield server
+    mod_web.pool.clear()
+    server.shutdown()
+    server.server_close()
+
+def test_keep_alive(server):
+    for i in range(10):
+        assert mod_web.get(server.url + "/page") == BODY
+    assert mod_web.get(server.url + "/redirect") == BODY
+    assert mod_web.get(server.url + "/flaky") == BODY
+    with pytest.raises(mod_web.HTTPError) as error:
+        mod_web.get(server.url + "/missing")
+    assert mod_web.not_found(error.value)
+    # a single connection for all requests, including the redirects and retries
+    assert len(server.requests) == 16
+    assert len(server.connections) == 1
+
+def test_async_keep_alive(server):
+    async def fetch():
+        pages = [ await mod_web.aget(server.url + "/page") for i in range(10) ]
+        pages.append( await mod_web.aget(server.url + "/redirect") )
+        pages.append( await mod_web.aget(server.url + "/flaky") )
+        with pytest.raises(mod_web.HTTPError):
+            await mod_web.aget(server.url + "/missing")
+        mod_web.get_async_pool().clear()
+        return pages
+    assert asyncio.run(fetch()) == [BODY] * 12
+    assert len(server.requests) == 16
+    assert len(server.connections) == 1